@@ -2,7 +2,7 @@
 Hostelix Pro - Hostel Management System
 Flask application factory and configuration
 """
-from flask import Flask, jsonify
+from flask import Flask, jsonify, g, request
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
@@ -42,7 +42,7 @@ def create_app(config_name='development'):
     migrate.init_app(app, db)
     
     # Register blueprints
-    from app.api import auth_bp, users_bp, account_bp, reports_bp, routines_bp, fees_bp, announcements_bp, audit_bp, backups_bp, dashboard_bp, notifications_bp
+    from app.api import auth_bp, users_bp, account_bp, reports_bp, routines_bp, fees_bp, announcements_bp, audit_bp, backups_bp, dashboard_bp, notifications_bp, exports_bp
     
     app.register_blueprint(auth_bp, url_prefix='/api/v1/auth')
     app.register_blueprint(users_bp, url_prefix='/api/v1/users')
@@ -55,7 +55,26 @@ def create_app(config_name='development'):
     app.register_blueprint(backups_bp, url_prefix='/api/v1/backups')
     app.register_blueprint(dashboard_bp, url_prefix='/api/v1/dashboard')
     app.register_blueprint(notifications_bp, url_prefix='/api/v1/notifications')
+    app.register_blueprint(exports_bp, url_prefix='/api/v1/exports')
     
+    # Maintenance mode (e.g. during a restore): turn requests away with 503
+    from app.services.maintenance_service import MaintenanceService
+
+    @app.before_request
+    def maintenance_gate():
+        g.maintenance_counted = True
+        status = MaintenanceService.request_started(request.endpoint)
+        if status:
+            response = jsonify({'error': 'Maintenance in progress', 'maintenance': status})
+            response.status_code = 503
+            response.headers['Retry-After'] = '30'
+            return response
+
+    @app.teardown_request
+    def maintenance_count(exc):
+        if g.pop('maintenance_counted', False):
+            MaintenanceService.request_finished()
+
     # Health check endpoint
     @app.route('/api/v1/health', methods=['GET'])
     def health_check():
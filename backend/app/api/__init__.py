@@ -15,10 +15,11 @@ audit_bp = Blueprint('audit', __name__)
 backups_bp = Blueprint('backups', __name__)
 dashboard_bp = Blueprint('dashboard', __name__)
 notifications_bp = Blueprint('notifications', __name__)
+exports_bp = Blueprint('exports', __name__)
 
 # Import routes (must be after blueprint creation to avoid circular imports)
-from app.api import auth, users, account, reports, routines, fees, announcements, audit, backups, dashboard, notifications
+from app.api import auth, users, account, reports, routines, fees, announcements, audit, backups, dashboard, notifications, exports
 
-__all__ = ['auth_bp', 'users_bp', 'account_bp', 'reports_bp', 'routines_bp', 'fees_bp', 'announcements_bp', 'audit_bp', 'backups_bp', 'dashboard_bp', 'notifications_bp']
+__all__ = ['auth_bp', 'users_bp', 'account_bp', 'reports_bp', 'routines_bp', 'fees_bp', 'announcements_bp', 'audit_bp', 'backups_bp', 'dashboard_bp', 'notifications_bp', 'exports_bp']
 
 
@@ -1,7 +1,8 @@
 """
 Backup API endpoints
 """
-from flask import request, jsonify, send_file
+import os
+from flask import request, jsonify, send_file, Response
 # Remove Blueprint import as we import the instance
 # from flask import Blueprint 
 from app import db
@@ -9,6 +10,10 @@ from app.api import backups_bp
 from app.models.backup_meta import BackupMeta
 from app.models.audit_log import AuditLog
 from app.services.backup_service import BackupService
+from app.services.backup_schedule_service import BackupScheduleService
+from app.services.job_service import JobService
+from app.services.restore_service import RestoreService
+from app.utils.encryption import BackupEncryption
 from app.utils.decorators import token_required, role_required
 
 # backups_bp definition removed, imported above
@@ -19,11 +24,24 @@ from app.utils.decorators import token_required, role_required
 def create_backup():
     """
     Create a new encrypted backup
+    JSON body (optional): format ('sqlite'/'logical'), type ('full'/'incremental'),
+    key (required for incremental: the key of the chain's full backup),
+    storage ('file', or 'chunks' to only store what earlier backups with
+    the same key lack), uploads (true to also back up the uploaded files
+    the database references)
     Returns: Backup metadata and encryption key
     """
     user_id = request.current_user.get('user_id')
+    data = request.get_json(silent=True) or {}
     try:
-        backup, key = BackupService.create_backup(user_id)
+        backup, key = BackupService.create_backup(
+            user_id,
+            encryption_key_str=data.get('key'),
+            backup_format=data.get('format'),
+            backup_type=data.get('type', 'full'),
+            storage=data.get('storage', 'file'),
+            include_uploads=bool(data.get('uploads', False))
+        )
         
         # Log action
         ip = request.remote_addr
@@ -35,7 +53,15 @@ def create_backup():
             entity_id=backup.id,
             ip=ip,
             device=device,
-            details={'filename': backup.filename, 'size': backup.file_size_bytes}
+            details={
+                'filename': backup.filename,
+                'size': backup.file_size_bytes,
+                'format': backup.backup_format,
+                'type': backup.backup_type,
+                'storage': backup.storage,
+                'upload_files': backup.upload_files,
+                'parent_id': backup.parent_id
+            }
         )
         db.session.commit()
         
@@ -44,6 +70,8 @@ def create_backup():
             'backup': backup.to_dict(),
             'encryption_key': key # IMPORTANT: User must save this!
         }), 201
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -55,6 +83,31 @@ def list_backups():
     backups = BackupMeta.query.order_by(BackupMeta.created_at.desc()).all()
     return jsonify([b.to_dict() for b in backups]), 200
 
+@backups_bp.route('/chain', methods=['GET'])
+@token_required
+@role_required('admin')
+def backup_chain():
+    """
+    Status of a backup chain: the full backup and incrementals a restore
+    replays. Query: backup_id (default: latest backup)
+    """
+    backup_id = request.args.get('backup_id', type=int)
+    status, error = BackupService.chain_status(backup_id)
+    if error:
+        return jsonify({'error': error}), 404
+    return jsonify(status), 200
+
+@backups_bp.route('/runs', methods=['GET'])
+@token_required
+@role_required('admin')
+def list_backup_runs():
+    """
+    Recent scheduled backup runs with their metrics (duration, throughput,
+    time throttled, what retention pruned). Query: limit (default 50)
+    """
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return jsonify([run.to_dict() for run in BackupScheduleService.recent_runs(limit)]), 200
+
 @backups_bp.route('/<int:id>/download', methods=['GET'])
 @token_required
 @role_required('admin')
@@ -62,11 +115,13 @@ def download_backup(id):
     """Download encrypted backup file"""
     backup = BackupMeta.query.get_or_404(id)
     backup_dir = BackupService._get_backup_dir()
-    import os
     path = os.path.join(backup_dir, backup.filename)
     
     if not os.path.exists(path):
         return jsonify({'error': 'File not found'}), 404
+    if backup.storage == 'chunks':
+        # The file is only the manifest; the content is spread over the chunk store
+        return jsonify({'error': 'Chunked backups can only be downloaded decrypted (POST with the key)'}), 400
         
     return send_file(
         path,
@@ -75,12 +130,63 @@ def download_backup(id):
         mimetype='application/octet-stream'
     )
 
+@backups_bp.route('/<int:id>/download', methods=['POST'])
+@token_required
+@role_required('admin')
+def download_decrypted_backup(id):
+    """
+    Stream a backup decrypted with the key in the JSON body
+    Chunks are authenticated before they are sent; a corrupt or truncated
+    file aborts the transfer rather than sending unauthenticated data
+    """
+    backup = BackupMeta.query.get_or_404(id)
+    data = request.get_json() or {}
+    if not data.get('key'):
+        return jsonify({'error': 'key is required'}), 400
+
+    path = os.path.join(BackupService._get_backup_dir(), backup.filename)
+    if not os.path.exists(path):
+        return jsonify({'error': 'File not found'}), 404
+
+    try:
+        key = BackupEncryption.key_from_string(data['key'])
+        chunks = BackupService.iter_content(backup, key)
+        # Authenticate the first chunk before committing to a 200
+        first = next(chunks)
+    except Exception as e:
+        return jsonify({'error': f"Decryption failed: {e}"}), 400
+
+    AuditLog.log(
+        user_id=request.current_user.get('user_id'),
+        action='BACKUP_DOWNLOAD_DECRYPTED',
+        entity='backup',
+        entity_id=backup.id,
+        ip=request.remote_addr,
+        device=request.headers.get('User-Agent', '')
+    )
+    db.session.commit()
+
+    # Logical backups decrypt to a table archive, not a database file
+    extension = 'hxl' if backup.backup_format == 'logical' else 'db'
+
+    def stream():
+        yield first
+        yield from chunks
+
+    return Response(
+        stream(),
+        mimetype='application/octet-stream',
+        headers={'Content-Disposition': f"attachment; filename={os.path.splitext(backup.filename)[0]}.{extension}"}
+    )
+
 @backups_bp.route('/restore', methods=['POST'])
 @token_required
 @role_required('admin')
 def restore_backup():
     """
-    Verify and restore backup
+    Verify a backup and its chain without writing it to disk (the live
+    database is not touched; see POST /<id>/restore)
+    Returns: message and the verification report
     """
     data = request.get_json()
     backup_id = data.get('backup_id')
@@ -90,7 +196,7 @@ def restore_backup():
         return jsonify({'error': 'backup_id and key are required'}), 400
         
     try:
-        success, message = BackupService.restore_backup(backup_id, key)
+        success, message, report = BackupService.restore_backup(backup_id, key)
         
         # Log action
         user_id = request.current_user.get('user_id')
@@ -108,9 +214,54 @@ def restore_backup():
         db.session.commit()
         
         if success:
-            return jsonify({'message': message}), 200
+            return jsonify({'message': message, 'report': report}), 200
         else:
-            return jsonify({'error': message}), 400
+            return jsonify({'error': message, 'report': report}), 400
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+
+@backups_bp.route('/<int:id>/restore', methods=['POST'])
+@token_required
+@role_required('admin')
+def start_restore(id):
+    """
+    Restore a backup (and the chain before it) over the live database
+    Runs on the background worker; the API is in maintenance mode (503)
+    while the database is swapped. JSON body: key
+    Returns: job id to poll at status_url
+    """
+    data = request.get_json(silent=True) or {}
+    if not data.get('key'):
+        return jsonify({'error': 'key is required'}), 400
+
+    user_id = request.current_user.get('user_id')
+    job_id, error = RestoreService.start(id, data['key'], user_id)
+    if error:
+        return jsonify({'error': error}), 400
+
+    AuditLog.log(
+        user_id=user_id,
+        action='BACKUP_RESTORE_START',
+        entity='backup',
+        entity_id=id,
+        ip=request.remote_addr,
+        device=request.headers.get('User-Agent', ''),
+        details={'job_id': job_id}
+    )
+    db.session.commit()
+    return jsonify({'job_id': job_id, 'status_url': f"/api/v1/backups/restore/{job_id}"}), 202
+
+@backups_bp.route('/restore/<job_id>', methods=['GET'])
+@token_required
+@role_required('admin')
+def restore_status(job_id):
+    """
+    Poll a restore: status plus progress (phase, percent, message)
+    Served during maintenance mode
+    """
+    job = JobService.get_job(job_id, request.current_user)
+    if not job or 'backup_id' not in job.meta:
+        return jsonify({'error': 'Restore job not found'}), 404
+    return jsonify(RestoreService.job_status(job)), 200
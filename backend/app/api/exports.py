@@ -0,0 +1,77 @@
+"""
+Export job API endpoints
+Status and download of exports rendered by the background worker
+"""
+import os
+from flask import request, jsonify, send_file, Response, stream_with_context
+from app.api import exports_bp
+from app.services.job_service import JobService
+from app.services.table_export_service import TableExportService, FORMATS
+from app.utils.decorators import token_required, role_required
+
+
+@exports_bp.route('/<job_id>', methods=['GET'])
+@token_required
+def get_export_status(job_id):
+    """Poll an export job: queued, started, finished (with download_url) or failed"""
+    job = JobService.get_job(job_id, request.current_user)
+    if not job:
+        return jsonify({'error': 'Export job not found'}), 404
+
+    return jsonify(JobService.job_status(job)), 200
+
+
+@exports_bp.route('/<job_id>/download', methods=['GET'])
+@token_required
+def download_export(job_id):
+    """Download a finished export while its result is retained"""
+    job = JobService.get_job(job_id, request.current_user)
+    if not job:
+        return jsonify({'error': 'Export job not found'}), 404
+
+    if not job.is_finished:
+        return jsonify({'error': 'Export not ready', 'status': JobService.job_status(job)['status']}), 409
+
+    result = job.return_value()
+    if not result or not os.path.exists(result['path']):
+        return jsonify({'error': 'Export expired'}), 410
+
+    return send_file(
+        result['path'],
+        as_attachment=True,
+        download_name=result['download_name'],
+        mimetype=result['mimetype']
+    )
+
+
+@exports_bp.route('/tables/<table>', methods=['GET'])
+@token_required
+@role_required('admin')
+def export_table(table):
+    """
+    Stream a whole table (fees, transactions, routines, audit_logs)
+    Query params:
+        format: csv (default), ndjson or parquet (needs pyarrow)
+        columns: comma-separated column names (default all)
+        from, to: epoch ms bounds on the table's time column (to is exclusive)
+    """
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(FORMATS)}"}), 400
+    if fmt == 'parquet' and not TableExportService.parquet_available():
+        return jsonify({'error': 'Parquet export requires pyarrow to be installed'}), 400
+
+    columns, error = TableExportService.resolve_columns(table, request.args.get('columns'))
+    if error:
+        return jsonify({'error': error}), 400
+
+    stream = TableExportService.stream(
+        table, fmt, columns,
+        from_ms=request.args.get('from', type=int),
+        to_ms=request.args.get('to', type=int)
+    )
+    return Response(
+        stream_with_context(stream),
+        mimetype=FORMATS[fmt]['mimetype'],
+        headers={'Content-Disposition': f"attachment; filename={table}.{FORMATS[fmt]['extension']}"}
+    )
@@ -1,18 +1,27 @@
 """
 Fee API endpoints
 """
-from flask import request, jsonify, send_file, current_app
+from flask import request, jsonify, send_file, Response
 from app import db
 from app.api import fees_bp
 from app.models.fee import Fee
 from app.models.fee_structure import FeeStructure
 from app.models.student import Student
 from app.services.fee_service import FeeService
-from app.services.export_service import ExportService
+from app.services.export_service import ExportService, render_challan, render_statement
+from app.services.document_cache_service import DocumentCacheService
+from app.services.receipt_service import ReceiptService
+from app.services.statement_import_service import StatementImportService
+from app.services.ledger_service import LedgerService
+from app.services.aging_service import AgingService
+from app.services.proof_storage_service import ProofStorageService
+from app.services.proof_image_service import ProofImageService
+from app.services.job_service import JobService
+from app.services.time_service import TimeService
 from app.utils.decorators import token_required, role_required
 from datetime import datetime
 import os
-import uuid
+import tempfile
 from werkzeug.utils import secure_filename
 
 # --- Fee Structure Management (Admin) ---
@@ -106,7 +115,7 @@ def list_fees():
     )
     
     return jsonify({
-        'fees': [f.to_dict() for f in pagination.items],
+        'fees': ProofImageService.attach([f.to_dict() for f in pagination.items], originals=role == 'admin'),
         'total': pagination.total,
         'pages': pagination.pages,
         'current_page': page
@@ -243,12 +252,42 @@ def get_fee_stats():
         'actual_collection': str(actual_collection)
     }), 200
 
+@fees_bp.route('/aging', methods=['GET'])
+@token_required
+@role_required('admin')
+def get_fee_aging():
+    """
+    Receivables aging: outstanding balances bucketed by days past due
+    Query params:
+        group_by: student | room | teacher (default student)
+        as_of: YYYY-MM-DD (default today)
+        refresh: 'true' to bypass the cache (kept until fees, payments or students change)
+    """
+    as_of = None
+    if request.args.get('as_of'):
+        try:
+            as_of = datetime.strptime(request.args['as_of'], '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'as_of must be YYYY-MM-DD'}), 400
+
+    report, error = AgingService.get_report(
+        as_of=as_of,
+        group_by=request.args.get('group_by', 'student'),
+        refresh=request.args.get('refresh', 'false').lower() == 'true'
+    )
+    if error:
+        return jsonify({'error': error}), 400
+
+    return jsonify(report), 200
+
 @fees_bp.route('/upload-proof', methods=['POST'])
 @token_required
 @role_required('student', 'admin')
 def upload_proof():
     """
     Upload payment proof image
+    Stored by content: re-uploading an image returns the path it already has (200)
+    Its thumbnail and display copy are made on the background worker
     """
     if 'proof_file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
@@ -258,17 +297,12 @@ def upload_proof():
         return jsonify({'error': 'No selected file'}), 400
         
     if file:
-        filename = secure_filename(file.filename)
-        unique_name = f"{uuid.uuid4()}_{filename}"
-        
-        # Save to static/uploads/proofs
-        upload_dir = os.path.join(current_app.root_path, 'static', 'uploads', 'proofs')
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        file.save(os.path.join(upload_dir, unique_name))
+        blob, created = ProofStorageService.store(file.stream, secure_filename(file.filename))
+        if created:
+            ProofImageService.enqueue(blob)
         
         # Return path relative to static
-        return jsonify({'path': f"/static/uploads/proofs/{unique_name}"}), 201
+        return jsonify({'path': blob.path}), 201 if created else 200
 
     return jsonify({'error': 'Upload failed'}), 500
 
@@ -297,6 +331,38 @@ def submit_fee():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@fees_bp.route('/import-statement', methods=['POST'])
+@token_required
+@role_required('admin')
+def import_statement():
+    """
+    Import a CSV/XLSX bank statement and auto-match rows to fees
+    Form fields: statement_file, dry_run (optional, 'true' to preview)
+    """
+    if 'statement_file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+
+    file = request.files['statement_file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    dry_run = request.form.get('dry_run', 'false').lower() == 'true'
+
+    try:
+        summary = StatementImportService.import_statement(
+            file.stream,
+            file.filename,
+            request.current_user['user_id'],
+            dry_run=dry_run
+        )
+        return jsonify(summary), 200
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 @fees_bp.route('/transactions/<int:id>/approve', methods=['POST'])
 @token_required
 @role_required('admin')
@@ -337,21 +403,219 @@ def get_fee_transactions(id):
             return jsonify({'error': 'Unauthorized'}), 403
             
     transactions = Transaction.query.filter_by(fee_id=id).order_by(Transaction.transaction_date.desc()).all()
-    return jsonify([t.to_dict() for t in transactions]), 200
+    return jsonify(ProofImageService.attach(
+        [t.to_dict() for t in transactions], originals=user['role'] == 'admin'
+    )), 200
 
 @fees_bp.route('/<int:id>/challan', methods=['GET'])
 @token_required
 def download_challan(id):
     """
     Download Fee Challan PDF
+    With ?async=true the PDF is rendered on the background worker and a job id is returned
     """
+    if request.args.get('async', 'false').lower() == 'true':
+        job_id, error = JobService.enqueue_export('fee_challan', {'fee_id': id}, request.current_user['user_id'])
+        if error:
+            return jsonify({'error': error}), 503
+        return jsonify({'job_id': job_id, 'status_url': f"/api/v1/exports/{job_id}"}), 202
+
+    data = ExportService.challan_data(id)
+    if not data:
+        return jsonify({'error': 'Fee not found'}), 404
+    return _send_document('challan', id, data['version'], lambda: render_challan(data), f"fee_challan_{id}.pdf")
+
+@fees_bp.route('/transactions/<int:id>/receipt', methods=['GET'])
+@token_required
+def download_receipt(id):
+    """Download the PDF receipt of an approved transaction"""
+    data = ExportService.receipt_data(id)
+    if not data:
+        return jsonify({'error': 'Transaction not found'}), 404
+
+    user = request.current_user
+    if user['role'] == 'student' and data['student_user_id'] != user['user_id']:
+        return jsonify({'error': 'Unauthorized'}), 403
+
     try:
-        buffer = ExportService.generate_fee_challan(id)
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=f"fee_challan_{id}.pdf",
-            mimetype='application/pdf'
-        )
+        path, error = ReceiptService.get_receipt(id, data)
     except Exception as e:
         return jsonify({'error': str(e)}), 400
+    if error:
+        return jsonify({'error': error}), 400
+
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name=f"receipt_{id}.pdf",
+        mimetype='application/pdf',
+        conditional=True,
+        etag=True
+    )
+
+@fees_bp.route('/challans/bulk', methods=['GET'])
+@token_required
+@role_required('admin')
+def download_bulk_challans():
+    """
+    Download every challan of a month as a ZIP of PDFs
+    Query params:
+        month, year: required
+        structure_id: only fees of this fee structure (optional)
+        async: 'true' to render on the background worker and return a job id
+    Render throughput is returned in X-Challan-* headers (or the job's stats)
+    """
+    month = request.args.get('month', type=int)
+    year = request.args.get('year', type=int)
+    if not month or not year or not 1 <= month <= 12:
+        return jsonify({'error': 'month (1-12) and year are required'}), 400
+
+    params = {'month': month, 'year': year, 'fee_structure_id': request.args.get('structure_id', type=int)}
+
+    if request.args.get('async', 'false').lower() == 'true':
+        job_id, error = JobService.enqueue_export('bulk_challans', params, request.current_user['user_id'])
+        if error:
+            return jsonify({'error': error}), 503
+        return jsonify({'job_id': job_id, 'status_url': f"/api/v1/exports/{job_id}"}), 202
+
+    fd, path = tempfile.mkstemp(prefix='fee_challans_', suffix='.zip')
+    os.close(fd)
+    try:
+        stats = ExportService.write_bulk_challans(path, **params)
+    except Exception as e:
+        os.remove(path)
+        return jsonify({'error': str(e)}), 400
+
+    return Response(
+        ExportService.iter_file(path, delete=True),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f"attachment; filename=fee_challans_{year}_{month:02d}.zip",
+            'X-Challan-Count': str(stats['count']),
+            'X-Challan-Render-Seconds': str(stats['seconds']),
+            'X-Challans-Per-Second': str(stats['challans_per_second'])
+        }
+    )
+
+def _send_document(doc_type, entity_id, version, render, download_name):
+    """
+    Serve a rendered PDF from the document cache
+    A matching If-None-Match gets a 304 before the cache is even touched;
+    otherwise a hit costs one stat and the file is sent as-is.
+    """
+    etag = DocumentCacheService.key(doc_type, entity_id, version)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        try:
+            path, etag = DocumentCacheService.get_or_render(doc_type, entity_id, version, render)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 400
+        response = send_file(
+            path,
+            as_attachment=True,
+            download_name=download_name,
+            mimetype='application/pdf',
+            conditional=False
+        )
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# --- Ledger ---
+
+def _ledger_student_id():
+    """
+    Student whose ledger is requested
+    Students always get their own; admins pass ?student_id=
+    Returns (student_id, error_response)
+    """
+    user = request.current_user
+    if user['role'] == 'student':
+        student = Student.query.filter_by(user_id=user['user_id']).first()
+        if not student:
+            return None, (jsonify({'error': 'Student profile not found'}), 404)
+        return student.id, None
+
+    student_id = request.args.get('student_id', type=int)
+    if not student_id:
+        return None, (jsonify({'error': 'student_id is required'}), 400)
+    return student_id, None
+
+@fees_bp.route('/balance', methods=['GET'])
+@token_required
+@role_required('admin', 'student')
+def get_balance():
+    """
+    Balance owed at a point in time
+    Query params: student_id (admin), as_of (epoch ms, default now)
+    """
+    student_id, error = _ledger_student_id()
+    if error:
+        return error
+
+    as_of = request.args.get('as_of', TimeService.now_ms(), type=int)
+    balance = LedgerService.balance_at(student_id, as_of)
+    return jsonify({'student_id': student_id, 'as_of': as_of, 'balance': str(balance)}), 200
+
+@fees_bp.route('/statement', methods=['GET'])
+@token_required
+@role_required('admin', 'student')
+def get_statement():
+    """
+    Ledger statement with opening/closing balances
+    Query params: student_id (admin), from, to (epoch ms, default last 30 days),
+    format ('json' or 'pdf'; PDF statements cover whole UTC days)
+    """
+    student_id, error = _ledger_student_id()
+    if error:
+        return error
+
+    to_ms = request.args.get('to', TimeService.now_ms(), type=int)
+    from_ms = request.args.get('from', to_ms - 30 * 24 * 60 * 60 * 1000, type=int)
+    if from_ms > to_ms:
+        return jsonify({'error': 'from must be before to'}), 400
+
+    if request.args.get('format') == 'pdf':
+        from_ms, to_ms = ExportService.statement_period(from_ms, to_ms)
+        return _send_document(
+            'statement', f"{student_id}:{from_ms}:{to_ms}",
+            ExportService.statement_version(student_id, to_ms),
+            lambda: render_statement(ExportService.statement_data(student_id, from_ms, to_ms)),
+            f"statement_{student_id}.pdf"
+        )
+
+    return jsonify(LedgerService.statement(student_id, from_ms, to_ms)), 200
+
+@fees_bp.route('/<int:id>/late-fee', methods=['POST'])
+@token_required
+@role_required('admin')
+def add_late_fee(id):
+    """Charge a late fee against a fee record"""
+    data = request.get_json() or {}
+    fee, error = FeeService.add_late_fee(id, data.get('amount'), request.current_user['user_id'])
+
+    if error:
+        return jsonify({'error': error}), 400
+
+    return jsonify(fee.to_dict()), 200
+
+@fees_bp.route('/ledger/<int:entry_id>/reverse', methods=['POST'])
+@token_required
+@role_required('admin')
+def reverse_ledger_entry(entry_id):
+    """
+    Waive a late fee by reversing its ledger entry
+    Payments are reversed by rejecting their transaction instead
+    """
+    data = request.get_json() or {}
+    reason = data.get('reason')
+    if not reason:
+        return jsonify({'error': 'Reason required for reversal'}), 400
+
+    reversal, error = FeeService.waive_late_fee(entry_id, request.current_user['user_id'], reason)
+
+    if error:
+        return jsonify({'error': error}), 400
+
+    return jsonify(reversal.to_dict()), 201
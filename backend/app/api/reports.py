@@ -1,10 +1,16 @@
-from flask import request, jsonify, send_file
+from flask import request, jsonify, Response, send_file
+from datetime import datetime, timedelta
+import io
+import os
+import tempfile
 from app.api import reports_bp
 from app import db
 from app.models.report import Report
 from app.models.student import Student
 from app.services.report_service import ReportService
 from app.services.export_service import ExportService
+from app.services.job_service import JobService
+from app.services.attendance_service import AttendanceService
 from app.utils.decorators import token_required, role_required, validate_json
 
 @reports_bp.route('', methods=['GET'])
@@ -124,15 +130,103 @@ def reject_report(report_id):
 @role_required('admin')
 def export_reports():
     """
-    Export reports as Excel
+    Export reports as Excel, streamed in chunks
+    Query params:
+        from: YYYY-MM-DD (inclusive, by wake time)
+        to: YYYY-MM-DD (inclusive)
+        status: report status (optional)
+        async: 'true' to render on the background worker and return a job id
     """
     try:
-        buffer = ExportService.generate_reports_excel()
+        date_from_ms = _date_param_ms('from')
+        date_to_ms = _date_param_ms('to', days_after=1)
+    except ValueError:
+        return jsonify({'error': 'from/to must be YYYY-MM-DD'}), 400
+
+    if request.args.get('async', 'false').lower() == 'true':
+        job_id, error = JobService.enqueue_export(
+            'reports_xlsx',
+            {'date_from_ms': date_from_ms, 'date_to_ms': date_to_ms, 'status': request.args.get('status')},
+            request.current_user['user_id']
+        )
+        if error:
+            return jsonify({'error': error}), 503
+        return jsonify({'job_id': job_id, 'status_url': f"/api/v1/exports/{job_id}"}), 202
+
+    fd, path = tempfile.mkstemp(prefix='reports_export_', suffix='.xlsx')
+    os.close(fd)
+    try:
+        ExportService.write_reports_excel(
+            path,
+            date_from_ms=date_from_ms,
+            date_to_ms=date_to_ms,
+            status=request.args.get('status')
+        )
+    except Exception as e:
+        os.remove(path)
+        return jsonify({'error': str(e)}), 400
+
+    return Response(
+        ExportService.iter_file(path, delete=True),
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Content-Disposition': 'attachment; filename=reports_export.xlsx'}
+    )
+
+
+@reports_bp.route('/attendance', methods=['GET'])
+@token_required
+@role_required('teacher', 'admin')
+def attendance_matrix():
+    """
+    Monthly attendance matrix (student x day) from filed wake reports
+    Teachers get their assigned students; admins may pass teacher_id
+    Query params:
+        year, month: default current month
+        teacher_id: admin only (default all students)
+        format: json (default), xlsx or pdf
+    """
+    user = request.current_user
+    now = datetime.utcnow()
+    year = request.args.get('year', now.year, type=int)
+    month = request.args.get('month', now.month, type=int)
+    fmt = request.args.get('format', 'json').lower()
+    if fmt not in ('json', 'xlsx', 'pdf'):
+        return jsonify({'error': 'format must be json, xlsx or pdf'}), 400
+
+    if user['role'] == 'teacher':
+        teacher_id = user['user_id']
+    else:
+        teacher_id = request.args.get('teacher_id', type=int)
+
+    matrix, error = AttendanceService.monthly_matrix(year, month, teacher_id)
+    if error:
+        return jsonify({'error': error}), 400
+
+    filename = f"attendance_{year}_{month:02d}"
+    if fmt == 'pdf':
         return send_file(
-            buffer,
+            ExportService.generate_attendance_pdf(matrix),
             as_attachment=True,
-            download_name=f"reports_export.xlsx",
+            download_name=f"{filename}.pdf",
+            mimetype='application/pdf'
+        )
+    if fmt == 'xlsx':
+        output = io.BytesIO()
+        ExportService.write_attendance_excel(output, matrix)
+        output.seek(0)
+        return send_file(
+            output,
+            as_attachment=True,
+            download_name=f"{filename}.xlsx",
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
         )
-    except Exception as e:
-        return jsonify({'error': str(e)}), 400
+    return jsonify(matrix), 200
+
+
+def _date_param_ms(name, days_after=0):
+    """Epoch ms at local midnight of a YYYY-MM-DD query param, or None"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    day = datetime.strptime(value, '%Y-%m-%d') + timedelta(days=days_after)
+    return int(day.timestamp() * 1000)
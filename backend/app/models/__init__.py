@@ -9,9 +9,16 @@ from app.models.report import Report
 from app.models.report_action import ReportAction
 from app.models.routine import Routine
 from app.models.transaction import Transaction
+from app.models.ledger_entry import LedgerEntry
+from app.models.balance_snapshot import BalanceSnapshot
+from app.models.deleted_row import DeletedRow
+from app.models.backup_run import BackupRun
+from app.models.proof_blob import ProofBlob, TransactionProof
 
 __all__ = [
     'BaseModel', 'User', 'Student', 'AuditLog', 
     'Report', 'ReportAction', 'Routine', 'Fee', 
-    'FeeStructure', 'Announcement', 'Transaction'
+    'FeeStructure', 'Announcement', 'Transaction',
+    'LedgerEntry', 'BalanceSnapshot', 'DeletedRow', 'BackupRun',
+    'ProofBlob', 'TransactionProof'
 ]
@@ -13,6 +13,24 @@ class BackupMeta(BaseModel):
     filename = db.Column(db.String(255), nullable=False)
     file_size_bytes = db.Column(db.BigInteger, nullable=False)
     created_by_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    # 'sqlite': encrypted copy of the database file; 'logical': encrypted
+    # table-by-table archive (see LogicalBackupService), works on any backend
+    backup_format = db.Column(db.String(20), nullable=False, default='sqlite')
+    # 'full', or 'incremental': rows changed since parent_id's high-water mark
+    backup_type = db.Column(db.String(20), nullable=False, default='full')
+    parent_id = db.Column(db.Integer, db.ForeignKey('backups.id'), nullable=True)
+    # Epoch ms taken before the snapshot; the next incremental starts here
+    high_water_ms = db.Column(db.BigInteger, nullable=True)
+    # Largest id per append-only table (no updated_at) at snapshot time
+    id_marks = db.Column(db.JSON, nullable=True)
+    # When this backup was last restored over the live database (epoch ms)
+    restored_at = db.Column(db.BigInteger, nullable=True)
+    # 'file': the file holds the whole backup; 'chunks': the file is a
+    # manifest of chunks in the shared, deduplicating chunk store
+    storage = db.Column(db.String(20), nullable=False, default='file')
+    # Referenced uploads in the uploads archive next to the backup file
+    # (see UploadBackupService); None if uploads were not included
+    upload_files = db.Column(db.Integer, nullable=True)
     
     # User who created the backup
     created_by = db.relationship('User', backref='backups')
@@ -22,6 +40,13 @@ class BackupMeta(BaseModel):
         data.update({
             'filename': self.filename,
             'file_size_bytes': self.file_size_bytes,
+            'backup_format': self.backup_format,
+            'backup_type': self.backup_type,
+            'parent_id': self.parent_id,
+            'high_water_ms': self.high_water_ms,
+            'restored_at': self.restored_at,
+            'storage': self.storage,
+            'upload_files': self.upload_files,
             'created_by': self.created_by.display_name if self.created_by else 'System'
         })
         return data
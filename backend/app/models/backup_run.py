@@ -0,0 +1,50 @@
+"""
+Backup Run Model
+"""
+from app import db
+from app.models.base import BaseModel
+
+
+class BackupRun(BaseModel):
+    """
+    One scheduled backup run (see BackupScheduleService), with its timings
+    and what retention pruned, for monitoring
+    """
+    __tablename__ = 'backup_runs'
+
+    # 'success', 'failed', or 'skipped' (e.g. a restore was running)
+    status = db.Column(db.String(20), nullable=False)
+    backup_id = db.Column(db.Integer, db.ForeignKey('backups.id'), nullable=True)
+    backup_type = db.Column(db.String(20), nullable=True)
+    duration_ms = db.Column(db.BigInteger, nullable=True)
+    # Bytes read from the database (or its snapshot) into the backup
+    bytes_processed = db.Column(db.BigInteger, nullable=True)
+    # Size of the encrypted backup file
+    bytes_written = db.Column(db.BigInteger, nullable=True)
+    # Time spent waiting on the I/O rate limit
+    throttled_ms = db.Column(db.BigInteger, nullable=True)
+    pruned_count = db.Column(db.Integer, nullable=False, default=0)
+    pruned_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    message = db.Column(db.Text, nullable=True)
+
+    def to_dict(self):
+        data = super().to_dict()
+        seconds = (self.duration_ms or 0) / 1000
+        data.update({
+            'status': self.status,
+            'backup_id': self.backup_id,
+            'backup_type': self.backup_type,
+            'duration_ms': self.duration_ms,
+            'bytes_processed': self.bytes_processed,
+            'bytes_written': self.bytes_written,
+            'throttled_ms': self.throttled_ms,
+            'mb_per_second': round(self.bytes_processed / 1024 / 1024 / seconds, 2)
+                if self.bytes_processed and seconds else None,
+            'pruned_count': self.pruned_count,
+            'pruned_bytes': self.pruned_bytes,
+            'message': self.message
+        })
+        return data
+
+    def __repr__(self):
+        return f'<BackupRun {self.status} backup={self.backup_id}>'
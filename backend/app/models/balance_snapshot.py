@@ -0,0 +1,30 @@
+"""
+Balance snapshot model for point-in-time ledger queries
+"""
+from app import db
+
+
+class BalanceSnapshot(db.Model):
+    """
+    A student's receivable balance as of a moment, folded from the ledger
+    Point-in-time balance = latest snapshot at or before t + entries after it
+    """
+    __tablename__ = 'balance_snapshots'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+    as_of = db.Column(db.BigInteger, nullable=False)  # Unix epoch ms, inclusive
+    balance = db.Column(db.Numeric(12, 2), nullable=False)
+    
+    # Constraints
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'as_of', name='unique_snapshot_per_student_time'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'student_id': self.student_id,
+            'as_of': self.as_of,
+            'balance': str(self.balance)
+        }
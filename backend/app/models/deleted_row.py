@@ -0,0 +1,47 @@
+"""
+Deletion log model for incremental backups
+"""
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from app import db
+import time
+
+# Tables whose deletions are not replayed by incremental backups
+UNLOGGED_TABLES = {'backups', 'backup_runs', 'deleted_rows'}
+
+
+class DeletedRow(db.Model):
+    """
+    One row removed through the ORM (including cascades)
+    Incremental backups carry the ids deleted since their parent, since
+    timestamps alone cannot show that a row is gone
+    """
+    __tablename__ = 'deleted_rows'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    table_name = db.Column(db.String(100), nullable=False)
+    row_id = db.Column(db.BigInteger, nullable=False)
+    deleted_at = db.Column(db.BigInteger, nullable=False, default=lambda: int(time.time() * 1000))
+
+    __table_args__ = (
+        db.Index('ix_deleted_rows_table_deleted_at', 'table_name', 'deleted_at'),
+    )
+
+    def __repr__(self):
+        return f'<DeletedRow {self.table_name}#{self.row_id}>'
+
+
+@event.listens_for(Session, 'after_flush')
+def log_deletions(session, flush_context):
+    """Record every row the flush deleted, in the same transaction"""
+    now = int(time.time() * 1000)
+    rows = []
+    for obj in session.deleted:
+        table_name = getattr(obj, '__tablename__', None)
+        if table_name is None or table_name in UNLOGGED_TABLES:
+            continue
+        identity = inspect(obj).identity
+        if identity and len(identity) == 1:
+            rows.append({'table_name': table_name, 'row_id': identity[0], 'deleted_at': now})
+    if rows:
+        session.connection().execute(DeletedRow.__table__.insert(), rows)
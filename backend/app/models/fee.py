@@ -23,6 +23,11 @@ class Fee(BaseModel):
     paid_amount = db.Column(db.Numeric(10, 2))      # Actual amount paid
     late_fee = db.Column(db.Numeric(10, 2), default=0)
     
+    # Denormalized totals of PENDING transactions, maintained by FeeService
+    pending_amount = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    pending_count = db.Column(db.Integer, nullable=False, default=0)
+    pending_proofs = db.Column(db.JSON)  # proof_path of each PENDING transaction
+    
     # Proof & Status
     proof_path = db.Column(db.String(255))
     status = db.Column(
@@ -55,11 +60,6 @@ class Fee(BaseModel):
     
     def to_dict(self):
         """Convert fee to dictionary"""
-        # Calculate pending details from transactions
-        pending_txs = [t for t in self.transactions if t.status == 'PENDING']
-        pending_amount = sum(float(t.amount) for t in pending_txs)
-        pending_proofs = [t.proof_path for t in pending_txs if t.proof_path]
-        
         return {
             'id': self.id,
             'student_id': self.student_id,
@@ -73,8 +73,9 @@ class Fee(BaseModel):
             'year': self.year,
             'expected_amount': str(self.expected_amount) if self.expected_amount else None,
             'paid_amount': str(self.paid_amount) if self.paid_amount else None,
-            'pending_amount': str(pending_amount),
-            'pending_proofs': pending_proofs,
+            'pending_amount': str(self.pending_amount or 0),
+            'pending_count': self.pending_count or 0,
+            'pending_proofs': self.pending_proofs or [],
             
             'late_fee': str(self.late_fee) if self.late_fee else '0.00',
             'amount': str(self.paid_amount) if self.paid_amount else None, # Legacy compatibility
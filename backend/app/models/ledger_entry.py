@@ -0,0 +1,78 @@
+"""
+Ledger entry model for the double-entry fee ledger
+"""
+from app import db
+import time
+
+
+class LedgerEntry(db.Model):
+    """
+    Append-only double-entry posting against a student's fee account
+    Every entry debits one account and credits another by the same amount.
+    Corrections are new REVERSAL entries, never updates or deletes.
+    """
+    __tablename__ = 'ledger_entries'
+    
+    # Accounts
+    RECEIVABLE = 'receivable'          # what the student owes
+    CASH = 'cash'                      # money received
+    FEE_INCOME = 'fee_income'
+    LATE_FEE_INCOME = 'late_fee_income'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+    fee_id = db.Column(db.Integer, db.ForeignKey('fees.id'), index=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'), index=True)
+    reverses_id = db.Column(db.Integer, db.ForeignKey('ledger_entries.id'), unique=True)
+    
+    entry_type = db.Column(db.String(20), nullable=False)  # CHARGE, PAYMENT, LATE_FEE, REVERSAL
+    debit_account = db.Column(db.String(30), nullable=False)
+    credit_account = db.Column(db.String(30), nullable=False)
+    amount = db.Column(db.Numeric(12, 2), nullable=False)
+    
+    posted_at = db.Column(db.BigInteger, nullable=False, default=lambda: int(time.time() * 1000))
+    actor_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    memo = db.Column(db.String(255))
+    
+    # A reversal is flushed after, and deleted before, the entry it reverses
+    reverses = db.relationship('LedgerEntry', remote_side=[id])
+    
+    # Constraints
+    __table_args__ = (
+        db.Index('ix_ledger_entries_student_posted', 'student_id', 'posted_at'),
+        db.CheckConstraint(
+            entry_type.in_(['CHARGE', 'PAYMENT', 'LATE_FEE', 'REVERSAL']),
+            name='check_valid_ledger_entry_type'
+        ),
+        db.CheckConstraint('amount > 0', name='check_positive_ledger_amount'),
+    )
+    
+    @property
+    def receivable_delta(self):
+        """Change this entry makes to the student's balance owed"""
+        if self.debit_account == self.RECEIVABLE:
+            return self.amount
+        if self.credit_account == self.RECEIVABLE:
+            return -self.amount
+        return 0
+    
+    def to_dict(self):
+        """Convert ledger entry to dictionary"""
+        return {
+            'id': self.id,
+            'student_id': self.student_id,
+            'fee_id': self.fee_id,
+            'transaction_id': self.transaction_id,
+            'reverses_id': self.reverses_id,
+            'entry_type': self.entry_type,
+            'debit_account': self.debit_account,
+            'credit_account': self.credit_account,
+            'amount': str(self.amount),
+            'receivable_delta': str(self.receivable_delta),
+            'posted_at': self.posted_at,
+            'actor_id': self.actor_id,
+            'memo': self.memo
+        }
+    
+    def __repr__(self):
+        return f'<LedgerEntry {self.entry_type} {self.amount} student {self.student_id}>'
@@ -0,0 +1,77 @@
+"""
+Proof blob models for content-addressed payment proofs
+"""
+from app import db
+from app.models.base import BaseModel
+import time
+
+# URL the files are served under (app/static/uploads/proofs)
+PROOF_URL_PREFIX = '/static/uploads/proofs/'
+
+
+class ProofBlob(BaseModel):
+    """
+    One distinct uploaded proof, stored once under the SHA-256 of its
+    content (see ProofStorageService), with the thumbnail and display copy
+    the worker derives from it (see ProofImageService)
+    """
+    __tablename__ = 'proof_blobs'
+
+    sha256 = db.Column(db.String(64), nullable=False, unique=True)
+    size_bytes = db.Column(db.BigInteger, nullable=False)
+    # Extension of the first upload (e.g. '.png'), so the file is served with its type
+    extension = db.Column(db.String(10), nullable=False, default='')
+    # 'pending' until processed, then 'ready', or 'unsupported' if it is not an image Pillow can read
+    image_status = db.Column(db.String(20), nullable=False, default='pending')
+    # Extension of the derived images ('.webp' or '.jpg')
+    image_extension = db.Column(db.String(10))
+
+    @property
+    def relative_path(self):
+        """Path under the proofs directory, fanned out by the first two hex digits"""
+        return f"{self.sha256[:2]}/{self.sha256}{self.extension}"
+
+    @property
+    def path(self):
+        """URL stored as a transaction's proof_path"""
+        return PROOF_URL_PREFIX + self.relative_path
+
+    def derived_relative_path(self, kind):
+        """Path under the proofs directory of the 'thumb' or 'display' image"""
+        return f"{self.sha256[:2]}/{self.sha256}_{kind}{self.image_extension or ''}"
+
+    @property
+    def thumbnail_path(self):
+        return PROOF_URL_PREFIX + self.derived_relative_path('thumb') if self.image_status == 'ready' else None
+
+    @property
+    def display_path(self):
+        """EXIF-stripped copy bounded in size, for viewing"""
+        return PROOF_URL_PREFIX + self.derived_relative_path('display') if self.image_status == 'ready' else None
+
+    def to_dict(self):
+        data = super().to_dict()
+        data.update({
+            'sha256': self.sha256,
+            'size_bytes': self.size_bytes,
+            'path': self.path,
+            'image_status': self.image_status,
+            'thumbnail_path': self.thumbnail_path,
+            'display_path': self.display_path
+        })
+        return data
+
+
+class TransactionProof(db.Model):
+    """
+    Which blob a transaction's proof is; many transactions can share a blob
+    """
+    __tablename__ = 'transaction_proofs'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'), nullable=False, unique=True)
+    blob_id = db.Column(db.Integer, db.ForeignKey('proof_blobs.id'), nullable=False, index=True)
+    created_at = db.Column(db.BigInteger, nullable=False, default=lambda: int(time.time() * 1000))
+
+    transaction = db.relationship('Transaction', back_populates='proof_link')
+    blob = db.relationship('ProofBlob')
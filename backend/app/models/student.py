@@ -48,3 +48,7 @@ class Student(BaseModel):
     # Relationship to reports and routines
     reports = db.relationship('Report', back_populates='student', cascade='all, delete-orphan')
     routines = db.relationship('Routine', back_populates='student', cascade='all, delete-orphan')
+    
+    # Ledger history goes with the student (through the ORM, so deletions reach incremental backups)
+    ledger_entries = db.relationship('LedgerEntry', cascade='all, delete-orphan')
+    balance_snapshots = db.relationship('BalanceSnapshot', cascade='all, delete-orphan')
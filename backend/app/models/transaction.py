@@ -32,6 +32,9 @@ class Transaction(BaseModel):
     # Relationships
     fee = db.relationship('Fee', back_populates='transactions')
     approved_by = db.relationship('User', foreign_keys=[approved_by_id])
+    # Which stored blob the proof is (see ProofStorageService.link); goes with the transaction
+    proof_link = db.relationship('TransactionProof', back_populates='transaction',
+                                 uselist=False, cascade='all, delete-orphan')
 
     def to_dict(self):
         return {
@@ -0,0 +1,167 @@
+"""
+Receivables aging service
+Buckets outstanding fee balances by days past due, entirely in SQL
+"""
+from datetime import datetime, timedelta, timezone
+from app import db
+from app.models.fee import Fee
+from app.models.student import Student
+from app.models.user import User
+from app.models.ledger_entry import LedgerEntry
+from app.services.ledger_service import _receivable_delta
+from app.services.time_service import TimeService
+from app.services.fee_service import DEFAULT_DUE_DAY
+
+BUCKETS = ['current', 'days_0_30', 'days_31_60', 'days_61_90', 'days_90_plus']
+GROUPINGS = ['student', 'room', 'teacher']
+
+
+def _date_key(d):
+    """Order-preserving integer for a date, e.g. 2024-03-05 -> 20240305"""
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+class AgingService:
+    """
+    Outstanding per fee comes from the ledger (receivable delta grouped by
+    fee up to the end of the as-of day). Bucket edges are bound as date
+    keys, so the SQL needs no dialect-specific date arithmetic.
+    """
+
+    # (as_of date, group_by) -> report, kept while the day and data_version() match
+    _cache = {}
+
+    @staticmethod
+    def data_version():
+        """
+        Stamp of the report's inputs: ledger postings (append-only, so the
+        last id and count), and fee and student rows (due dates, rooms,
+        teachers) by last update and count. Read from the database, so every
+        process sees a change however it was made
+        """
+        stamps = []
+        for column, counted in (
+            (LedgerEntry.id, LedgerEntry.id),
+            (Fee.updated_at, Fee.id),
+            (Student.updated_at, Student.id),
+        ):
+            stamps.append(db.select(db.func.max(column)).scalar_subquery())
+            stamps.append(db.select(db.func.count(counted)).scalar_subquery())
+        return tuple(db.session.query(*stamps).one())
+
+    @staticmethod
+    def _due_key():
+        return db.case(
+            (
+                Fee.due_date.isnot(None),
+                db.extract('year', Fee.due_date) * 10000
+                + db.extract('month', Fee.due_date) * 100
+                + db.extract('day', Fee.due_date)
+            ),
+            else_=Fee.year * 10000 + Fee.month * 100 + DEFAULT_DUE_DAY
+        )
+
+    @staticmethod
+    def _bucket_columns(outstanding, as_of):
+        """One SUM(CASE ...) per bucket; the day ranges do not overlap"""
+        due = AgingService._due_key()
+        today, d30, d60, d90 = (
+            _date_key(as_of - timedelta(days=days)) for days in (0, 30, 60, 90)
+        )
+        ranges = {
+            'current': due > today,
+            'days_0_30': db.and_(due <= today, due >= d30),
+            'days_31_60': db.and_(due < d30, due >= d60),
+            'days_61_90': db.and_(due < d60, due >= d90),
+            'days_90_plus': due < d90,
+        }
+        return [
+            db.func.sum(db.case((ranges[name], outstanding), else_=0)).label(name)
+            for name in BUCKETS
+        ]
+
+    @staticmethod
+    def _group_columns(group_by):
+        """(column, label) pairs to group by, and the teacher alias if joined"""
+        if group_by == 'student':
+            return [(Student.id, 'key'), (User.display_name, 'label'),
+                    (Student.admission_no, 'admission_no'), (Student.room, 'room')], None
+        if group_by == 'room':
+            return [(Student.room, 'key')], None
+        teacher = db.aliased(User)
+        return [(Student.assigned_teacher_id, 'key'), (teacher.display_name, 'label')], teacher
+
+    @staticmethod
+    def build_report(as_of, group_by):
+        """Run the aging aggregate for one grouping"""
+        day_start_ms = int(datetime(as_of.year, as_of.month, as_of.day, tzinfo=timezone.utc).timestamp() * 1000)
+        end_of_day_ms = day_start_ms + 24 * 60 * 60 * 1000 - 1
+
+        owed = db.session.query(
+            LedgerEntry.fee_id.label('fee_id'),
+            db.func.sum(_receivable_delta()).label('outstanding')
+        ).filter(
+            LedgerEntry.fee_id.isnot(None),
+            LedgerEntry.posted_at <= end_of_day_ms
+        ).group_by(LedgerEntry.fee_id).subquery()
+
+        group_columns, teacher = AgingService._group_columns(group_by)
+
+        query = db.session.query(
+            *[column.label(label) for column, label in group_columns],
+            *AgingService._bucket_columns(owed.c.outstanding, as_of),
+            db.func.sum(owed.c.outstanding).label('total'),
+            db.func.count(Fee.id).label('fee_count')
+        ).select_from(owed).join(
+            Fee, Fee.id == owed.c.fee_id
+        ).join(
+            Student, Student.id == Fee.student_id
+        ).filter(owed.c.outstanding > 0)
+
+        if group_by == 'student':
+            query = query.join(User, User.id == Student.user_id)
+        elif teacher is not None:
+            query = query.outerjoin(teacher, teacher.id == Student.assigned_teacher_id)
+
+        query = query.group_by(*[column for column, _ in group_columns])
+
+        rows = []
+        totals = {bucket: 0.0 for bucket in BUCKETS + ['total']}
+        for row in query.order_by(db.desc('total')):
+            data = row._asdict()
+            for bucket in BUCKETS + ['total']:
+                data[bucket] = float(data[bucket] or 0)
+                totals[bucket] += data[bucket]
+            rows.append(data)
+
+        return {
+            'as_of': as_of.isoformat(),
+            'group_by': group_by,
+            'buckets': BUCKETS,
+            'rows': rows,
+            'totals': totals,
+            'generated_at': TimeService.now_ms()
+        }
+
+    @staticmethod
+    def get_report(as_of=None, group_by='student', refresh=False):
+        """
+        Aging report for a day, cached until the data changes or the day ends
+        Returns (report, error)
+        """
+        if group_by not in GROUPINGS:
+            return None, f"group_by must be one of: {', '.join(GROUPINGS)}"
+
+        today = datetime.now(timezone.utc).date()
+        as_of = as_of or today
+        key = (as_of, group_by)
+        version = (today, AgingService.data_version())
+
+        cache = AgingService._cache
+        stale = [k for k, v in cache.items() if v['version'] != version]
+        for k in stale:
+            del cache[k]
+
+        if refresh or key not in cache:
+            cache[key] = {'version': version, 'report': AgingService.build_report(as_of, group_by)}
+        return cache[key]['report'], None
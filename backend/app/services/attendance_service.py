@@ -0,0 +1,102 @@
+"""
+Attendance service
+Monthly student x day matrix of filed wake reports, computed in SQL
+"""
+import calendar
+from datetime import datetime, timezone
+from app import db
+from app.models.report import Report
+from app.models.student import Student
+from app.models.user import User
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+class AttendanceService:
+    """
+    A student is present on a day if they filed a wake report that (UTC) day.
+    Presence is returned as a bitmap per student: bit d-1 set = present on day d.
+    """
+
+    @staticmethod
+    def _month_range_ms(year, month):
+        """[start, end) of a UTC month in epoch ms, and its number of days"""
+        days = calendar.monthrange(year, month)[1]
+        start = int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+        return start, start + days * DAY_MS, days
+
+    @staticmethod
+    def monthly_matrix(year, month, teacher_id=None):
+        """
+        Attendance matrix for one month, limited to a teacher's assigned
+        students when teacher_id is given. One grouped query: a row per
+        (student, day with reports), plus one per student with none.
+        Returns (matrix, error)
+        """
+        if not 1 <= month <= 12:
+            return None, "month must be between 1 and 12"
+
+        start_ms, end_ms, days = AttendanceService._month_range_ms(year, month)
+        day = ((Report.wake_time - start_ms) // DAY_MS + 1).label('day')
+
+        query = db.session.query(
+            Student.id, User.display_name, Student.admission_no, Student.room,
+            day,
+            db.func.count(Report.id),
+            db.func.coalesce(db.func.sum(Report.late_minutes), 0)
+        ).join(
+            User, User.id == Student.user_id
+        ).outerjoin(
+            Report,
+            db.and_(
+                Report.student_id == Student.id,
+                Report.wake_time >= start_ms,
+                Report.wake_time < end_ms
+            )
+        )
+        if teacher_id is not None:
+            query = query.filter(Student.assigned_teacher_id == teacher_id)
+        query = query.group_by(
+            Student.id, User.display_name, Student.admission_no, Student.room, day
+        ).order_by(Student.room, User.display_name, Student.id)
+
+        students = {}
+        daily_totals = [0] * days
+        for student_id, name, admission_no, room, day_no, reports, late in query:
+            row = students.get(student_id)
+            if row is None:
+                row = students[student_id] = {
+                    'student_id': student_id,
+                    'name': name,
+                    'admission_no': admission_no,
+                    'room': room,
+                    'bitmap': 0,
+                    'days_present': 0,
+                    'reports': 0,
+                    'late_minutes': 0
+                }
+            if day_no is None:
+                continue
+            day_no = int(day_no)
+            row['bitmap'] |= 1 << (day_no - 1)
+            row['days_present'] += 1
+            row['reports'] += reports
+            row['late_minutes'] += int(late)
+            daily_totals[day_no - 1] += 1
+
+        for row in students.values():
+            row['present_days'] = AttendanceService.present_days(row['bitmap'], days)
+
+        return {
+            'year': year,
+            'month': month,
+            'days': days,
+            'teacher_id': teacher_id,
+            'students': list(students.values()),
+            'daily_totals': daily_totals
+        }, None
+
+    @staticmethod
+    def present_days(bitmap, days):
+        """Day numbers set in a presence bitmap"""
+        return [d for d in range(1, days + 1) if bitmap >> (d - 1) & 1]
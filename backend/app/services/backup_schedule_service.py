@@ -0,0 +1,292 @@
+"""
+Backup schedule service
+Scheduled backups (run hourly by scripts/run_scheduled_backup.py) and
+grandfather-father-son retention of the backups directory
+"""
+import os
+import time
+from datetime import datetime, timezone
+from app import db
+from app.models.backup_meta import BackupMeta
+from app.models.backup_run import BackupRun
+from app.services.backup_service import BackupService
+from app.services.job_service import JobService
+from app.services.maintenance_service import MaintenanceService
+from app.services.restore_service import RESTORE_LOCK_KEY
+from app.services.time_service import TimeService
+from app.utils.chunk_store import collect_garbage, read_refs, refs_path
+from app.utils.encryption import BackupEncryption
+from app.utils.throttle import RateLimiter
+
+HOUR_MS = 60 * 60 * 1000
+# Backups kept per tier: the newest backup of each of the last N hours that
+# have one, and the newest full backup of each of the last N days, weeks
+# and months that have one
+RETENTION = {
+    'hourly': int(os.getenv('BACKUP_KEEP_HOURLY', 24)),
+    'daily': int(os.getenv('BACKUP_KEEP_DAILY', 7)),
+    'weekly': int(os.getenv('BACKUP_KEEP_WEEKLY', 4)),
+    'monthly': int(os.getenv('BACKUP_KEEP_MONTHLY', 12)),
+}
+# 'chunks': every run is a full backup into the deduplicating chunk store,
+# costing about what an incremental would; 'file': self-contained files,
+# a full backup every FULL_BACKUP_INTERVAL_MS with incrementals in between
+STORAGE = os.getenv('BACKUP_SCHEDULE_STORAGE', 'chunks')
+# Also back up the uploaded files (payment proofs) the database references
+INCLUDE_UPLOADS = os.getenv('BACKUP_INCLUDE_UPLOADS', 'false').lower() == 'true'
+FULL_BACKUP_INTERVAL_MS = int(os.getenv('BACKUP_FULL_INTERVAL_HOURS', 24)) * HOUR_MS
+# Read rate allowed to a scheduled backup, so it does not slow requests (0 = unlimited)
+IO_LIMIT_BYTES_PER_SECOND = int(float(os.getenv('BACKUP_IO_LIMIT_MB_S', 20)) * 1024 * 1024)
+# Files in the backups directory without a row, and chunks no backup
+# references, are removed once this old (younger ones may belong to a
+# backup still being written)
+ORPHAN_GRACE_MS = 6 * HOUR_MS
+RUN_HISTORY_MS = 90 * 24 * HOUR_MS
+
+
+def _bucket(tier, created_at):
+    moment = datetime.fromtimestamp(created_at / 1000, tz=timezone.utc)
+    if tier == 'hourly':
+        return (moment.date(), moment.hour)
+    if tier == 'daily':
+        return moment.date()
+    if tier == 'weekly':
+        return tuple(moment.isocalendar())[:2]
+    return (moment.year, moment.month)
+
+
+class BackupScheduleService:
+    """
+    Scheduled runs back up with the BACKUP_ENCRYPTION_KEY key, so the admin
+    holding it can restore any of them, then prune what retention no longer
+    keeps. Every run is recorded as a BackupRun with its timings.
+    """
+
+    @staticmethod
+    def run(prune=True):
+        """
+        One scheduled run: back up (unless a restore is running), then prune
+        Returns the recorded BackupRun
+        """
+        lock_path = BackupScheduleService._lock()
+        if lock_path is None:
+            return BackupScheduleService._record(status='skipped', message="Another scheduled run is in progress")
+        try:
+            if BackupScheduleService._restore_running():
+                return BackupScheduleService._record(status='skipped', message="A restore is in progress")
+
+            key_str = os.getenv('BACKUP_ENCRYPTION_KEY')
+            try:
+                if len(BackupEncryption.key_from_string(key_str or '')) != 32:
+                    raise ValueError
+            except ValueError:
+                return BackupScheduleService._record(
+                    status='failed', message="BACKUP_ENCRYPTION_KEY must be set to a base64 256-bit key"
+                )
+
+            limiter = RateLimiter(IO_LIMIT_BYTES_PER_SECOND)
+            backup_type = BackupScheduleService._next_type()
+            started = time.monotonic()
+            try:
+                try:
+                    backup, _ = BackupService.create_backup(
+                        None, key_str, backup_type=backup_type, limiter=limiter, storage=STORAGE,
+                        include_uploads=INCLUDE_UPLOADS
+                    )
+                except ValueError:
+                    if backup_type != 'incremental':
+                        raise
+                    # e.g. the latest chain was started with another key
+                    db.session.rollback()
+                    backup_type = 'full'
+                    backup, _ = BackupService.create_backup(
+                        None, key_str, limiter=limiter, storage=STORAGE, include_uploads=INCLUDE_UPLOADS
+                    )
+            except Exception as e:
+                db.session.rollback()
+                # Nothing is pruned after a failed run, so old backups outlive an outage
+                return BackupScheduleService._record(
+                    status='failed',
+                    backup_type=backup_type,
+                    duration_ms=int((time.monotonic() - started) * 1000),
+                    message=str(e)
+                )
+
+            run = BackupRun(
+                status='success',
+                backup_id=backup.id,
+                backup_type=backup_type,
+                duration_ms=int((time.monotonic() - started) * 1000),
+                bytes_processed=limiter.total,
+                bytes_written=backup.file_size_bytes,
+                throttled_ms=int(limiter.slept * 1000)
+            )
+            if prune:
+                removed, freed = BackupScheduleService.prune()
+                run.pruned_count = len(removed)
+                run.pruned_bytes = freed
+            db.session.add(run)
+            db.session.commit()
+            return run
+        finally:
+            os.remove(lock_path)
+
+    @staticmethod
+    def _lock():
+        """
+        Create the run's lock file; returns its path, or None if another run
+        holds it (a lock older than ORPHAN_GRACE_MS is from a crashed run)
+        """
+        path = os.path.join(BackupService._get_backup_dir(), '.schedule.lock')
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) < ORPHAN_GRACE_MS / 1000:
+                        return None
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            return path
+        return None
+
+    @staticmethod
+    def _restore_running():
+        try:
+            return bool(JobService._connection().exists(RESTORE_LOCK_KEY) or MaintenanceService.status())
+        except Exception:
+            # Restores run on the worker, so without Redis none can be running
+            return False
+
+    @staticmethod
+    def _record(**fields):
+        run = BackupRun(**fields)
+        db.session.add(run)
+        db.session.commit()
+        return run
+
+    @staticmethod
+    def _next_type():
+        """Incremental if the latest chain can be extended and its full backup is recent enough"""
+        if STORAGE == 'chunks':
+            return 'full'
+        latest = BackupMeta.query.order_by(BackupMeta.id.desc()).first()
+        if not latest:
+            return 'full'
+        status, _ = BackupService.chain_status(latest.id)
+        if not status['extendable']:
+            return 'full'
+        if TimeService.now_ms() - status['backups'][0]['created_at'] >= FULL_BACKUP_INTERVAL_MS:
+            return 'full'
+        return 'incremental'
+
+    @staticmethod
+    def retained(backups):
+        """
+        Ids of the backups retention keeps: per tier, the newest backup of
+        each of its last N buckets, plus every backup those need to restore
+        """
+        by_id = {b.id: b for b in backups}
+        newest_first = sorted(backups, key=lambda b: (b.created_at, b.id), reverse=True)
+        keep = set()
+        for tier, count in RETENTION.items():
+            # Only full backups stand alone; keeping an incremental keeps its chain
+            candidates = newest_first if tier == 'hourly' else [b for b in newest_first if b.backup_type == 'full']
+            buckets = set()
+            for backup in candidates:
+                bucket = _bucket(tier, backup.created_at)
+                if bucket in buckets:
+                    continue
+                if len(buckets) >= count:
+                    break
+                buckets.add(bucket)
+                keep.add(backup.id)
+
+        # Its restored_at is what stops incrementals extending chains older than the restore
+        restored = [b for b in backups if b.restored_at]
+        if restored:
+            keep.add(max(restored, key=lambda b: b.restored_at).id)
+
+        for backup_id in list(keep):
+            parent_id = by_id[backup_id].parent_id
+            while parent_id in by_id and parent_id not in keep:
+                keep.add(parent_id)
+                parent_id = by_id[parent_id].parent_id
+        return keep
+
+    @staticmethod
+    def prune(dry_run=False):
+        """
+        Delete the backups retention no longer keeps, files and rows in one
+        pass, along with stray backup files, chunks no backup references
+        and old run history
+        Returns (ids of the backups removed, bytes freed)
+        """
+        backups = BackupMeta.query.all()
+        keep = BackupScheduleService.retained(backups)
+        expired = [b for b in backups if b.id not in keep]
+        ids = [b.id for b in expired]
+        if dry_run:
+            return ids, sum(b.file_size_bytes for b in expired)
+
+        kept_files = set().union(*(BackupScheduleService._files(b) for b in backups if b.id in keep))
+        expired_files = set().union(*(BackupScheduleService._files(b) for b in expired))
+        chunked = [
+            filename for b in backups if b.id in keep and b.storage == 'chunks' for filename in BackupService.files_of(b)
+        ]
+        if expired:
+            BackupRun.query.filter(BackupRun.backup_id.in_(ids)).update(
+                {'backup_id': None}, synchronize_session=False
+            )
+            BackupMeta.query.filter(BackupMeta.id.in_(ids)).delete(synchronize_session=False)
+        BackupRun.query.filter(
+            BackupRun.created_at < TimeService.now_ms() - RUN_HISTORY_MS
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+        # Files go after their rows, so a failed commit never leaves a row without its file
+        cutoff = time.time() - ORPHAN_GRACE_MS / 1000
+        freed = 0
+        with os.scandir(BackupService._get_backup_dir()) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.startswith('backup_') or entry.name in kept_files:
+                    continue
+                stat = entry.stat()
+                if entry.name in expired_files or stat.st_mtime < cutoff:
+                    os.remove(entry.path)
+                    freed += stat.st_size
+        freed += BackupScheduleService._collect_chunks(chunked, cutoff)
+        return ids, freed
+
+    @staticmethod
+    def _files(backup):
+        files = set(BackupService.files_of(backup))
+        if backup.storage == 'chunks':
+            files |= {os.path.basename(refs_path(filename)) for filename in files}
+        return files
+
+    @staticmethod
+    def _collect_chunks(filenames, cutoff):
+        """
+        Remove the chunks none of the chunked backups in filenames uses
+        Skipped if any of their .refs files is unreadable, since the chunks
+        it lists would look unused
+        Returns bytes freed
+        """
+        backup_dir = BackupService._get_backup_dir()
+        referenced = set()
+        for filename in filenames:
+            try:
+                referenced |= read_refs(os.path.join(backup_dir, filename))
+            except OSError:
+                return 0
+        _, freed = collect_garbage(BackupService._get_chunk_dir(), referenced, cutoff)
+        return freed
+
+    @staticmethod
+    def recent_runs(limit=50):
+        return BackupRun.query.order_by(BackupRun.id.desc()).limit(limit).all()
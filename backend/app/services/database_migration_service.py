@@ -0,0 +1,345 @@
+"""
+Database migration service
+Moves a SQLite database into PostgreSQL (scripts/migrate_sqlite_to_postgres.py):
+every model table is streamed through COPY with its ids kept, sequences
+are reset past them, and each table is verified by row count and checksum
+before the single transaction commits.
+
+Values are written in the text Postgres itself gives back from COPY TO
+(see _sql_text and _converter), so a table is verified by reading it back
+with COPY TO and comparing the SHA-256 of the bytes with that of the bytes
+sent. SQLite builds that text itself for most columns, so rows reach
+Python ready to send.
+"""
+import hashlib
+import sqlite3
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from app import db
+# Imported so every model table is registered on db.metadata
+from app import models  # noqa: F401
+from app.models.notification import Notification  # noqa: F401
+from app.services.logical_backup_service import LogicalBackupService, _kind
+from app.utils.encryption import IterReader
+
+# Rows fetched from SQLite and encoded per COPY chunk
+COPY_BATCH_ROWS = 10000
+# COPY text escapes by character code; Postgres writes \b, \f and \v escaped too, so they are here
+_ESCAPES = [(92, '\\\\'), (9, '\\t'), (10, '\\n'), (13, '\\r'), (8, '\\b'), (12, '\\f'), (11, '\\v')]
+
+
+class MigrationError(Exception):
+    """The source cannot be migrated as it is, or the copy did not verify"""
+
+
+def _float_text(value):
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return 'Infinity' if value > 0 else '-Infinity'
+    text = repr(value)
+    return text[:-2] if text.endswith('.0') else text
+
+
+def _datetime_text(value):
+    moment = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    suffix = ''
+    if moment.tzinfo is not None:
+        # Read back in the session's UTC
+        moment, suffix = moment.astimezone(timezone.utc).replace(tzinfo=None), '+00'
+    text = moment.isoformat(sep=' ')
+    return (text.rstrip('0') if moment.microsecond else text) + suffix
+
+
+def _sql_text(column):
+    """
+    SQLite expression giving a column's COPY text, as Postgres writes it
+    back, or None for the kinds formatted in Python (see _converter)
+    """
+    name = f'"{column.name}"'
+    kind = _kind(column)
+    if kind == 'bool':
+        return f"CASE WHEN {name} IS NULL THEN '\\N' WHEN {name} THEN 't' ELSE 'f' END"
+    if kind == 'int':
+        expression = f"CAST({name} AS TEXT)"
+    elif kind == 'bytes':
+        expression = f"'\\\\x' || lower(hex({name}))"
+    elif kind in ('text', 'json'):
+        # JSON as the text SQLite holds: Postgres json keeps it verbatim
+        escaped_text = f"CAST({name} AS TEXT)"
+        for code, escaped in _ESCAPES:
+            escaped_text = f"replace({escaped_text}, char({code}), '{escaped}')"
+        # One GLOB scan finds the few values needing escapes, instead of seven replace() passes over each
+        specials = f"'*[' || char({', '.join(str(code) for code, _ in _ESCAPES)}) || ']*'"
+        expression = f"CASE WHEN {name} GLOB {specials} THEN {escaped_text} ELSE CAST({name} AS TEXT) END"
+    else:
+        return None
+    return f"COALESCE({expression}, '\\N')"
+
+
+def _converter(column):
+    """Function from a raw SQLite value (not None) to its COPY text, for kinds _sql_text leaves to Python"""
+    kind = _kind(column)
+    if kind == 'float':
+        return _float_text
+    if kind == 'decimal':
+        scale = column.type.scale
+        if scale is None:
+            return lambda v: format(Decimal(str(v)), 'f')
+        # Rounded as SQLAlchemy reads a SQLite Numeric, so the app's values carry over unchanged
+        return lambda v: '%.*f' % (scale, float(v))
+    if kind == 'date':
+        return lambda v: (v if isinstance(v, date) else date.fromisoformat(v)).isoformat()
+    return _datetime_text
+
+
+def _layout(table):
+    """
+    (columns in COPY order, SQLite select list, Python converters): the
+    columns SQLite formats come first, joined into one value, then the
+    ones Python formats
+    """
+    in_sql = [c for c in table.columns if _sql_text(c)]
+    in_python = [c for c in table.columns if not _sql_text(c)]
+    select = [" || char(9) || ".join(_sql_text(c) for c in in_sql)] if in_sql else []
+    select += [f'"{c.name}"' for c in in_python]
+    return in_sql + in_python, select, [_converter(c) for c in in_python]
+
+
+class _Digest:
+    """File-like sink for COPY TO: hashes what it is given and counts rows"""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.rows = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data = bytes(data)
+        self.sha256.update(data)
+        self.rows += data.count(b'\n')
+
+    def update(self, data, rows):
+        self.sha256.update(data)
+        self.rows += rows
+
+
+class DatabaseMigrationService:
+    """
+    The target is the database behind the engine given (the app's own,
+    DATABASE_URL); its tables are created if missing and must be empty
+    unless replacing. During the copy, foreign keys and plain indexes are
+    dropped and afterwards recreated in bulk, which is faster than
+    maintaining them row by row; all of it, like the copy, in one
+    transaction, so a failed migration leaves the target as it was.
+    """
+
+    @staticmethod
+    def tables():
+        """Every model table, parents before children"""
+        return list(db.metadata.sorted_tables)
+
+    @staticmethod
+    def _connect_source(sqlite_path):
+        return sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True, isolation_level=None)
+
+    @staticmethod
+    def check_source(sqlite_path):
+        """
+        What would be migrated, and why it cannot be
+        Returns {'tables': {table: rows}, 'missing_tables': [...],
+        'extra_tables': [...], 'problems': [...]}
+        """
+        source = DatabaseMigrationService._connect_source(sqlite_path)
+        try:
+            present = {name for (name,) in source.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            )}
+            tables, missing, problems = {}, [], []
+            for table in DatabaseMigrationService.tables():
+                if table.name not in present:
+                    missing.append(table.name)
+                    continue
+                columns = {row[1] for row in source.execute(f'PRAGMA table_info("{table.name}")')}
+                absent = [c.name for c in table.columns if c.name not in columns]
+                if absent:
+                    problems.append(f"{table.name} has no column(s) {', '.join(absent)}: "
+                                    f"run the add_*_columns scripts on it first")
+                tables[table.name] = source.execute(f'SELECT COUNT(*) FROM "{table.name}"').fetchone()[0]
+
+            # SQLite only enforces foreign keys when asked to; Postgres always does
+            orphans = {}
+            for child, _, parent, _ in source.execute('PRAGMA foreign_key_check'):
+                if child in tables:
+                    orphans[(child, parent)] = orphans.get((child, parent), 0) + 1
+            for (child, parent), count in sorted(orphans.items()):
+                problems.append(f"{child}: {count} row(s) reference missing {parent} rows")
+        finally:
+            source.close()
+        return {
+            'tables': tables,
+            'missing_tables': missing,
+            'extra_tables': sorted(present - {t.name for t in DatabaseMigrationService.tables()}),
+            'problems': problems
+        }
+
+    @staticmethod
+    def migrate(sqlite_path, engine, replace=False, progress=None):
+        """
+        Copy every model table of the SQLite database at sqlite_path into
+        the PostgreSQL database behind engine
+        replace empties target tables that already hold rows (otherwise an
+        error); progress(fraction) is called per batch
+        Returns {table: {'rows': n, 'sha256': hex}} as verified on the target
+        """
+        if engine.dialect.name != 'postgresql':
+            raise MigrationError(f"The target must be PostgreSQL, not {engine.dialect.name}")
+        check = DatabaseMigrationService.check_source(sqlite_path)
+        if check['problems']:
+            raise MigrationError("The source database cannot be migrated:\n" + '\n'.join(check['problems']))
+
+        tables = DatabaseMigrationService.tables()
+        total = sum(check['tables'].values()) or 1
+        db.metadata.create_all(engine)
+
+        results = {}
+        source = DatabaseMigrationService._connect_source(sqlite_path)
+        try:
+            # One read transaction: every table from the same snapshot
+            source.execute('BEGIN')
+            with engine.begin() as conn:
+                # Output settings COPY TO's text depends on
+                conn.exec_driver_sql("SET LOCAL DateStyle = 'ISO, YMD'")
+                conn.exec_driver_sql("SET LOCAL TimeZone = 'UTC'")
+                conn.exec_driver_sql("SET LOCAL extra_float_digits = 1")
+                conn.exec_driver_sql("SET LOCAL bytea_output = 'hex'")
+
+                if not replace:
+                    occupied = [t.name for t in tables
+                                if conn.execute(db.select(db.literal(1)).select_from(t).limit(1)).first()]
+                    if occupied:
+                        raise MigrationError(f"Target tables already hold rows: {', '.join(occupied)}")
+
+                foreign_keys = DatabaseMigrationService._drop_foreign_keys(conn, tables)
+                # Truncated in this transaction, so COPY can write the rows already frozen
+                conn.exec_driver_sql(
+                    'TRUNCATE ' + ', '.join(f'"{t.name}"' for t in tables) + ' RESTART IDENTITY'
+                )
+                done = 0
+                for table in tables:
+                    indexes = DatabaseMigrationService._drop_indexes(conn, table)
+                    # A table the source predates is left empty, and checked as such
+                    sent = _Digest()
+                    if table.name in check['tables']:
+                        sent = DatabaseMigrationService._copy_table(source, conn, table, total, done, progress)
+                    for definition in indexes:
+                        conn.exec_driver_sql(definition)
+                    received = DatabaseMigrationService._read_back(conn, table)
+                    if (sent.rows, sent.sha256.digest()) != (received.rows, received.sha256.digest()):
+                        raise MigrationError(
+                            f"{table.name} did not verify: {sent.rows} row(s) sent, {received.rows} read back"
+                            + ('' if sent.rows != received.rows else ', checksums differ')
+                        )
+                    results[table.name] = {'rows': sent.rows, 'sha256': sent.sha256.hexdigest()}
+                    done += sent.rows
+
+                for table_name, name, definition in foreign_keys:
+                    conn.exec_driver_sql(f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{name}" {definition}')
+                LogicalBackupService._reset_sequences(conn, tables)
+        finally:
+            source.close()
+        return results
+
+    @staticmethod
+    def _drop_foreign_keys(conn, tables):
+        """Drop the foreign keys of tables; returns [(table, name, definition)] to add them back"""
+        dropped = []
+        for table in tables:
+            for name, definition in conn.exec_driver_sql(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE contype = 'f' AND conrelid = %(table)s::regclass",
+                {'table': f'"{table.name}"'}
+            ).all():
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" DROP CONSTRAINT "{name}"')
+                dropped.append((table.name, name, definition))
+        return dropped
+
+    @staticmethod
+    def _drop_indexes(conn, table):
+        """Drop the indexes of table no constraint owns; returns their definitions"""
+        indexes = conn.exec_driver_sql(
+            "SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+            "WHERE x.indrelid = %(table)s::regclass "
+            "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)",
+            {'table': f'"{table.name}"'}
+        ).all()
+        for name, _ in indexes:
+            conn.exec_driver_sql(f'DROP INDEX "{name}"')
+        return [definition for _, definition in indexes]
+
+    @staticmethod
+    def _copy_table(source, conn, table, total, done, progress):
+        """Stream a table from SQLite into COPY; returns a _Digest of the bytes sent"""
+        columns, select, converters = _layout(table)
+        order = ', '.join(f'"{c.name}"' for c in table.primary_key.columns)
+        cursor = source.execute(f'SELECT {", ".join(select)} FROM "{table.name}" ORDER BY {order}')
+        sent = _Digest()
+
+        def chunks():
+            while True:
+                batch = cursor.fetchmany(COPY_BATCH_ROWS)
+                if not batch:
+                    return
+                if not converters:
+                    lines = [row[0] for row in batch]
+                else:
+                    skip = len(select) - len(converters)
+                    lines = [
+                        '\t'.join(row[:skip] + tuple('\\N' if v is None else f(v)
+                                                     for f, v in zip(converters, row[skip:])))
+                        for row in batch
+                    ]
+                lines.append('')
+                data = '\n'.join(lines).encode('utf-8')
+                sent.update(data, len(batch))
+                if progress:
+                    progress((done + sent.rows) / total)
+                yield data
+
+        names = ', '.join(f'"{c.name}"' for c in columns)
+        sql = f'COPY "{table.name}" ({names}) FROM STDIN WITH (FREEZE)'
+        cursor_pg = conn.connection.driver_connection.cursor()
+        try:
+            if hasattr(cursor_pg, 'copy_expert'):
+                # psycopg2
+                cursor_pg.copy_expert(sql, IterReader(chunks()))
+            else:
+                # psycopg 3
+                with cursor_pg.copy(sql) as copy:
+                    for data in chunks():
+                        copy.write(data)
+        finally:
+            cursor_pg.close()
+            cursor.close()
+        return sent
+
+    @staticmethod
+    def _read_back(conn, table):
+        """_Digest of the table as Postgres writes it out, in the order it was sent"""
+        names = ', '.join(f'"{c.name}"' for c in _layout(table)[0])
+        order = ', '.join(f'"{c.name}"' for c in table.primary_key.columns)
+        sql = f'COPY (SELECT {names} FROM "{table.name}" ORDER BY {order}) TO STDOUT'
+        received = _Digest()
+        cursor = conn.connection.driver_connection.cursor()
+        try:
+            if hasattr(cursor, 'copy_expert'):
+                cursor.copy_expert(sql, received)
+            else:
+                with cursor.copy(sql) as copy:
+                    for data in copy:
+                        received.write(data)
+        finally:
+            cursor.close()
+        return received
@@ -0,0 +1,165 @@
+"""
+Rendered document cache
+Keeps rendered PDFs on disk, addressed by what they were rendered from
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from flask import current_app
+from app.utils.files import replace_readable
+
+# Bump a document type's version whenever its template changes, so stale
+# renders stop matching and age out of the cache
+TEMPLATE_VERSIONS = {
+    'challan': 2,
+    'statement': 1,
+}
+# Total size the cache may grow to before least recently used files are evicted
+MAX_CACHE_BYTES = int(os.getenv('DOCUMENT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Eviction frees space down to this fraction of the limit, so it runs rarely
+EVICT_TO_RATIO = 0.9
+# Hits only refresh a file's mtime (its LRU position) this often
+TOUCH_INTERVAL_SECONDS = 60 * 60
+
+
+class DocumentCacheService:
+    """
+    A document's key is a hash of its type, entity id, version (the
+    updated_at of the rows it was rendered from) and template version.
+    Any change to those rows yields a new key, so entries never need
+    invalidating; unused ones are evicted oldest-mtime first. The key
+    doubles as the ETag.
+    """
+
+    # Bytes on disk as last counted by this process; None until first scan
+    _size = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _cache_dir():
+        """Get document cache directory, create if not exists"""
+        path = os.getenv('DOCUMENT_CACHE_DIR') or os.path.join(current_app.root_path, '..', 'cache', 'documents')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def key(doc_type, entity_id, version):
+        raw = f"{doc_type}:{entity_id}:{version}:v{TEMPLATE_VERSIONS[doc_type]}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def path_for(key):
+        return os.path.join(DocumentCacheService._cache_dir(), key[:2], f"{key}.pdf")
+
+    @staticmethod
+    def lookup(key):
+        """Path of a cached document, or None; costs one stat on a hit"""
+        path = DocumentCacheService.path_for(key)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if time.time() - st.st_mtime > TOUCH_INTERVAL_SECONDS:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+        return path
+
+    @staticmethod
+    def store(key, content):
+        """Write a rendered document atomically; returns its path"""
+        path = DocumentCacheService.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            replace_readable(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with DocumentCacheService._lock:
+            if DocumentCacheService._size is None:
+                DocumentCacheService._size = DocumentCacheService._scan_size()
+            else:
+                DocumentCacheService._size += len(content)
+            over_limit = DocumentCacheService._size > MAX_CACHE_BYTES
+        if over_limit:
+            DocumentCacheService.evict()
+        return path
+
+    @staticmethod
+    def get_or_render(doc_type, entity_id, version, render):
+        """
+        Cached document for (type, entity, version), rendering it on a miss
+        render() must return the document bytes
+        Returns (path, etag)
+        """
+        key = DocumentCacheService.key(doc_type, entity_id, version)
+        path = DocumentCacheService.lookup(key)
+        if path is None:
+            path = DocumentCacheService.store(key, render())
+        return path, key
+
+    @staticmethod
+    def _entries():
+        cache_dir = DocumentCacheService._cache_dir()
+        for shard in os.scandir(cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file() and entry.name.endswith('.pdf'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, st.st_size, st.st_mtime
+
+    @staticmethod
+    def _scan_size():
+        return sum(size for _, size, _ in DocumentCacheService._entries())
+
+    @staticmethod
+    def clear():
+        """
+        Delete every cached document, e.g. after a restore
+        Returns files removed
+        """
+        with DocumentCacheService._lock:
+            removed = 0
+            for path, _, _ in list(DocumentCacheService._entries()):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+            DocumentCacheService._size = 0
+        return removed
+
+    @staticmethod
+    def evict(max_bytes=MAX_CACHE_BYTES):
+        """
+        Delete least recently used documents until the cache is under
+        EVICT_TO_RATIO of max_bytes. Returns files removed.
+        """
+        with DocumentCacheService._lock:
+            entries = sorted(DocumentCacheService._entries(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in entries)
+            target = max_bytes * EVICT_TO_RATIO
+            removed = 0
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            DocumentCacheService._size = total
+        return removed
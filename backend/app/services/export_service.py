@@ -3,129 +3,565 @@ Export Service for PDF and Excel generation
 """
 import io
 import os
+import time
+import zipfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
 from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
+from reportlab.lib.pagesizes import A4, landscape
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from openpyxl import Workbook
+from werkzeug.utils import secure_filename
+from app import db
 from app.models.fee import Fee
 from app.models.user import User
+from app.models.student import Student
 from app.models.report import Report
+from app.models.transaction import Transaction
+from app.models.ledger_entry import LedgerEntry
+from app.services.ledger_service import LedgerService
+
+# Rows fetched per database round trip during exports
+EXPORT_CHUNK_ROWS = 2000
+# Bytes per chunk when streaming a rendered file to the client
+FILE_CHUNK_BYTES = 64 * 1024
+# Challans sent to a render process per task; larger batches amortize pickling
+CHALLAN_BATCH_SIZE = 25
+# Render processes for bulk challans (defaults to one per CPU)
+CHALLAN_WORKERS = int(os.getenv('CHALLAN_RENDER_WORKERS', 0)) or os.cpu_count() or 1
+
+
+def _version_of(model):
+    """Column for when a row last changed (rows never updated only have created_at)"""
+    return db.func.coalesce(model.updated_at, model.created_at)
+
+
+@lru_cache(maxsize=None)
+def _challan_styles():
+    """Paragraph and table styles, built once per process instead of per challan"""
+    styles = getSampleStyleSheet()
+    info_style = TableStyle([
+        ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey),
+        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ])
+    amount_style = TableStyle([
+        ('BACKGROUND', (0, 0), (1, 0), colors.darkblue),
+        ('TEXTCOLOR', (0, 0), (1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 10),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+        ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey), # Total row
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+    ])
+    return styles['Title'], styles['Normal'], info_style, amount_style
+
+
+def render_challan(data):
+    """
+    Render one challan PDF from plain challan data (see ExportService.challan_data)
+    Needs no app context or session, so it can run in a worker process
+    Returns PDF bytes
+    """
+    title, normal, info_style, amount_style = _challan_styles()
+    expected = Decimal(data['expected_amount'] or 0)
+    late_fee = Decimal(data['late_fee'] or 0)
+    paid = Decimal(data['paid_amount'] or 0)
+    payable = max(expected + late_fee - paid, Decimal('0'))
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    elements = []
+
+    # Header
+    elements.append(Paragraph("HOSTELIX PRO - FEE CHALLAN", title))
+    elements.append(Spacer(1, 20))
+
+    # Info Table
+    info = [
+        ["Challan ID:", f"#{data['fee_id']}"],
+        ["Student Name:", data['name'] or "Unknown"],
+        ["Email:", data['email'] or "Unknown"],
+        ["Admission No:", data['admission_no'] or "N/A"],
+        ["Room:", data['room'] or "N/A"],
+        ["Month/Year:", datetime(data['year'], data['month'], 1).strftime('%B %Y')],
+        ["Due Date:", data['due_date'] or "N/A"],
+        ["Generated Date:", datetime.now().strftime("%Y-%m-%d")],
+        ["Status:", data['status']]
+    ]
+    t = Table(info, colWidths=[150, 300])
+    t.setStyle(info_style)
+    elements.append(t)
+    elements.append(Spacer(1, 40))
+
+    # Amount Box
+    amounts = [
+        ["DESCRIPTION", "AMOUNT"],
+        ["Hostel Monthly Fee", f"${expected:.2f}"],
+        ["Late Fee", f"${late_fee:.2f}"],
+        ["Less: Paid", f"-${paid:.2f}"],
+        ["TOTAL PAYABLE", f"${payable:.2f}"]
+    ]
+    t2 = Table(amounts, colWidths=[300, 150])
+    t2.setStyle(amount_style)
+    elements.append(t2)
+
+    elements.append(Spacer(1, 50))
+    elements.append(Paragraph("__________________________", normal))
+    elements.append(Paragraph("Authorized Signature", normal))
+
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+def render_receipt(data):
+    """
+    Render a payment receipt PDF from plain receipt data (see ExportService.receipt_data)
+    Returns PDF bytes
+    """
+    title, normal, info_style, amount_style = _challan_styles()
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    elements = []
+
+    elements.append(Paragraph("HOSTELIX PRO - PAYMENT RECEIPT", title))
+    elements.append(Spacer(1, 20))
+
+    info = [
+        ["Receipt No:", f"#{data['transaction_id']}"],
+        ["Reference:", data['reference'] or "N/A"],
+        ["Student Name:", data['name'] or "Unknown"],
+        ["Admission No:", data['admission_no'] or "N/A"],
+        ["Fee Month/Year:", datetime(data['year'], data['month'], 1).strftime('%B %Y')],
+        ["Payment Method:", data['payment_method']],
+        ["Paid On:", _format_ms(data['transaction_date'])],
+        ["Approved On:", _format_ms(data['approved_at'])],
+        ["Approved By:", data['approved_by'] or "N/A"]
+    ]
+    t = Table(info, colWidths=[150, 300])
+    t.setStyle(info_style)
+    elements.append(t)
+    elements.append(Spacer(1, 40))
+
+    amounts = [
+        ["DESCRIPTION", "AMOUNT"],
+        ["Hostel Fee Payment", f"${Decimal(data['amount']):.2f}"],
+        ["TOTAL RECEIVED", f"${Decimal(data['amount']):.2f}"]
+    ]
+    t2 = Table(amounts, colWidths=[300, 150])
+    t2.setStyle(amount_style)
+    elements.append(t2)
+
+    elements.append(Spacer(1, 50))
+    elements.append(Paragraph("This receipt was generated electronically.", normal))
+
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+def render_statement(data):
+    """
+    Render a ledger statement PDF from ExportService.statement_data
+    Returns PDF bytes
+    """
+    title, normal, info_style, amount_style = _challan_styles()
+    statement = data['statement']
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    elements = []
+
+    elements.append(Paragraph("HOSTELIX PRO - FEE STATEMENT", title))
+    elements.append(Spacer(1, 20))
+
+    info = [
+        ["Student Name:", data['name'] or "Unknown"],
+        ["Admission No:", data['admission_no'] or "N/A"],
+        ["Period:", f"{data['from_date']} to {data['to_date']}"],
+        ["Opening Balance:", f"${Decimal(statement['opening_balance']):.2f}"],
+        ["Closing Balance:", f"${Decimal(statement['closing_balance']):.2f}"]
+    ]
+    t = Table(info, colWidths=[150, 300])
+    t.setStyle(info_style)
+    elements.append(t)
+    elements.append(Spacer(1, 30))
+
+    lines = [["DATE", "DESCRIPTION", "CHARGES", "PAYMENTS", "BALANCE"]]
+    for entry in statement['entries']:
+        delta = Decimal(entry['receivable_delta'])
+        lines.append([
+            _format_ms(entry['posted_at'], '%Y-%m-%d'),
+            entry['memo'] or entry['entry_type'].title(),
+            f"${delta:.2f}" if delta > 0 else "",
+            f"${-delta:.2f}" if delta < 0 else "",
+            f"${Decimal(entry['balance']):.2f}"
+        ])
+    lines.append(["", "CLOSING BALANCE", "", "", f"${Decimal(statement['closing_balance']):.2f}"])
+    t2 = Table(lines, colWidths=[70, 180, 70, 70, 70], repeatRows=1)
+    t2.setStyle(amount_style)
+    elements.append(t2)
+
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+def _format_ms(value, fmt='%Y-%m-%d %H:%M'):
+    return datetime.fromtimestamp(value / 1000).strftime(fmt) if value else "N/A"
+
+
+def _render_challan_batch(batch):
+    """Pool task: [(filename, data)] -> [(filename, pdf bytes)]"""
+    return [(name, render_challan(data)) for name, data in batch]
+
 
 class ExportService:
     
+    @staticmethod
+    def _challan_query():
+        """Fee, student and user columns a challan needs, in one joined query"""
+        return db.session.query(
+            Fee.id, Fee.month, Fee.year, Fee.status, Fee.due_date,
+            Fee.expected_amount, Fee.late_fee, Fee.paid_amount,
+            User.display_name, User.email, Student.admission_no, Student.room,
+            _version_of(Fee), _version_of(Student), _version_of(User)
+        ).join(Student, Student.id == Fee.student_id)\
+            .outerjoin(User, User.id == Student.user_id)
+
+    @staticmethod
+    def _challan_data(row):
+        """Plain, picklable challan data from a _challan_query row"""
+        (fee_id, month, year, status, due_date, expected, late_fee, paid,
+         name, email, admission_no, room, *versions) = row
+        return {
+            'fee_id': fee_id,
+            'month': month,
+            'year': year,
+            'status': status,
+            'due_date': due_date.isoformat() if due_date else None,
+            'expected_amount': str(expected or 0),
+            'late_fee': str(late_fee or 0),
+            'paid_amount': str(paid or 0),
+            'name': name,
+            'email': email,
+            'admission_no': admission_no,
+            'room': room,
+            'version': '-'.join(str(v or 0) for v in versions)
+        }
+
+    @staticmethod
+    def challan_data(fee_id):
+        """Challan data for one fee, or None if it does not exist"""
+        row = ExportService._challan_query().filter(Fee.id == fee_id).first()
+        return ExportService._challan_data(row) if row else None
+
     @staticmethod
     def generate_fee_challan(fee_id):
         """
         Generate PDF Fee Challan
         Returns bio (BytesIO)
         """
-        fee = Fee.query.get(fee_id)
-        if not fee:
+        data = ExportService.challan_data(fee_id)
+        if not data:
             raise Exception("Fee not found")
-        
-        user = User.query.get(fee.user_id)
-        
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        elements = []
-        styles = getSampleStyleSheet()
-        
-        # Header
-        elements.append(Paragraph(f"HOSTELIX PRO - FEE CHALLAN", styles['Title']))
-        elements.append(Spacer(1, 20))
-        
-        # Info Table
-        data = [
-            ["Challan ID:", f"#{fee.id}"],
-            ["Student Name:", user.display_name if user else "Unknown"],
-            ["Email:", user.email if user else "Unknown"],
-            ["Month/Year:", f"{datetime(fee.year, fee.month, 1).strftime('%B %Y')}"],
-            ["Generated Date:", datetime.now().strftime("%Y-%m-%d")],
-            ["Status:", fee.status]
-        ]
-        
-        t = Table(data, colWidths=[150, 300])
-        t.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), colors.lightgrey),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-        elements.append(t)
-        elements.append(Spacer(1, 40))
-        
-        # Amount Box
-        amount_data = [
-            ["DESCRIPTION", "AMOUNT"],
-            ["Hostel Monthly Fee", f"${fee.amount}"],
-            ["Utility Charges", "$0.00"],
-            ["Fine/Other", "$0.00"],
-            ["TOTAL PAYABLE", f"${fee.amount}"]
-        ]
-        
-        t2 = Table(amount_data, colWidths=[300, 150])
-        t2.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (1, 0), colors.darkblue),
-            ('TEXTCOLOR', (0, 0), (1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey), # Total row
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ]))
-        elements.append(t2)
-        
-        elements.append(Spacer(1, 50))
-        elements.append(Paragraph("__________________________", styles['Normal']))
-        elements.append(Paragraph("Authorized Signature", styles['Normal']))
-        
-        doc.build(elements)
-        buffer.seek(0)
-        return buffer
+        return io.BytesIO(render_challan(data))
 
     @staticmethod
-    def generate_reports_excel():
+    def receipt_data(transaction_id):
         """
-        Generate Excel list of all student reports
-        Returns bio (BytesIO)
+        Receipt data for one transaction, or None if it does not exist
+        Includes the owning student's user id for permission checks
         """
-        reports = Report.query.order_by(Report.created_at.desc()).limit(1000).all()
-        
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Student Reports"
+        approver = db.aliased(User)
+        row = db.session.query(
+            Transaction.id, Transaction.transaction_reference, Transaction.amount,
+            Transaction.payment_method, Transaction.transaction_date, Transaction.status,
+            Transaction.approved_at, approver.display_name, Fee.month, Fee.year,
+            Student.user_id, User.display_name, Student.admission_no,
+            _version_of(Transaction), _version_of(Student), _version_of(User)
+        ).join(Fee, Fee.id == Transaction.fee_id)\
+            .join(Student, Student.id == Fee.student_id)\
+            .outerjoin(User, User.id == Student.user_id)\
+            .outerjoin(approver, approver.id == Transaction.approved_by_id)\
+            .filter(Transaction.id == transaction_id).first()
+        if not row:
+            return None
+
+        (trx_id, reference, amount, method, trx_date, status, approved_at, approved_by,
+         month, year, student_user_id, name, admission_no, *versions) = row
+        return {
+            'transaction_id': trx_id,
+            'reference': reference,
+            'amount': str(amount),
+            'payment_method': method,
+            'transaction_date': trx_date,
+            'status': status,
+            'approved_at': approved_at,
+            'approved_by': approved_by,
+            'month': month,
+            'year': year,
+            'student_user_id': student_user_id,
+            'name': name,
+            'admission_no': admission_no,
+            'version': '-'.join(str(v or 0) for v in versions)
+        }
+
+    @staticmethod
+    def statement_period(from_ms, to_ms):
+        """
+        Widen a statement range to whole UTC days, so every request for the
+        same days renders (and caches) the same document
+        Returns (from_ms, to_ms)
+        """
+        day_ms = 24 * 60 * 60 * 1000
+        return from_ms - from_ms % day_ms, to_ms - to_ms % day_ms + day_ms - 1
+
+    @staticmethod
+    def statement_version(student_id, to_ms):
+        """
+        Version of a student's statement up to to_ms
+        The ledger is append-only, so the count and last id of its entries
+        change whenever anything the statement shows could have changed
+        """
+        count, last_id = db.session.query(
+            db.func.count(LedgerEntry.id), db.func.max(LedgerEntry.id)
+        ).filter(
+            LedgerEntry.student_id == student_id,
+            LedgerEntry.posted_at <= to_ms
+        ).one()
+        profile = db.session.query(_version_of(Student), _version_of(User))\
+            .outerjoin(User, User.id == Student.user_id)\
+            .filter(Student.id == student_id).first()
+        return '-'.join(str(v or 0) for v in (count, last_id, *(profile or ())))
+
+    @staticmethod
+    def statement_data(student_id, from_ms, to_ms):
+        """Ledger statement plus the student details a statement PDF shows"""
+        profile = db.session.query(User.display_name, Student.admission_no)\
+            .outerjoin(User, User.id == Student.user_id)\
+            .filter(Student.id == student_id).first()
+        name, admission_no = profile or (None, None)
+        return {
+            'name': name,
+            'admission_no': admission_no,
+            'from_date': datetime.utcfromtimestamp(from_ms / 1000).strftime('%Y-%m-%d'),
+            'to_date': datetime.utcfromtimestamp(to_ms / 1000).strftime('%Y-%m-%d'),
+            'statement': LedgerService.statement(student_id, from_ms, to_ms)
+        }
+
+    @staticmethod
+    def _iter_challan_batches(month, year, fee_structure_id=None):
+        """Yield [(filename, data)] batches for every fee of a month, streamed from the DB"""
+        query = ExportService._challan_query().filter(Fee.month == month, Fee.year == year)
+        if fee_structure_id:
+            query = query.filter(Fee.fee_structure_id == fee_structure_id)
+
+        batch = []
+        for row in query.order_by(Student.admission_no, Fee.id).yield_per(EXPORT_CHUNK_ROWS):
+            data = ExportService._challan_data(row)
+            label = secure_filename(data['admission_no'] or '') or f"fee_{data['fee_id']}"
+            batch.append((f"challan_{year}_{month:02d}_{label}_{data['fee_id']}.pdf", data))
+            if len(batch) >= CHALLAN_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def write_bulk_challans(output, month, year, fee_structure_id=None, workers=None):
+        """
+        Render every challan of a month (optionally one fee structure) into a ZIP
+        Batches are rendered across a process pool while the parent streams rows
+        from the DB and writes finished PDFs into the archive in order; at most
+        two batches per worker are in flight, so memory does not grow with the month.
+        Returns stats dict with count, bytes, seconds and challans_per_second
+        """
+        workers = workers or CHALLAN_WORKERS
+        started = time.perf_counter()
+        count = 0
+        size = 0
+
+        def write(zf, rendered):
+            nonlocal count, size
+            for name, pdf in rendered:
+                zf.writestr(name, pdf)
+                count += 1
+                size += len(pdf)
+
+        batches = ExportService._iter_challan_batches(month, year, fee_structure_id)
+        # PDFs are already compressed, so the archive just stores them
+        with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as zf:
+            if workers == 1:
+                for batch in batches:
+                    write(zf, _render_challan_batch(batch))
+            else:
+                # spawn, so children do not inherit the parent's DB connections
+                context = multiprocessing.get_context('spawn')
+                with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                    in_flight = deque()
+                    for batch in batches:
+                        in_flight.append(pool.submit(_render_challan_batch, batch))
+                        if len(in_flight) >= workers * 2:
+                            write(zf, in_flight.popleft().result())
+                    while in_flight:
+                        write(zf, in_flight.popleft().result())
+
+        seconds = time.perf_counter() - started
+        return {
+            'count': count,
+            'bytes': size,
+            'workers': workers,
+            'seconds': round(seconds, 3),
+            'challans_per_second': round(count / seconds, 1) if seconds else None
+        }
+
+    @staticmethod
+    def _report_rows(date_from_ms=None, date_to_ms=None, status=None):
+        """
+        Report export rows with student columns joined in
+        Streamed with yield_per so only one chunk is in memory at a time
+        """
+        query = db.session.query(
+            Report.id,
+            User.display_name,
+            Student.room,
+            Report.status,
+            Report.wake_time,
+            Report.walk,
+            Report.exercise,
+            Report.late_minutes
+        ).outerjoin(Student, Student.id == Report.student_id)\
+            .outerjoin(User, User.id == Student.user_id)
+
+        if date_from_ms is not None:
+            query = query.filter(Report.wake_time >= date_from_ms)
+        if date_to_ms is not None:
+            query = query.filter(Report.wake_time < date_to_ms)
+        if status:
+            query = query.filter(Report.status == status)
+
+        return query.order_by(Report.created_at.desc()).yield_per(EXPORT_CHUNK_ROWS)
+
+    @staticmethod
+    def write_reports_excel(output, date_from_ms=None, date_to_ms=None, status=None):
+        """
+        Write student reports to an .xlsx path or file object
+        Uses openpyxl write-only mode, so memory stays flat regardless of row count
+        Returns number of rows written
+        """
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Student Reports")
         
         # Headers
         headers = ["ID", "Student", "Room", "Status", "Wake Time", "Walk", "Exercise", "Late Mins"]
         ws.append(headers)
         
-        for r in reports:
-            student_name = "Unknown"
-            student_room = "N/A"
-            if r.student and r.student.user:
-                student_name = r.student.user.display_name
-                student_room = r.student.room
+        count = 0
+        for report_id, name, room, status_, wake_time, walk, exercise, late_minutes in \
+                ExportService._report_rows(date_from_ms, date_to_ms, status):
+            wake_time_str = datetime.fromtimestamp(wake_time/1000).strftime('%Y-%m-%d %H:%M:%S')
             
-            wake_time_str = datetime.fromtimestamp(r.wake_time/1000).strftime('%Y-%m-%d %H:%M:%S')
-            
-            row = [
-                r.id,
-                student_name,
-                student_room,
-                r.status,
+            ws.append([
+                report_id,
+                name if name is not None else "Unknown",
+                room if name is not None else "N/A",
+                status_,
                 wake_time_str,
-                "Yes" if r.walk else "No",
-                "Yes" if r.exercise else "No",
-                r.late_minutes
-            ]
-            ws.append(row)
+                "Yes" if walk else "No",
+                "Yes" if exercise else "No",
+                late_minutes
+            ])
+            count += 1
             
+        wb.save(output)
+        return count
+
+    @staticmethod
+    def _attendance_rows(matrix):
+        """Header and one row per student: P per present day, then totals"""
+        days = matrix['days']
+        header = ["Student", "Admission No", "Room"] + [str(d) for d in range(1, days + 1)] \
+            + ["Days", "Late Mins"]
+        rows = []
+        for student in matrix['students']:
+            bitmap = student['bitmap']
+            rows.append(
+                [student['name'] or "Unknown", student['admission_no'] or "", student['room'] or ""]
+                + ["P" if bitmap >> d & 1 else "" for d in range(days)]
+                + [student['days_present'], student['late_minutes']]
+            )
+        totals = ["Present", "", ""] + list(matrix['daily_totals']) + ["", ""]
+        return header, rows, totals
+
+    @staticmethod
+    def write_attendance_excel(output, matrix):
+        """Write an attendance matrix (see AttendanceService.monthly_matrix) to .xlsx"""
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(datetime(matrix['year'], matrix['month'], 1).strftime('Attendance %b %Y'))
+        header, rows, totals = ExportService._attendance_rows(matrix)
+        ws.append(header)
+        for row in rows:
+            ws.append(row)
+        ws.append(totals)
+        wb.save(output)
+
+    @staticmethod
+    def generate_attendance_pdf(matrix):
+        """
+        Printable attendance grid on landscape A4
+        Returns bio (BytesIO)
+        """
+        title, normal, info_style, amount_style = _challan_styles()
         buffer = io.BytesIO()
-        wb.save(buffer)
+        doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), leftMargin=20, rightMargin=20)
+        elements = [
+            Paragraph(datetime(matrix['year'], matrix['month'], 1).strftime('ATTENDANCE - %B %Y'), title),
+            Spacer(1, 10)
+        ]
+
+        header, rows, totals = ExportService._attendance_rows(matrix)
+        # Admission no is dropped to fit 31 day columns across the page
+        data = [[r[0]] + r[2:] for r in [header] + rows + [totals]]
+        day_width = 18
+        name_width = doc.width - 40 - day_width * matrix['days'] - 36 - 44
+        t = Table(data, colWidths=[name_width, 40] + [day_width] * matrix['days'] + [36, 44], repeatRows=1)
+        t.setStyle(TableStyle([
+            ('FONTSIZE', (0, 0), (-1, -1), 7),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+            ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+            ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
+            ('ALIGN', (2, 0), (-1, -1), 'CENTER'),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('TOPPADDING', (0, 0), (-1, -1), 2),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+        ]))
+        elements.append(t)
+
+        doc.build(elements)
         buffer.seek(0)
         return buffer
+
+    @staticmethod
+    def iter_file(path, chunk_size=FILE_CHUNK_BYTES, delete=False):
+        """
+        Yield a file in fixed-size chunks for a streamed response
+        With delete=True the file is removed once fully sent (or the client disconnects)
+        """
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            if delete and os.path.exists(path):
+                os.remove(path)
@@ -1,72 +1,215 @@
 """
 Fee service for handling payments
 """
+import time
+from decimal import Decimal
+from sqlalchemy.exc import IntegrityError, OperationalError
 from app import db
 from app.models.fee import Fee
 from app.models.fee_structure import FeeStructure
 from app.models.student import Student
 from app.services.time_service import TimeService
+from app.services.proof_storage_service import ProofStorageService
+from app.services.ledger_service import LedgerService
+from app.services.receipt_service import ReceiptService
 from app.models.audit_log import AuditLog
 from datetime import date
 
 from app.models.transaction import Transaction
+from app.models.ledger_entry import LedgerEntry
+
+# Attempts for a fee mutation that lost a lock or an insert race
+MAX_LOCK_RETRIES = 3
+
+# Day of month a fee falls due when no structure says otherwise
+# (matches the FeeStructure.due_day default)
+DEFAULT_DUE_DAY = 5
+
 
 class FeeService:
+    @staticmethod
+    def _lock_fee(fee_id):
+        """
+        Load a fee row and hold a write lock on it until commit/rollback
+        Postgres: SELECT ... FOR UPDATE on the row
+        SQLite: no row locks, so a no-op UPDATE takes the database write lock
+        All balance mutations lock the fee first, so they serialize per fee
+        """
+        if db.engine.dialect.name == 'sqlite':
+            Fee.query.filter_by(id=fee_id).update(
+                {Fee.id: Fee.id}, synchronize_session=False
+            )
+        return Fee.query.filter_by(id=fee_id).with_for_update().populate_existing().first()
+
+    @staticmethod
+    def _lock_fees(fee_ids):
+        """
+        Batch form of _lock_fee, locking in id order to avoid deadlocks
+        Returns {fee_id: Fee}
+        """
+        fee_ids = sorted(set(fee_ids))
+        if not fee_ids:
+            return {}
+        if db.engine.dialect.name == 'sqlite':
+            Fee.query.filter(Fee.id.in_(fee_ids)).update(
+                {Fee.id: Fee.id}, synchronize_session=False
+            )
+        fees = Fee.query.filter(Fee.id.in_(fee_ids)).order_by(Fee.id)\
+            .with_for_update().populate_existing().all()
+        return {f.id: f for f in fees}
+
+    @staticmethod
+    def _lock_transaction(transaction_id):
+        """
+        Lock a transaction's fee, then re-read the transaction under that lock
+        Returns (transaction, fee) or (None, None)
+        """
+        trx = Transaction.query.get(transaction_id)
+        if not trx:
+            return None, None
+        fee = FeeService._lock_fee(trx.fee_id)
+        db.session.refresh(trx)
+        return trx, fee
+
+    @staticmethod
+    def _track_pending(fee, trx, sign):
+        """
+        Apply a transaction entering (+1) or leaving (-1) PENDING to the
+        fee's denormalized pending totals. Caller holds the fee lock.
+        """
+        amount = Decimal(str(trx.amount))
+        fee.pending_amount = (fee.pending_amount or Decimal('0')) + sign * amount
+        fee.pending_count = (fee.pending_count or 0) + sign
+
+        proofs = list(fee.pending_proofs or [])
+        if trx.proof_path:
+            if sign > 0:
+                proofs.append(trx.proof_path)
+            elif trx.proof_path in proofs:
+                proofs.remove(trx.proof_path)
+        fee.pending_proofs = proofs
+
+    @staticmethod
+    def _apply_payment(fee, trx, admin_id):
+        """
+        Credit an approved transaction to the fee, post it to the ledger
+        and settle the fee status
+        Caller holds the fee lock and has already moved the transaction out of PENDING
+        """
+        now = TimeService.now_ms()
+        fee.paid_amount = (fee.paid_amount or 0) + trx.amount
+        fee.approved_at = now
+        fee.approved_by_id = admin_id
+
+        # Update Fee Status based on payment completeness
+        if fee.paid_amount >= (fee.expected_amount or 0):
+            fee.status = 'APPROVED'
+            fee.paid_at = now
+        elif fee.pending_count > 0:
+            fee.status = 'PENDING_ADMIN'  # Still has pending transactions
+        else:
+            fee.status = 'PARTIAL'  # Partially paid, no more pending
+
+        LedgerService.post_payment(fee, trx, actor_id=admin_id, posted_at=now)
+
+    @staticmethod
+    def _run_locked(operation, *args):
+        """
+        Run a fee mutation, retrying when it hits a lock timeout/deadlock
+        or loses the race to create the fee row for a month
+        """
+        for attempt in range(MAX_LOCK_RETRIES):
+            try:
+                return operation(*args)
+            except (OperationalError, IntegrityError):
+                db.session.rollback()
+                if attempt == MAX_LOCK_RETRIES - 1:
+                    raise
+                time.sleep(0.05 * (attempt + 1))
+
+    @staticmethod
+    def expected_amount(student):
+        """Monthly amount a student is charged"""
+        expected = student.monthly_fee_amount or 0
+        # Students have no fee_structure_id column yet; the structure applies once they do
+        structure_id = getattr(student, 'fee_structure_id', None)
+        if not expected and structure_id:
+            structure = FeeStructure.query.get(structure_id)
+            if structure:
+                expected = structure.monthly_amount
+        return expected
+
+    @staticmethod
+    def _create_fee(student, month, year):
+        """
+        Add a student's fee row for a month, charged to the ledger
+        Raises IntegrityError (at flush) if the month's fee already exists
+        """
+        fee = Fee(
+            student_id=student.id,
+            month=month,
+            year=year,
+            expected_amount=FeeService.expected_amount(student),
+            paid_amount=0,
+            status='PENDING_ADMIN', # Use default valid status instead of UNPAID
+            due_date=date(year, month, DEFAULT_DUE_DAY),
+            created_at=TimeService.now_ms()
+        )
+        db.session.add(fee)
+        db.session.flush() # Get ID
+        LedgerService.post_charge(fee)
+        return fee
+
     @staticmethod
     def add_transaction(user_id, month, year, amount, proof_path=None, payment_method='manual', reference=None):
+        # Request values may be strings ("3"); the fee row, due date and ledger memo need ints
+        try:
+            month, year = int(month), int(year)
+            date(year, month, DEFAULT_DUE_DAY)
+        except (ValueError, TypeError):
+            return None, "Invalid month or year"
+        return FeeService._run_locked(
+            FeeService._add_transaction,
+            user_id, month, year, amount, proof_path, payment_method, reference
+        )
+
+    @staticmethod
+    def _add_transaction(user_id, month, year, amount, proof_path, payment_method, reference):
+        try:
+            amount_val = float(amount)
+        except (ValueError, TypeError):
+            return None, "Invalid amount format"
+
         student = Student.query.filter_by(user_id=user_id).first()
         if not student:
             return None, "Student profile not found"
-            
+
         # Get or Create Fee Record
         fee = Fee.query.filter_by(
             student_id=student.id,
             month=month,
             year=year
         ).first()
-        
+
         if not fee:
-            # Determine expected amount
-            expected = student.monthly_fee_amount or 0
-            if not expected and student.fee_structure_id:
-                structure = FeeStructure.query.get(student.fee_structure_id)
-                if structure:
-                    expected = structure.monthly_amount
-            
-            # Create new Fee record
-            fee = Fee(
-                student_id=student.id,
-                month=month,
-                year=year,
-                expected_amount=expected,
-                paid_amount=0,
-                status='PENDING_ADMIN', # Use default valid status instead of UNPAID
-                created_at=TimeService.now_ms()
-            )
-            db.session.add(fee)
-            db.session.flush() # Get ID
-            
+            # A concurrent submission creating the same month raises IntegrityError here
+            fee = FeeService._create_fee(student, month, year)
+
+        # Everything below reads and writes the balance under the fee lock
+        fee = FeeService._lock_fee(fee.id)
+
         # Check if already fully paid
         if fee.status == 'PAID' or fee.status == 'APPROVED':
+            db.session.rollback()
             return None, "Fee for this month is already fully paid"
 
-        # Create Transaction
-        try:
-            amount_val = float(amount)
-        except (ValueError, TypeError):
-            return None, "Invalid amount format"
+        # Check Payment Limits against the amount already awaiting approval
+        remaining_limit = float(fee.expected_amount or 0) - float(fee.paid_amount or 0) - float(fee.pending_amount or 0)
 
-        # Check Payment Limits
-        # Calculate pending amount from other pending transactions
-        pending_txs = Transaction.query.filter_by(fee_id=fee.id, status='PENDING').all()
-        pending_sum = sum(t.amount for t in pending_txs)
-        
-        # Calculate max allowable payment
-        remaining_limit = float(fee.expected_amount or 0) - float(fee.paid_amount or 0) - pending_sum
-        
         # Allow small floating point margin or exact check. Using exact check for now.
         if amount_val > remaining_limit:
-             return None, f"Amount exceeds remaining balance. Max allowed: {remaining_limit}"
+            db.session.rollback()
+            return None, f"Amount exceeds remaining balance. Max allowed: {remaining_limit}"
 
         transaction = Transaction(
             fee_id=fee.id,
@@ -77,91 +220,92 @@ class FeeService:
             proof_path=proof_path,
             status='PENDING'
         )
-        
+
         db.session.add(transaction)
-        
+        ProofStorageService.link(transaction, proof_path)
+        FeeService._track_pending(fee, transaction, 1)
+
         # Update Fee status to indicate pending action if not already partial/paid
-        if fee.status == 'PENDING_ADMIN' or fee.status == 'UNPAID' or fee.status == 'REJECTED': 
+        if fee.status == 'PENDING_ADMIN' or fee.status == 'UNPAID' or fee.status == 'REJECTED':
              # Ensure it is PENDING_ADMIN (though initialized as such above)
              fee.status = 'PENDING_ADMIN'
-            
+
         AuditLog.log(user_id, 'SUBMIT_FEE_TRANSACTION', 'transaction', transaction.id)
         db.session.commit()
         return transaction, None
 
     @staticmethod
     def approve_transaction(transaction_id, admin_id):
-        trx = Transaction.query.get(transaction_id)
+        trx, error = FeeService._run_locked(FeeService._approve_transaction, transaction_id, admin_id)
+        if trx:
+            # Render the receipt off the request path, before the student asks for it
+            ReceiptService.enqueue_render([trx.id])
+        return trx, error
+
+    @staticmethod
+    def _approve_transaction(transaction_id, admin_id):
+        trx, fee = FeeService._lock_transaction(transaction_id)
         if not trx:
             return None, "Transaction not found"
-            
+
         if trx.status == 'APPROVED':
+            db.session.rollback()
             return None, "Transaction already approved"
-            
-        fee = Fee.query.get(trx.fee_id)
-        
+
+        if trx.status == 'PENDING':
+            FeeService._track_pending(fee, trx, -1)
+
         # Approve Transaction
         trx.status = 'APPROVED'
         trx.approved_at = TimeService.now_ms()
         trx.approved_by_id = admin_id
-        
-        # Update Fee Totals
-        fee.paid_amount = (fee.paid_amount or 0) + trx.amount
-        fee.approved_at = TimeService.now_ms()
-        fee.approved_by_id = admin_id
-        
-        # Update Fee Status based on payment completeness
-        if fee.paid_amount >= fee.expected_amount:
-            fee.status = 'APPROVED'
-            fee.paid_at = TimeService.now_ms()
-        else:
-            # Check if there are still pending transactions remaining
-            db.session.flush()
-            remaining_pending = Transaction.query.filter(
-                Transaction.fee_id == fee.id,
-                Transaction.id != trx.id,
-                Transaction.status == 'PENDING'
-            ).count()
-            
-            if remaining_pending > 0:
-                fee.status = 'PENDING_ADMIN'  # Still has pending transactions
-            else:
-                fee.status = 'PARTIAL'  # Partially paid, no more pending
-            
+
+        FeeService._apply_payment(fee, trx, admin_id)
+
         AuditLog.log(admin_id, 'APPROVE_TRANSACTION', 'transaction', trx.id)
         db.session.commit()
         return trx, None
 
     @staticmethod
     def reject_transaction(transaction_id, admin_id, reason):
-        trx = Transaction.query.get(transaction_id)
+        trx, error = FeeService._run_locked(FeeService._reject_transaction, transaction_id, admin_id, reason)
+        if trx:
+            ReceiptService.discard(trx.id)
+        return trx, error
+
+    @staticmethod
+    def _reject_transaction(transaction_id, admin_id, reason):
+        trx, fee = FeeService._lock_transaction(transaction_id)
         if not trx:
             return None, "Transaction not found"
-        
+
         if trx.status == 'REJECTED':
+            db.session.rollback()
             return None, "Transaction already rejected"
-            
+
+        if trx.status == 'PENDING':
+            FeeService._track_pending(fee, trx, -1)
+        elif trx.status == 'APPROVED':
+            # Taking back an approved payment: undo its credit and reverse it in the ledger
+            fee.paid_amount = (fee.paid_amount or 0) - trx.amount
+            LedgerService.reverse_payment(trx, actor_id=admin_id, memo=reason)
+
         trx.status = 'REJECTED'
         trx.rejection_reason = reason
-        trx.approved_by_id = admin_id 
+        trx.approved_by_id = admin_id
         trx.approved_at = TimeService.now_ms()
-        
+
         # Flush so the status change is visible in subsequent queries
         db.session.flush()
-        
-        fee = Fee.query.get(trx.fee_id)
-        
+
         # Check remaining active transactions (excluding this one which is now REJECTED)
-        remaining_pending = Transaction.query.filter(
-            Transaction.fee_id == fee.id,
-            Transaction.status == 'PENDING'
-        ).count()
-        
+        remaining_pending = fee.pending_count
+
         remaining_approved = Transaction.query.filter(
             Transaction.fee_id == fee.id,
             Transaction.status == 'APPROVED'
         ).count()
-        
+
         if remaining_pending == 0 and remaining_approved == 0 and (fee.paid_amount or 0) == 0:
             # No active transactions and nothing paid — mark fee as rejected
             fee.status = 'REJECTED'
@@ -171,11 +315,114 @@ class FeeService:
             fee.status = 'PARTIAL'
         elif remaining_pending > 0:
             fee.status = 'PENDING_ADMIN'  # Still has pending transactions
-        
+
         AuditLog.log(admin_id, 'REJECT_TRANSACTION', 'transaction', trx.id)
         db.session.commit()
         return trx, None
-        
+
+    @staticmethod
+    def add_late_fee(fee_id, amount, admin_id):
+        return FeeService._run_locked(FeeService._add_late_fee, fee_id, amount, admin_id)
+
+    @staticmethod
+    def _add_late_fee(fee_id, amount, admin_id):
+        try:
+            amount_val = float(amount)
+        except (ValueError, TypeError):
+            return None, "Invalid amount format"
+        if amount_val <= 0:
+            return None, "Amount must be positive"
+
+        fee = FeeService._lock_fee(fee_id)
+        if not fee:
+            return None, "Fee not found"
+
+        entry = LedgerService.post_late_fee(fee, amount_val, actor_id=admin_id)
+        fee.late_fee = (fee.late_fee or 0) + entry.amount
+
+        AuditLog.log(admin_id, 'ADD_LATE_FEE', 'fee', fee.id, details={'amount': str(entry.amount)})
+        db.session.commit()
+        return fee, None
+
+    @staticmethod
+    def waive_late_fee(entry_id, admin_id, reason):
+        return FeeService._run_locked(FeeService._waive_late_fee, entry_id, admin_id, reason)
+
+    @staticmethod
+    def _waive_late_fee(entry_id, admin_id, reason):
+        entry = LedgerEntry.query.get(entry_id)
+        if not entry or entry.entry_type != 'LATE_FEE':
+            return None, "Late fee entry not found"
+
+        fee = FeeService._lock_fee(entry.fee_id)
+        reversal, error = LedgerService.reverse(entry, actor_id=admin_id, memo=reason)
+        if error:
+            db.session.rollback()
+            return None, error
+        fee.late_fee = (fee.late_fee or 0) - entry.amount
+
+        AuditLog.log(admin_id, 'WAIVE_LATE_FEE', 'ledger_entry', entry.id, reason=reason)
+        db.session.commit()
+        return reversal, None
+
+    @staticmethod
+    def find_pending_mismatches():
+        """
+        Consistency check: compare every fee's denormalized pending totals
+        with the PENDING transactions actually recorded against it
+        Returns a list of {'fee_id', 'stored', 'actual'} for fees that disagree
+        """
+        actual = {}
+        totals = db.session.query(
+            Transaction.fee_id,
+            db.func.sum(Transaction.amount),
+            db.func.count(Transaction.id)
+        ).filter(Transaction.status == 'PENDING').group_by(Transaction.fee_id)
+        for fee_id, amount, count in totals:
+            actual[fee_id] = {'amount': Decimal(str(amount)), 'count': count, 'proofs': []}
+
+        proofs = db.session.query(Transaction.fee_id, Transaction.proof_path).filter(
+            Transaction.status == 'PENDING',
+            Transaction.proof_path.isnot(None)
+        ).order_by(Transaction.id)
+        for fee_id, proof_path in proofs:
+            actual[fee_id]['proofs'].append(proof_path)
+
+        empty = {'amount': Decimal('0'), 'count': 0, 'proofs': []}
+        mismatches = []
+        stored_rows = db.session.query(
+            Fee.id, Fee.pending_amount, Fee.pending_count, Fee.pending_proofs
+        ).order_by(Fee.id).yield_per(1000)
+        for fee_id, amount, count, stored_proofs in stored_rows:
+            stored = {
+                'amount': Decimal(str(amount or 0)),
+                'count': count or 0,
+                'proofs': list(stored_proofs or [])
+            }
+            expected = actual.get(fee_id, empty)
+            if (stored['amount'] != expected['amount']
+                    or stored['count'] != expected['count']
+                    or sorted(stored['proofs']) != sorted(expected['proofs'])):
+                mismatches.append({'fee_id': fee_id, 'stored': stored, 'actual': expected})
+        return mismatches
+
+    @staticmethod
+    def repair_pending_totals():
+        """
+        Rewrite the pending totals of every inconsistent fee from its transactions
+        Used for the initial backfill and to repair drift. Returns fees fixed.
+        """
+        mismatches = FeeService.find_pending_mismatches()
+        if mismatches:
+            db.session.bulk_update_mappings(Fee, [{
+                'id': m['fee_id'],
+                'pending_amount': m['actual']['amount'],
+                'pending_count': m['actual']['count'],
+                'pending_proofs': m['actual']['proofs']
+            } for m in mismatches])
+            db.session.commit()
+        return len(mismatches)
+
     @staticmethod
     def get_student_fees(student_id, year=None):
         query = Fee.query.filter_by(student_id=student_id)
@@ -0,0 +1,201 @@
+"""
+Background job service
+Runs slow exports on the rq worker and keeps their results for download
+"""
+import os
+import time
+from flask import current_app
+from redis import Redis
+from rq import Queue
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from app import db
+from app.models.notification import Notification
+from app.services.export_service import ExportService
+
+QUEUE_NAME = 'default'
+# Worst-case render time before rq kills the job
+JOB_TIMEOUT_SECONDS = 30 * 60
+# How long finished results (and their files) stay downloadable
+RESULT_TTL_SECONDS = int(os.getenv('EXPORT_RESULT_TTL_SECONDS', 24 * 60 * 60))
+
+
+def _write_challan(path, fee_id):
+    buffer = ExportService.generate_fee_challan(fee_id)
+    with open(path, 'wb') as f:
+        f.write(buffer.getbuffer())
+
+
+# Export type -> how to render it and how to name the download
+EXPORT_TYPES = {
+    'reports_xlsx': {
+        'label': 'reports',
+        'render': lambda path, params: ExportService.write_reports_excel(path, **params),
+        'extension': 'xlsx',
+        'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'download_name': lambda params: 'reports_export.xlsx',
+    },
+    'fee_challan': {
+        'label': 'fee challan',
+        'render': lambda path, params: _write_challan(path, params['fee_id']),
+        'extension': 'pdf',
+        'mimetype': 'application/pdf',
+        'download_name': lambda params: f"fee_challan_{params['fee_id']}.pdf",
+    },
+    'bulk_challans': {
+        'label': 'bulk challan',
+        'render': lambda path, params: ExportService.write_bulk_challans(path, **params),
+        'extension': 'zip',
+        'mimetype': 'application/zip',
+        'download_name': lambda params: f"fee_challans_{params['year']}_{params['month']:02d}.zip",
+    },
+}
+
+
+def run_export_job(export_type, params, user_id):
+    """
+    rq entry point: render an export into the results directory
+    Runs inside the worker's app context (see worker.py)
+    """
+    from rq import get_current_job
+    job = get_current_job()
+    spec = EXPORT_TYPES[export_type]
+    path = JobService.result_path(job.id, spec['extension'])
+
+    try:
+        stats = spec['render'](path, params)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        JobService.notify(user_id, job.id, export_type, error=str(e))
+        raise
+
+    JobService.notify(user_id, job.id, export_type)
+    return {
+        'path': path,
+        'size': os.path.getsize(path),
+        'mimetype': spec['mimetype'],
+        'download_name': spec['download_name'](params),
+        'stats': stats if isinstance(stats, dict) else None
+    }
+
+
+class JobService:
+    """
+    Enqueue exports, report their status and locate their results
+    Job ids are returned to clients, who poll status or wait for the
+    in-app notification, then download before the result TTL runs out.
+    """
+
+    @staticmethod
+    def _connection():
+        return Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+
+    @staticmethod
+    def _queue():
+        return Queue(QUEUE_NAME, connection=JobService._connection())
+
+    @staticmethod
+    def _results_dir():
+        """Get export results directory, create if not exists"""
+        path = os.getenv('EXPORT_RESULTS_DIR') or os.path.join(current_app.root_path, '..', 'exports')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def result_path(job_id, extension):
+        return os.path.join(JobService._results_dir(), f"{job_id}.{extension}")
+
+    @staticmethod
+    def purge_expired_results():
+        """Delete result files older than the result TTL; returns files removed"""
+        cutoff = time.time() - RESULT_TTL_SECONDS
+        removed = 0
+        with os.scandir(JobService._results_dir()) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+    @staticmethod
+    def enqueue_export(export_type, params, user_id):
+        """
+        Queue an export for the worker
+        Returns (job_id, error)
+        """
+        if export_type not in EXPORT_TYPES:
+            return None, f"Unknown export type: {export_type}"
+
+        JobService.purge_expired_results()
+        try:
+            job = JobService._queue().enqueue(
+                run_export_job,
+                export_type, params, user_id,
+                job_timeout=JOB_TIMEOUT_SECONDS,
+                result_ttl=RESULT_TTL_SECONDS,
+                failure_ttl=RESULT_TTL_SECONDS,
+                meta={'user_id': user_id, 'export_type': export_type}
+            )
+        except Exception as e:
+            return None, f"Background jobs unavailable: {e}"
+        return job.id, None
+
+    @staticmethod
+    def get_job(job_id, user):
+        """
+        Fetch a job the user may see (their own, or any for admins)
+        Returns job or None
+        """
+        try:
+            job = Job.fetch(job_id, connection=JobService._connection())
+        except NoSuchJobError:
+            return None
+        if user['role'] != 'admin' and job.meta.get('user_id') != user['user_id']:
+            return None
+        return job
+
+    @staticmethod
+    def job_status(job):
+        status = job.get_status(refresh=False)
+        data = {
+            'job_id': job.id,
+            'export_type': job.meta.get('export_type'),
+            'status': status.value if hasattr(status, 'value') else status,
+            'enqueued_at': job.enqueued_at.isoformat() if job.enqueued_at else None,
+            'ended_at': job.ended_at.isoformat() if job.ended_at else None,
+            'download_url': None,
+            'error': None
+        }
+        if data['status'] == 'finished':
+            data['download_url'] = f"/api/v1/exports/{job.id}/download"
+            data['stats'] = (job.return_value(refresh=False) or {}).get('stats')
+        elif data['status'] == 'failed':
+            result = job.latest_result()
+            lines = ((result and result.exc_string) or '').strip().splitlines()
+            data['error'] = lines[-1] if lines else 'Export failed'
+        return data
+
+    @staticmethod
+    def notify(user_id, job_id, export_type, error=None):
+        """In-app notification when an export finishes or fails"""
+        label = EXPORT_TYPES[export_type]['label']
+        if error:
+            notification = Notification(
+                user_id=user_id,
+                title='Export failed',
+                message=f"Your {label} export failed: {error}",
+                type='error',
+                entity_type='export'
+            )
+        else:
+            notification = Notification(
+                user_id=user_id,
+                title='Export ready',
+                message=f"Your {label} export is ready to download.",
+                type='success',
+                action_url=f"/api/v1/exports/{job_id}/download",
+                entity_type='export'
+            )
+        db.session.add(notification)
+        db.session.commit()
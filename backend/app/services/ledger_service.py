@@ -0,0 +1,217 @@
+"""
+Ledger service for the double-entry fee ledger and balance snapshots
+"""
+from decimal import Decimal
+from app import db
+from app.models.ledger_entry import LedgerEntry
+from app.models.balance_snapshot import BalanceSnapshot
+from app.services.time_service import TimeService
+
+# Snapshots stop this far behind "now" so entries still being committed
+# with an earlier posted_at are never left out of a snapshot
+SNAPSHOT_LAG_MS = 60 * 1000
+
+# (debit, credit) for each entry type; REVERSAL swaps the original's pair
+POSTING_RULES = {
+    'CHARGE': (LedgerEntry.RECEIVABLE, LedgerEntry.FEE_INCOME),
+    'LATE_FEE': (LedgerEntry.RECEIVABLE, LedgerEntry.LATE_FEE_INCOME),
+    'PAYMENT': (LedgerEntry.CASH, LedgerEntry.RECEIVABLE),
+}
+
+
+def _receivable_delta():
+    """SQL expression for LedgerEntry.receivable_delta"""
+    return db.case(
+        (LedgerEntry.debit_account == LedgerEntry.RECEIVABLE, LedgerEntry.amount),
+        (LedgerEntry.credit_account == LedgerEntry.RECEIVABLE, -LedgerEntry.amount),
+        else_=0
+    )
+
+
+class LedgerService:
+    """
+    Posting, point-in-time balances and statements
+    Posting methods only add to the session; callers commit with their own change.
+    """
+
+    @staticmethod
+    def _post(student_id, entry_type, amount, fee_id=None, transaction_id=None,
+              actor_id=None, memo=None, posted_at=None):
+        debit, credit = POSTING_RULES[entry_type]
+        entry = LedgerEntry(
+            student_id=student_id,
+            fee_id=fee_id,
+            transaction_id=transaction_id,
+            entry_type=entry_type,
+            debit_account=debit,
+            credit_account=credit,
+            amount=Decimal(str(amount)),
+            posted_at=posted_at or TimeService.now_ms(),
+            actor_id=actor_id,
+            memo=memo
+        )
+        db.session.add(entry)
+        return entry
+
+    @staticmethod
+    def post_charge(fee, actor_id=None, posted_at=None):
+        """Charge a fee's expected amount to the student"""
+        if not fee.expected_amount:
+            return None
+        return LedgerService._post(
+            fee.student_id, 'CHARGE', fee.expected_amount, fee_id=fee.id,
+            actor_id=actor_id, memo=f"Fee {fee.month:02d}/{fee.year}", posted_at=posted_at
+        )
+
+    @staticmethod
+    def post_late_fee(fee, amount, actor_id=None, posted_at=None):
+        """Charge a late fee against a fee"""
+        return LedgerService._post(
+            fee.student_id, 'LATE_FEE', amount, fee_id=fee.id,
+            actor_id=actor_id, memo=f"Late fee {fee.month:02d}/{fee.year}", posted_at=posted_at
+        )
+
+    @staticmethod
+    def post_payment(fee, trx, actor_id=None, posted_at=None):
+        """Record an approved transaction as a payment"""
+        return LedgerService._post(
+            fee.student_id, 'PAYMENT', trx.amount, fee_id=fee.id, transaction_id=trx.id,
+            actor_id=actor_id, memo=trx.transaction_reference, posted_at=posted_at
+        )
+
+    @staticmethod
+    def reverse(entry, actor_id=None, memo=None):
+        """
+        Post the mirror image of an entry
+        Returns (entry, error)
+        """
+        if entry.entry_type == 'REVERSAL':
+            return None, "Reversals cannot be reversed"
+        if LedgerEntry.query.filter_by(reverses_id=entry.id).first():
+            return None, "Entry already reversed"
+
+        reversal = LedgerEntry(
+            student_id=entry.student_id,
+            fee_id=entry.fee_id,
+            transaction_id=entry.transaction_id,
+            reverses_id=entry.id,
+            entry_type='REVERSAL',
+            debit_account=entry.credit_account,
+            credit_account=entry.debit_account,
+            amount=entry.amount,
+            posted_at=TimeService.now_ms(),
+            actor_id=actor_id,
+            memo=memo or f"Reversal of #{entry.id}"
+        )
+        db.session.add(reversal)
+        return reversal, None
+
+    @staticmethod
+    def reverse_payment(trx, actor_id=None, memo=None):
+        """Reverse the PAYMENT entry of a transaction, if it has one"""
+        entry = LedgerEntry.query.filter_by(transaction_id=trx.id, entry_type='PAYMENT').first()
+        if not entry:
+            return None, "No payment entry for transaction"
+        return LedgerService.reverse(entry, actor_id, memo)
+
+    @staticmethod
+    def balance_at(student_id, at_ms=None):
+        """
+        Amount the student owed at a moment (default now)
+        One snapshot lookup plus a scan of the entries posted after it
+        """
+        at_ms = at_ms or TimeService.now_ms()
+        snapshot = BalanceSnapshot.query.filter(
+            BalanceSnapshot.student_id == student_id,
+            BalanceSnapshot.as_of <= at_ms
+        ).order_by(BalanceSnapshot.as_of.desc()).first()
+
+        base = snapshot.balance if snapshot else Decimal('0')
+        since = snapshot.as_of if snapshot else -1
+
+        tail = db.session.query(db.func.coalesce(db.func.sum(_receivable_delta()), 0)).filter(
+            LedgerEntry.student_id == student_id,
+            LedgerEntry.posted_at > since,
+            LedgerEntry.posted_at <= at_ms
+        ).scalar()
+        return Decimal(str(base)) + Decimal(str(tail))
+
+    @staticmethod
+    def statement(student_id, from_ms, to_ms):
+        """
+        Opening balance, entries with running balance, closing balance
+        for entries posted in [from_ms, to_ms]
+        """
+        opening = LedgerService.balance_at(student_id, from_ms - 1)
+        entries = LedgerEntry.query.filter(
+            LedgerEntry.student_id == student_id,
+            LedgerEntry.posted_at >= from_ms,
+            LedgerEntry.posted_at <= to_ms
+        ).order_by(LedgerEntry.posted_at, LedgerEntry.id).all()
+
+        running = opening
+        lines = []
+        for entry in entries:
+            running += Decimal(str(entry.receivable_delta))
+            line = entry.to_dict()
+            line['balance'] = str(running)
+            lines.append(line)
+
+        return {
+            'student_id': student_id,
+            'from': from_ms,
+            'to': to_ms,
+            'opening_balance': str(opening),
+            'entries': lines,
+            'closing_balance': str(running)
+        }
+
+    @staticmethod
+    def take_snapshots(as_of=None):
+        """
+        Fold ledger entries since each student's last snapshot into a new one
+        Only students with new entries get a row. Returns snapshots written.
+        """
+        as_of = as_of or TimeService.now_ms() - SNAPSHOT_LAG_MS
+
+        latest_as_of = db.session.query(
+            BalanceSnapshot.student_id,
+            db.func.max(BalanceSnapshot.as_of).label('as_of')
+        ).filter(BalanceSnapshot.as_of <= as_of).group_by(BalanceSnapshot.student_id).subquery()
+
+        previous = {
+            student_id: (snap_as_of, balance)
+            for student_id, snap_as_of, balance in db.session.query(
+                BalanceSnapshot.student_id, BalanceSnapshot.as_of, BalanceSnapshot.balance
+            ).join(
+                latest_as_of,
+                db.and_(
+                    BalanceSnapshot.student_id == latest_as_of.c.student_id,
+                    BalanceSnapshot.as_of == latest_as_of.c.as_of
+                )
+            )
+        }
+
+        deltas = db.session.query(
+            LedgerEntry.student_id,
+            db.func.sum(_receivable_delta())
+        ).outerjoin(
+            latest_as_of, LedgerEntry.student_id == latest_as_of.c.student_id
+        ).filter(
+            LedgerEntry.posted_at <= as_of,
+            db.or_(latest_as_of.c.as_of.is_(None), LedgerEntry.posted_at > latest_as_of.c.as_of)
+        ).group_by(LedgerEntry.student_id)
+
+        rows = []
+        for student_id, delta in deltas:
+            base = previous.get(student_id, (None, 0))[1]
+            rows.append({
+                'student_id': student_id,
+                'as_of': as_of,
+                'balance': Decimal(str(base)) + Decimal(str(delta or 0))
+            })
+
+        if rows:
+            db.session.bulk_insert_mappings(BalanceSnapshot, rows)
+        db.session.commit()
+        return len(rows)
@@ -0,0 +1,580 @@
+"""
+Logical backup service
+Database-agnostic dumps of every model table, streamed into the encrypted
+backup format, and bulk restores of them (COPY on Postgres, executemany
+elsewhere)
+
+Archive layout (the plaintext inside the encrypted file), a sequence of
+frames of: type (1 byte) | payload length (4 bytes BE) | payload
+    M  manifest JSON: format, dialect, tables with their columns and kinds
+    T  table start JSON: name, columns
+    R  row batch: zlib-compressed JSON list of row lists
+    E  table end JSON: name, rows, sha256 of the uncompressed batches
+    D  deletions JSON (incremental archives): {table: [ids]}, before the
+       tables so a restore frees deleted rows' unique values first
+    Z  end of archive JSON: row count per table, id marks
+"""
+import base64
+import hashlib
+import io
+import json
+import struct
+import zlib
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from app import db
+# Imported so every model table is registered on db.metadata
+from app import models  # noqa: F401
+from app.models.backup_meta import BackupMeta
+from app.models.backup_run import BackupRun
+from app.models.deleted_row import DeletedRow
+from app.models.notification import Notification  # noqa: F401
+
+ARCHIVE_FORMAT = 'hostelix-logical'
+ARCHIVE_VERSION = 1
+# Rows per R frame, and per server-side cursor fetch
+ROW_BATCH = 2000
+# Ids per DELETE statement when replaying deletions
+DELETE_BATCH = 500
+# Tables that describe backups themselves and are never dumped or overwritten
+EXCLUDED_TABLES = {BackupMeta.__tablename__, BackupRun.__tablename__, DeletedRow.__tablename__}
+FRAME_HEADER = struct.Struct('>cI')
+
+
+class ArchiveError(Exception):
+    """Logical archive is malformed or does not match the database schema"""
+
+
+def _kind(column):
+    """Value encoding used for a column in the archive"""
+    sql_type = column.type
+    if isinstance(sql_type, db.Boolean):
+        return 'bool'
+    if isinstance(sql_type, db.Integer):
+        return 'int'
+    if isinstance(sql_type, db.Float):
+        return 'float'
+    if isinstance(sql_type, db.Numeric):
+        return 'decimal'
+    if isinstance(sql_type, db.DateTime):
+        return 'datetime'
+    if isinstance(sql_type, db.Date):
+        return 'date'
+    if isinstance(sql_type, db.JSON):
+        return 'json'
+    if isinstance(sql_type, db.LargeBinary):
+        return 'bytes'
+    return 'text'
+
+
+def _encode(kind, value):
+    if value is None:
+        return None
+    if kind == 'decimal':
+        return str(value)
+    if kind in ('date', 'datetime'):
+        return value.isoformat()
+    if kind == 'bytes':
+        return base64.b64encode(value).decode('ascii')
+    return value
+
+
+def _decode(kind, value):
+    if value is None:
+        return None
+    if kind == 'decimal':
+        return Decimal(value)
+    if kind == 'date':
+        return date.fromisoformat(value)
+    if kind == 'datetime':
+        return datetime.fromisoformat(value)
+    if kind == 'bytes':
+        return base64.b64decode(value)
+    return value
+
+
+def _copy_text(kind, value):
+    """One value in Postgres COPY text format"""
+    if value is None:
+        return '\\N'
+    if kind == 'bool':
+        return 't' if value else 'f'
+    if kind == 'json':
+        value = json.dumps(value)
+    elif kind == 'bytes':
+        value = '\\x' + base64.b64decode(value).hex()
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def write_frame(out, frame_type, payload):
+    out.write(FRAME_HEADER.pack(frame_type, len(payload)))
+    out.write(payload)
+
+
+def read_frame(reader):
+    """Returns (type, payload), or (None, None) at end of stream"""
+    head = reader.read(FRAME_HEADER.size)
+    if not head:
+        return None, None
+    if len(head) < FRAME_HEADER.size:
+        raise ArchiveError("Archive truncated inside a frame header")
+    frame_type, length = FRAME_HEADER.unpack(head)
+    payload = reader.read(length)
+    if len(payload) < length:
+        raise ArchiveError("Archive truncated inside a frame")
+    return frame_type, payload
+
+
+class LogicalBackupService:
+    """
+    Dumps read every table inside one snapshot (REPEATABLE READ on Postgres,
+    a single read transaction on SQLite) through server-side cursors, so a
+    dump is consistent across tables and holds one batch in memory.
+    """
+
+    @staticmethod
+    def tables():
+        """Tables to back up, parents before children"""
+        return [t for t in db.metadata.sorted_tables if t.name not in EXCLUDED_TABLES]
+
+    @staticmethod
+    def manifest(dialect):
+        return {
+            'format': ARCHIVE_FORMAT,
+            'version': ARCHIVE_VERSION,
+            'dialect': dialect,
+            'tables': [
+                {
+                    'name': table.name,
+                    'columns': [
+                        {'name': c.name, 'kind': _kind(c), 'nullable': c.nullable}
+                        for c in table.columns
+                    ],
+                    'primary_key': [c.name for c in table.primary_key.columns]
+                }
+                for table in LogicalBackupService.tables()
+            ]
+        }
+
+    @staticmethod
+    @contextmanager
+    def _snapshot_connection():
+        """Connection whose reads all see one consistent snapshot"""
+        engine = db.engine
+        if engine.dialect.name == 'sqlite':
+            with engine.connect() as conn:
+                raw = conn.connection.driver_connection
+                previous = raw.isolation_level
+                # Let the explicit BEGIN below hold one read transaction
+                raw.isolation_level = None
+                raw.execute('BEGIN')
+                try:
+                    yield conn
+                finally:
+                    raw.execute('COMMIT')
+                    raw.isolation_level = previous
+        else:
+            with engine.connect().execution_options(isolation_level='REPEATABLE READ') as conn:
+                with conn.begin():
+                    yield conn
+
+    @staticmethod
+    def is_append_only(table):
+        """Tables without updated_at are only ever inserted into"""
+        return 'updated_at' not in table.c
+
+    @staticmethod
+    def dump(out, since_ms=None, id_marks=None, meta=None, limiter=None):
+        """
+        Write a logical archive of the database to a file-like object
+        With since_ms the archive is incremental: rows whose updated_at (or
+        created_at) is at or after since_ms, rows of append-only tables
+        above id_marks[table], and the ids deleted since since_ms
+        meta is recorded in the manifest; limiter (a RateLimiter) is fed
+        the uncompressed size of every row batch
+        Returns {'tables': row count per table, 'id_marks': largest id per
+        append-only table, 'deletions': ids deleted}
+        """
+        manifest = LogicalBackupService.manifest(db.engine.dialect.name)
+        manifest.update(meta or {})
+        manifest['backup_type'] = 'full' if since_ms is None else 'incremental'
+        manifest['since_ms'] = since_ms
+        write_frame(out, b'M', json.dumps(manifest).encode('utf-8'))
+
+        id_marks = id_marks or {}
+        counts, marks, deletions = {}, {}, {}
+        with LogicalBackupService._snapshot_connection() as conn:
+            if since_ms is not None:
+                deletions = LogicalBackupService._deletions_since(conn, since_ms)
+                write_frame(out, b'D', json.dumps(deletions).encode('utf-8'))
+
+            for table in LogicalBackupService.tables():
+                pk = list(table.primary_key.columns)[0]
+                clause = None
+                if LogicalBackupService.is_append_only(table):
+                    marks[table.name] = conn.execute(db.select(db.func.max(pk))).scalar() or 0
+                    if since_ms is not None:
+                        clause = pk > id_marks.get(table.name, 0)
+                elif since_ms is not None:
+                    clause = db.func.coalesce(table.c.updated_at, table.c.created_at) >= since_ms
+                spec = next(t for t in manifest['tables'] if t['name'] == table.name)
+                counts[table.name] = LogicalBackupService._dump_table(conn, out, table, spec, clause, limiter)
+
+        write_frame(out, b'Z', json.dumps({'tables': counts, 'id_marks': marks}).encode('utf-8'))
+        return {
+            'tables': counts,
+            'id_marks': marks,
+            'deletions': sum(len(ids) for ids in deletions.values())
+        }
+
+    @staticmethod
+    def _deletions_since(conn, since_ms):
+        """
+        Ids deleted since since_ms, per table, leaving out ids that exist
+        again in the snapshot (SQLite can reuse the largest id)
+        """
+        log = DeletedRow.__table__
+        deletions = {}
+        for table in LogicalBackupService.tables():
+            pk = list(table.primary_key.columns)[0]
+            ids = conn.execute(
+                db.select(log.c.row_id).where(
+                    log.c.table_name == table.name,
+                    log.c.deleted_at >= since_ms,
+                    ~db.exists().where(pk == log.c.row_id)
+                ).distinct().order_by(log.c.row_id)
+            ).scalars().all()
+            if ids:
+                deletions[table.name] = ids
+        return deletions
+
+    @staticmethod
+    def _dump_table(conn, out, table, spec, clause=None, limiter=None):
+        kinds = [c['kind'] for c in spec['columns']]
+        write_frame(out, b'T', json.dumps({'name': table.name, 'columns': spec['columns']}).encode('utf-8'))
+
+        query = db.select(*[table.c[c['name']] for c in spec['columns']])
+        if clause is not None:
+            query = query.where(clause)
+        query = query.order_by(*table.primary_key.columns)
+        result = conn.execution_options(stream_results=True, yield_per=ROW_BATCH).execute(query)
+
+        digest = hashlib.sha256()
+        rows = 0
+        try:
+            for batch in result.partitions(ROW_BATCH):
+                payload = json.dumps(
+                    [[_encode(k, v) for k, v in zip(kinds, row)] for row in batch],
+                    separators=(',', ':')
+                ).encode('utf-8')
+                digest.update(payload)
+                if limiter:
+                    limiter.consume(len(payload))
+                write_frame(out, b'R', zlib.compress(payload, 6))
+                rows += len(batch)
+        finally:
+            result.close()
+
+        write_frame(out, b'E', json.dumps(
+            {'name': table.name, 'rows': rows, 'sha256': digest.hexdigest()}
+        ).encode('utf-8'))
+        return rows
+
+    @staticmethod
+    def iter_archive(reader, decode=True):
+        """
+        Walk an archive: yields ('manifest', dict), ('table', spec),
+        ('rows', list of decoded row lists), ('end', dict),
+        ('deletions', dict), ('done', dict)
+        Table counts and checksums are checked as each table ends
+        decode=False leaves row values as stored (JSON-safe), for callers
+        that only check the archive
+        """
+        frame_type, payload = read_frame(reader)
+        if frame_type != b'M':
+            raise ArchiveError("Archive does not start with a manifest")
+        manifest = json.loads(payload)
+        if manifest.get('format') != ARCHIVE_FORMAT:
+            raise ArchiveError("Not a logical backup archive")
+        if manifest.get('version', 0) > ARCHIVE_VERSION:
+            raise ArchiveError(f"Unsupported archive version {manifest['version']}")
+        yield 'manifest', manifest
+
+        spec, kinds, digest, rows = None, None, None, 0
+        while True:
+            frame_type, payload = read_frame(reader)
+            if frame_type is None:
+                raise ArchiveError("Archive ends without an end-of-archive frame")
+            if frame_type == b'T':
+                spec = json.loads(payload)
+                kinds = [c['kind'] for c in spec['columns']]
+                digest, rows = hashlib.sha256(), 0
+                yield 'table', spec
+            elif frame_type == b'R':
+                if spec is None:
+                    raise ArchiveError("Row batch outside of a table")
+                raw = zlib.decompress(payload)
+                digest.update(raw)
+                batch = json.loads(raw)
+                if decode:
+                    batch = [[_decode(k, v) for k, v in zip(kinds, row)] for row in batch]
+                rows += len(batch)
+                yield 'rows', batch
+            elif frame_type == b'E':
+                end = json.loads(payload)
+                if spec is None or end['name'] != spec['name']:
+                    raise ArchiveError("Table end without a matching start")
+                if end['rows'] != rows or end['sha256'] != digest.hexdigest():
+                    raise ArchiveError(f"Table {spec['name']} does not match its recorded count/checksum")
+                spec = None
+                yield 'end', end
+            elif frame_type == b'D':
+                if spec is not None:
+                    raise ArchiveError(f"Deletions inside table {spec['name']}")
+                yield 'deletions', json.loads(payload)
+            elif frame_type == b'Z':
+                if spec is not None:
+                    raise ArchiveError(f"Archive ends inside table {spec['name']}")
+                yield 'done', json.loads(payload)
+                return
+            else:
+                raise ArchiveError(f"Unknown frame type {frame_type!r}")
+
+    @staticmethod
+    def validate_schema(manifest, tables):
+        """Every archived table and column must exist in the target schema"""
+        by_name = {t.name: t for t in tables}
+        problems = []
+        for spec in manifest['tables']:
+            table = by_name.get(spec['name'])
+            if table is None:
+                problems.append(f"unknown table {spec['name']}")
+                continue
+            missing = [c['name'] for c in spec['columns'] if c['name'] not in table.c]
+            if missing:
+                problems.append(f"{spec['name']}: unknown columns {', '.join(missing)}")
+        if problems:
+            raise ArchiveError("Archive does not match the database schema: " + '; '.join(problems))
+
+    @staticmethod
+    def restore(reader, engine):
+        """
+        Load an archive into the database behind engine, in one transaction
+        A full archive empties the archived tables and bulk loads them; an
+        incremental one applies its deletions, then upserts its rows, so a
+        row reusing a deleted row's unique value (e.g. an email) fits
+        Returns row count per table
+        """
+        tables = {t.name: t for t in LogicalBackupService.tables()}
+        events = LogicalBackupService.iter_archive(reader)
+        _, manifest = next(events)
+        LogicalBackupService.validate_schema(manifest, tables.values())
+        incremental = manifest.get('backup_type') == 'incremental'
+        postgres = engine.dialect.name == 'postgresql'
+
+        counts = {}
+        pending = {}
+        with engine.begin() as conn:
+            detached = []
+            if not incremental:
+                detached = LogicalBackupService._detach_excluded(conn, tables)
+                for spec in reversed(manifest['tables']):
+                    conn.execute(tables[spec['name']].delete())
+
+            table, spec = None, None
+            for event, value in events:
+                if event == 'table':
+                    spec, table = value, tables[value['name']]
+                    counts[table.name] = 0
+                elif event == 'rows':
+                    if incremental:
+                        LogicalBackupService._upsert_rows(conn, table, spec, value)
+                    else:
+                        LogicalBackupService._load_rows(conn, table, spec, value)
+                    counts[table.name] += len(value)
+                elif event == 'deletions':
+                    if counts:
+                        # Archives written before deletions came first
+                        pending = value
+                    else:
+                        pending = LogicalBackupService._apply_deletions(conn, manifest, tables, value)
+
+            # What a foreign key held up: children re-pointed by the rows above
+            LogicalBackupService._apply_deletions(conn, manifest, tables, pending, strict=True)
+
+            if postgres:
+                LogicalBackupService._reset_sequences(conn, [tables[s['name']] for s in manifest['tables']])
+            LogicalBackupService._reattach_excluded(conn, detached)
+        return counts
+
+    @staticmethod
+    def _apply_deletions(conn, manifest, tables, deletions, strict=False):
+        """
+        Delete archived ids, children before parents
+        Unless strict, on Postgres a table whose delete a foreign key
+        refuses (a child that still points at the row until the archive's
+        rows re-point it) is rolled back to a savepoint and returned as
+        {table: [ids]} to retry after the rows. SQLite does not enforce
+        the keys here, and pysqlite savepoints would end the transaction.
+        """
+        held = {}
+        postgres = conn.engine.dialect.name == 'postgresql'
+        for spec in reversed(manifest['tables']):
+            table = tables[spec['name']]
+            ids = deletions.get(table.name, [])
+            if not ids:
+                continue
+            pk = list(table.primary_key.columns)[0]
+            savepoint = conn.begin_nested() if postgres and not strict else None
+            try:
+                for i in range(0, len(ids), DELETE_BATCH):
+                    conn.execute(table.delete().where(pk.in_(ids[i:i + DELETE_BATCH])))
+            except IntegrityError:
+                if savepoint is None:
+                    raise
+                savepoint.rollback()
+                held[table.name] = ids
+                continue
+            if savepoint:
+                savepoint.commit()
+        return held
+
+    @staticmethod
+    def copy_database(source_engine, conn, progress=None):
+        """
+        Replace every backed-up table behind conn with the rows of the
+        database behind source_engine (same schema), e.g. a staged restore.
+        Runs in conn's transaction; progress(fraction) is called per batch
+        Returns row count per table
+        """
+        tables = LogicalBackupService.tables()
+        specs = LogicalBackupService.manifest(source_engine.dialect.name)['tables']
+        counts = {}
+        with source_engine.connect() as source:
+            total = sum(
+                source.execute(db.select(db.func.count()).select_from(t)).scalar() for t in tables
+            ) or 1
+            detached = LogicalBackupService._detach_excluded(conn, {t.name: t for t in tables})
+            for table in reversed(tables):
+                conn.execute(table.delete())
+
+            done = 0
+            for table, spec in zip(tables, specs):
+                counts[table.name] = 0
+                query = db.select(*[table.c[c['name']] for c in spec['columns']]).order_by(
+                    *table.primary_key.columns
+                )
+                result = source.execution_options(stream_results=True, yield_per=ROW_BATCH).execute(query)
+                for batch in result.partitions(ROW_BATCH):
+                    LogicalBackupService._load_rows(conn, table, spec, [list(row) for row in batch])
+                    counts[table.name] += len(batch)
+                    done += len(batch)
+                    if progress:
+                        progress(done / total)
+
+        if conn.engine.dialect.name == 'postgresql':
+            LogicalBackupService._reset_sequences(conn, tables)
+        LogicalBackupService._reattach_excluded(conn, detached)
+        return counts
+
+    @staticmethod
+    def _load_rows(conn, table, spec, rows):
+        """Bulk insert decoded rows: COPY on Postgres, executemany elsewhere"""
+        if conn.engine.dialect.name == 'postgresql':
+            LogicalBackupService._copy_rows(conn, table, spec, rows)
+        else:
+            names = [c['name'] for c in spec['columns']]
+            conn.execute(table.insert(), [dict(zip(names, row)) for row in rows])
+
+    @staticmethod
+    def _upsert_rows(conn, table, spec, rows):
+        """Insert rows, overwriting existing ones with the same primary key"""
+        dialect = conn.engine.dialect.name
+        if dialect == 'postgresql':
+            stmt = postgresql.insert(table)
+        elif dialect == 'sqlite':
+            stmt = sqlite.insert(table)
+        else:
+            raise ArchiveError(f"Incremental restore is not supported on {dialect}")
+        pk = [c.name for c in table.primary_key.columns]
+        names = [c['name'] for c in spec['columns']]
+        updates = {name: stmt.excluded[name] for name in names if name not in pk}
+        if updates:
+            stmt = stmt.on_conflict_do_update(index_elements=pk, set_=updates)
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=pk)
+        conn.execute(stmt, [dict(zip(names, row)) for row in rows])
+
+    @staticmethod
+    def _copy_rows(conn, table, spec, rows):
+        kinds = [c['kind'] for c in spec['columns']]
+        buffer = io.StringIO()
+        for row in rows:
+            # Values were decoded for executemany; COPY wants their archive encoding back
+            buffer.write('\t'.join(_copy_text(k, _encode(k, v)) for k, v in zip(kinds, row)))
+            buffer.write('\n')
+        buffer.seek(0)
+        columns = ', '.join(f'"{c["name"]}"' for c in spec['columns'])
+        sql = f'COPY "{table.name}" ({columns}) FROM STDIN'
+        cursor = conn.connection.driver_connection.cursor()
+        try:
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2
+                cursor.copy_expert(sql, buffer)
+            else:
+                # psycopg 3
+                with cursor.copy(sql) as copy:
+                    copy.write(buffer.getvalue())
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _reset_sequences(conn, tables):
+        """Point each serial id sequence past the restored ids"""
+        for table in tables:
+            pk = list(table.primary_key.columns)
+            if len(pk) != 1 or not isinstance(pk[0].type, db.Integer):
+                continue
+            conn.exec_driver_sql(
+                f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', '{pk[0].name}'), "
+                f"COALESCE(MAX(\"{pk[0].name}\"), 1), MAX(\"{pk[0].name}\") IS NOT NULL) FROM \"{table.name}\""
+            )
+
+    @staticmethod
+    def _detach_excluded(conn, tables):
+        """
+        Null out references from excluded tables (e.g. backups.created_by_id)
+        into restored tables so the restored rows can be replaced
+        Returns [(table, fk column, {pk: value})] for _reattach_excluded
+        """
+        detached = []
+        for table in db.metadata.sorted_tables:
+            if table.name not in EXCLUDED_TABLES:
+                continue
+            pk = list(table.primary_key.columns)[0]
+            for fk in table.foreign_keys:
+                if fk.column.table.name not in tables:
+                    continue
+                column = fk.parent
+                values = dict(conn.execute(db.select(pk, column).where(column.isnot(None))).all())
+                if values:
+                    conn.execute(table.update().values({column.name: None}))
+                    detached.append((table, column, fk.column, values))
+        return detached
+
+    @staticmethod
+    def _reattach_excluded(conn, detached):
+        """Restore detached references whose target row exists after the restore"""
+        for table, column, target, values in detached:
+            existing = set(conn.execute(
+                db.select(target).where(target.in_(set(values.values())))
+            ).scalars())
+            pk = list(table.primary_key.columns)[0]
+            for row_id, value in values.items():
+                if value in existing:
+                    conn.execute(table.update().where(pk == row_id).values({column.name: value}))
@@ -0,0 +1,126 @@
+"""
+Maintenance mode
+While it is on, the API answers 503 (apart from the endpoints that report
+on the maintenance itself) so a restore can replace the database
+"""
+import json
+import os
+import socket
+import threading
+import time
+from app.services.job_service import JobService
+
+MAINTENANCE_KEY = 'hostelix:maintenance'
+INFLIGHT_KEY = 'hostelix:maintenance:inflight'
+# How often each web process re-reads the flag (and reports its requests)
+CHECK_INTERVAL_SECONDS = 1.0
+# How long a restore waits for in-flight requests to finish
+DRAIN_TIMEOUT_SECONDS = int(os.getenv('MAINTENANCE_DRAIN_TIMEOUT_SECONDS', 30))
+# Endpoints still served during maintenance
+EXEMPT_ENDPOINTS = {'health_check', 'backups.restore_status'}
+
+
+class MaintenanceService:
+    """
+    The flag lives in Redis so every web process and the worker share it.
+    Each web process runs a watcher thread that re-reads the flag once per
+    CHECK_INTERVAL_SECONDS, so requests only read memory, and while the
+    flag is on publishes how many requests it still has in flight; drain()
+    waits for those counts to reach zero.
+    """
+
+    _active = None
+    _inflight = 0
+    _lock = threading.Lock()
+    _watcher_pid = None
+
+    @staticmethod
+    def _process_key():
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    @staticmethod
+    def enable(reason, ttl_seconds, **details):
+        """
+        Turn maintenance on for at most ttl_seconds (so a crashed restore
+        cannot leave the API down)
+        """
+        status = dict(details, reason=reason, since=int(time.time() * 1000))
+        connection = JobService._connection()
+        connection.delete(INFLIGHT_KEY)
+        connection.set(MAINTENANCE_KEY, json.dumps(status), ex=ttl_seconds)
+        return status
+
+    @staticmethod
+    def disable():
+        connection = JobService._connection()
+        connection.delete(MAINTENANCE_KEY)
+        connection.delete(INFLIGHT_KEY)
+
+    @staticmethod
+    def status():
+        """Current maintenance status read from Redis, or None"""
+        raw = JobService._connection().get(MAINTENANCE_KEY)
+        return json.loads(raw) if raw else None
+
+    @staticmethod
+    def drain(timeout=DRAIN_TIMEOUT_SECONDS):
+        """
+        Wait until no web process has a request in flight
+        Returns the number of requests still running when the timeout hit
+        (0 once drained)
+        """
+        # By then every watcher has seen the flag and reported its count
+        time.sleep(CHECK_INTERVAL_SECONDS * 2)
+        connection = JobService._connection()
+        deadline = time.monotonic() + timeout
+        while True:
+            busy = sum(int(v) for v in connection.hgetall(INFLIGHT_KEY).values())
+            if busy == 0 or time.monotonic() >= deadline:
+                return busy
+            time.sleep(0.2)
+
+    @staticmethod
+    def _ensure_watcher():
+        # Started per process, after any fork by the app server
+        if MaintenanceService._watcher_pid == os.getpid():
+            return
+        with MaintenanceService._lock:
+            if MaintenanceService._watcher_pid == os.getpid():
+                return
+            MaintenanceService._watcher_pid = os.getpid()
+            threading.Thread(target=MaintenanceService._watch, daemon=True).start()
+
+    @staticmethod
+    def _watch():
+        process_key = MaintenanceService._process_key()
+        while True:
+            try:
+                status = MaintenanceService.status()
+                if status:
+                    connection = JobService._connection()
+                    connection.hset(INFLIGHT_KEY, process_key, MaintenanceService._inflight)
+                    connection.expire(INFLIGHT_KEY, DRAIN_TIMEOUT_SECONDS * 2)
+            except Exception:
+                # Redis is down, so no restore can be running
+                status = None
+            MaintenanceService._active = status
+            time.sleep(CHECK_INTERVAL_SECONDS)
+
+    @staticmethod
+    def request_started(endpoint):
+        """
+        Count a request in; returns the maintenance status if it must be
+        turned away, else None
+        """
+        MaintenanceService._ensure_watcher()
+        with MaintenanceService._lock:
+            MaintenanceService._inflight += 1
+        status = MaintenanceService._active
+        if status and endpoint not in EXEMPT_ENDPOINTS:
+            return status
+        return None
+
+    @staticmethod
+    def request_finished():
+        with MaintenanceService._lock:
+            MaintenanceService._inflight -= 1
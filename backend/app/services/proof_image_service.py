@@ -0,0 +1,223 @@
+"""
+Proof image service
+Derives two images from every uploaded proof on the background worker: a
+small thumbnail for list views and a display copy bounded in size, both
+upright (EXIF orientation applied) and re-encoded without EXIF, so camera
+metadata such as location is not served with them. The original blob is
+kept as uploaded, and is all a backup holds: derived images missing on
+disk (after a restore onto another host) are made again. Only admins are
+given the original's URL; everyone else gets the display image.
+"""
+import os
+import tempfile
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+from app import db
+from app.models.proof_blob import ProofBlob
+from app.services.job_service import JobService, RESULT_TTL_SECONDS
+from app.services.proof_storage_service import ProofStorageService
+from app.utils.files import replace_readable
+
+# Longest side of each derived image, in pixels, and its encoder quality
+THUMBNAIL_MAX_PX = int(os.getenv('PROOF_THUMBNAIL_MAX_PX', 320))
+THUMBNAIL_QUALITY = 70
+DISPLAY_MAX_PX = int(os.getenv('PROOF_DISPLAY_MAX_PX', 2048))
+DISPLAY_QUALITY = 85
+# Larger sources are refused rather than decoded (a 50 MP image is ~150 MB in memory)
+MAX_SOURCE_PIXELS = 50_000_000
+JOB_TIMEOUT_SECONDS = 5 * 60
+
+
+def run_proof_image_job(blob_id):
+    """
+    rq entry point: derive a proof's images
+    Runs inside the worker's app context (see worker.py)
+    """
+    return ProofImageService.process(db.session.get(ProofBlob, blob_id))
+
+
+def _output_format():
+    """WebP where Pillow was built with it, JPEG otherwise"""
+    return ('WEBP', '.webp') if features.check('webp') else ('JPEG', '.jpg')
+
+
+def _save(image, path, image_format, quality):
+    """Encode image to path atomically; no EXIF is passed on, only the colour profile"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            options = {'quality': quality, 'icc_profile': image.info.get('icc_profile')}
+            if image_format == 'JPEG':
+                options.update(optimize=True, progressive=True)
+            else:
+                options['method'] = 4
+            image.save(f, image_format, **options)
+        replace_readable(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class ProofImageService:
+    @staticmethod
+    def enqueue(blob):
+        """
+        Queue a blob's images for the worker
+        Without Redis the blob stays pending for scripts/process_proof_images.py
+        Returns the job id, or None if the queue is unavailable
+        """
+        try:
+            job = JobService._queue().enqueue(
+                run_proof_image_job,
+                blob.id,
+                job_timeout=JOB_TIMEOUT_SECONDS,
+                result_ttl=RESULT_TTL_SECONDS,
+                failure_ttl=RESULT_TTL_SECONDS
+            )
+        except Exception:
+            return None
+        return job.id
+
+    @staticmethod
+    def derived_file(blob, kind):
+        return os.path.join(ProofStorageService.proof_dir(), *blob.derived_relative_path(kind).split('/'))
+
+    @staticmethod
+    def has_images(blob):
+        """Whether a ready blob's thumbnail and display image are on disk"""
+        return all(os.path.isfile(ProofImageService.derived_file(blob, kind)) for kind in ('thumb', 'display'))
+
+    @staticmethod
+    def reset_missing():
+        """
+        Mark ready blobs whose derived images are not on disk pending again
+        Returns the blobs reset
+        """
+        blobs = [blob for blob in ProofBlob.query.filter_by(image_status='ready')
+                 if not ProofImageService.has_images(blob)]
+        for blob in blobs:
+            blob.image_status = 'pending'
+        db.session.commit()
+        return blobs
+
+    @staticmethod
+    def process(blob):
+        """
+        Write a blob's thumbnail and display image and mark it ready, or
+        mark it unsupported if it is not an image Pillow can read
+        Returns the blob's image_status
+        """
+        source = ProofStorageService.blob_file(blob)
+        image_format, extension = _output_format()
+        try:
+            with Image.open(source) as image:
+                if image.width * image.height > MAX_SOURCE_PIXELS:
+                    raise UnidentifiedImageError(f"{image.width}x{image.height} is too large")
+                # JPEG decodes straight to a reduced scale no smaller than needed
+                image.draft('RGB', (DISPLAY_MAX_PX, DISPLAY_MAX_PX))
+                display = ImageOps.exif_transpose(image)
+                display = ProofImageService._flatten(display, image_format)
+                display.thumbnail((DISPLAY_MAX_PX, DISPLAY_MAX_PX), Image.Resampling.LANCZOS)
+        except FileNotFoundError:
+            # Left pending: the file may yet be restored
+            raise
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+            blob.image_status = 'unsupported'
+            db.session.commit()
+            return blob.image_status
+
+        thumbnail = display.copy()
+        thumbnail.thumbnail((THUMBNAIL_MAX_PX, THUMBNAIL_MAX_PX), Image.Resampling.LANCZOS)
+        blob.image_extension = extension
+        _save(display, ProofImageService.derived_file(blob, 'display'), image_format, DISPLAY_QUALITY)
+        _save(thumbnail, ProofImageService.derived_file(blob, 'thumb'), image_format, THUMBNAIL_QUALITY)
+        blob.image_status = 'ready'
+        db.session.commit()
+        return blob.image_status
+
+    @staticmethod
+    def _flatten(image, image_format):
+        """8-bit RGB (RGBA for WebP), transparency on white for JPEG"""
+        icc_profile = image.info.get('icc_profile')
+        if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            if image_format == 'JPEG':
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        if icc_profile:
+            image.info['icc_profile'] = icc_profile
+        return image
+
+    @staticmethod
+    def images_for(proof_paths):
+        """
+        {proof_path: ProofBlob} for the given paths whose images are ready
+        and on disk, in one query
+        """
+        shas = {}
+        for proof_path in proof_paths:
+            sha256 = ProofStorageService.sha256_from_path(proof_path)
+            if sha256:
+                shas[sha256] = proof_path
+        if not shas:
+            return {}
+        blobs = ProofBlob.query.filter(ProofBlob.sha256.in_(shas), ProofBlob.image_status == 'ready')
+        return {shas[blob.sha256]: blob for blob in blobs if ProofImageService.has_images(blob)}
+
+    @staticmethod
+    def viewable_for(proof_paths):
+        """
+        {proof_path: URL to show in place of the original} for users who may
+        not see originals: the display image once ready, the original only
+        where it is not an image (nothing to strip), else None
+        """
+        shas = {}
+        for proof_path in proof_paths:
+            sha256 = ProofStorageService.sha256_from_path(proof_path)
+            if sha256:
+                shas[sha256] = proof_path
+        viewable = dict.fromkeys(proof_paths)
+        if not shas:
+            return viewable
+        for blob in ProofBlob.query.filter(ProofBlob.sha256.in_(shas)):
+            if blob.image_status == 'unsupported':
+                viewable[shas[blob.sha256]] = shas[blob.sha256]
+            elif blob.image_status == 'ready' and ProofImageService.has_images(blob):
+                viewable[shas[blob.sha256]] = blob.display_path
+        return viewable
+
+    @staticmethod
+    def attach(items, originals=True):
+        """
+        Add image URLs to serialized fees and transactions: proof_thumbnail
+        and proof_display_path for proof_path, pending_proof_thumbnails
+        alongside pending_proofs (None where there is no image yet)
+        Uploads keep their EXIF (e.g. location), so without originals the
+        proof paths themselves are replaced (see viewable_for)
+        Returns items
+        """
+        paths = set()
+        for item in items:
+            paths.update(item.get('pending_proofs') or [])
+            if item.get('proof_path'):
+                paths.add(item['proof_path'])
+        blobs = ProofImageService.images_for(paths)
+        viewable = None if originals else ProofImageService.viewable_for(paths)
+        for item in items:
+            if 'proof_path' in item:
+                blob = blobs.get(item['proof_path'])
+                item['proof_thumbnail'] = blob.thumbnail_path if blob else None
+                item['proof_display_path'] = blob.display_path if blob else None
+                if viewable is not None and item['proof_path']:
+                    item['proof_path'] = viewable[item['proof_path']]
+            if 'pending_proofs' in item:
+                item['pending_proof_thumbnails'] = [
+                    blobs[p].thumbnail_path if p in blobs else None for p in item['pending_proofs']
+                ]
+                if viewable is not None:
+                    item['pending_proofs'] = [viewable[p] for p in item['pending_proofs']]
+        return items
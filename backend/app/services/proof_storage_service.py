@@ -0,0 +1,178 @@
+"""
+Proof storage service
+Payment proofs are stored by content: the SHA-256 of an upload, computed
+as it streams in, names its file, so identical uploads share one file and
+a duplicate is answered with the existing path without writing anything.
+transaction_proofs records which blob each transaction's proof is.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models.fee import Fee
+from app.models.proof_blob import PROOF_URL_PREFIX, ProofBlob, TransactionProof
+from app.models.transaction import Transaction
+from app.utils.files import replace_readable
+
+# Upload bytes hashed, and copied, per read
+READ_BYTES = 1024 * 1024
+_EXTENSION = re.compile(r'^\.[a-z0-9]{1,9}$')
+_BLOB_PATH = re.compile(re.escape(PROOF_URL_PREFIX) + r'([0-9a-f]{2})/([0-9a-f]{64})(\.[a-z0-9]{1,9})?$')
+
+
+def _extension(filename):
+    extension = os.path.splitext(filename or '')[1].lower()
+    return extension if _EXTENSION.match(extension) else ''
+
+
+def _sha256(fileobj):
+    """(sha256 hex digest, size) of the rest of a file object"""
+    digest = hashlib.sha256()
+    size = 0
+    for data in iter(lambda: fileobj.read(READ_BYTES), b''):
+        digest.update(data)
+        size += len(data)
+    return digest.hexdigest(), size
+
+
+class ProofStorageService:
+    @staticmethod
+    def proof_dir():
+        return os.path.join(current_app.root_path, 'static', 'uploads', 'proofs')
+
+    @staticmethod
+    def blob_file(blob):
+        return os.path.join(ProofStorageService.proof_dir(), *blob.relative_path.split('/'))
+
+    @staticmethod
+    def sha256_from_path(proof_path):
+        """The content hash a content-addressed proof path names, or None for any other path"""
+        match = _BLOB_PATH.match(proof_path or '')
+        if not match or match.group(2)[:2] != match.group(1):
+            return None
+        return match.group(2)
+
+    @staticmethod
+    def store(stream, filename):
+        """
+        Store an uploaded proof unless identical content is already stored
+        The upload is hashed first (Werkzeug has already spooled it), so a
+        duplicate writes nothing; new content is copied to a temporary file
+        and renamed into place
+        Returns (ProofBlob, created)
+        """
+        sha256, size = _sha256(stream)
+        blob = ProofBlob.query.filter_by(sha256=sha256).first()
+        if blob and os.path.exists(ProofStorageService.blob_file(blob)):
+            return blob, False
+
+        candidate = blob or ProofBlob(sha256=sha256, size_bytes=size, extension=_extension(filename))
+        path = ProofStorageService.blob_file(candidate)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        stream.seek(0)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in iter(lambda: stream.read(READ_BYTES), b''):
+                    f.write(data)
+            replace_readable(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if blob:
+            # The row outlived its file; the file is back
+            return blob, False
+
+        db.session.add(candidate)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # The same content was uploaded concurrently; its file is the one just written
+            db.session.rollback()
+            return ProofBlob.query.filter_by(sha256=sha256).one(), False
+        return candidate, True
+
+    @staticmethod
+    def link(transaction, proof_path):
+        """
+        Record the blob a new transaction's proof is, if proof_path names
+        one; the caller commits
+        """
+        sha256 = ProofStorageService.sha256_from_path(proof_path)
+        blob = ProofBlob.query.filter_by(sha256=sha256).first() if sha256 else None
+        if blob:
+            db.session.add(TransactionProof(transaction=transaction, blob=blob))
+        return blob
+
+    @staticmethod
+    def adopt_legacy(dry_run=False):
+        """
+        Move the proofs saved as <uuid4>_<name> to content-addressed blobs:
+        every referenced file becomes (or joins) a blob, the transactions
+        and fees pointing at it are rewritten to the blob's path and linked,
+        and the old file is removed once that is committed
+        Returns a summary: files, blobs_created, rows_updated, missing, bytes_freed
+        """
+        proof_dir = ProofStorageService.proof_dir()
+        paths = set()
+        for column in (Transaction.proof_path, Fee.proof_path):
+            paths.update(value for (value,) in db.session.query(column).filter(column.isnot(None)).distinct())
+        pending = Fee.query.filter(Fee.pending_count > 0).all()
+        for fee in pending:
+            paths.update(fee.pending_proofs or [])
+
+        renamed, missing, originals = {}, [], []
+        blobs_created = 0
+        for proof_path in sorted(paths):
+            if ProofStorageService.sha256_from_path(proof_path) or not proof_path.startswith(PROOF_URL_PREFIX):
+                continue
+            name = proof_path[len(PROOF_URL_PREFIX):]
+            file_path = os.path.join(proof_dir, name)
+            if '/' in name or os.sep in name or not os.path.isfile(file_path):
+                missing.append(proof_path)
+                continue
+            if dry_run:
+                renamed[proof_path] = None
+                continue
+            with open(file_path, 'rb') as f:
+                blob, created = ProofStorageService.store(f, name)
+            blobs_created += created
+            renamed[proof_path] = blob.path
+            originals.append(file_path)
+
+        rows = 0
+        if not dry_run and renamed:
+            now = int(time.time() * 1000)
+            for old, new in renamed.items():
+                for model in (Transaction, Fee):
+                    rows += model.query.filter(model.proof_path == old).update(
+                        {'proof_path': new, 'updated_at': now}, synchronize_session=False
+                    )
+            for fee in pending:
+                proofs = [renamed.get(p) or p for p in fee.pending_proofs or []]
+                if proofs != fee.pending_proofs:
+                    fee.pending_proofs = proofs
+                    fee.updated_at = now
+            linked = {t for (t,) in db.session.query(TransactionProof.transaction_id)}
+            for trx in Transaction.query.filter(Transaction.proof_path.in_(set(renamed.values()))):
+                if trx.id not in linked:
+                    ProofStorageService.link(trx, trx.proof_path)
+            db.session.commit()
+
+        # Only once no row points at them any more
+        freed = 0
+        for file_path in originals:
+            freed += os.path.getsize(file_path)
+            os.remove(file_path)
+        return {
+            'files': len(renamed),
+            'blobs_created': blobs_created,
+            'rows_updated': rows,
+            'missing': missing,
+            'bytes_freed': freed
+        }
@@ -0,0 +1,149 @@
+"""
+Receipt service
+Payment receipts are rendered once, in the background after approval,
+and kept on disk by transaction id and the version of what they show
+"""
+import glob
+import hashlib
+import os
+import tempfile
+from flask import current_app
+from app.services.export_service import ExportService, render_receipt
+from app.services.job_service import JobService
+from app.utils.files import replace_readable
+
+# Worst-case time to render the receipts of one approval batch
+RECEIPT_JOB_TIMEOUT_SECONDS = 10 * 60
+
+
+def render_receipts_job(transaction_ids):
+    """rq entry point: pre-render receipts for newly approved transactions"""
+    rendered = 0
+    for transaction_id in transaction_ids:
+        path, _ = ReceiptService.render(transaction_id)
+        if path:
+            rendered += 1
+    return rendered
+
+
+class ReceiptService:
+    """
+    A receipt's PDF lives at <receipts dir>/<transaction id>_<key>.pdf, the
+    key hashing the approval and the version of the rows it shows (as the
+    document cache keys challans). Downloads serve that file and render it
+    on demand if the background job has not run yet (or Redis was
+    unavailable), so approval never waits on ReportLab. A file left by
+    another row under the same id (a restore, or SQLite reusing a deleted
+    row's id) has another key and is never served.
+    """
+
+    @staticmethod
+    def _receipts_dir():
+        """Get receipts directory, create if not exists"""
+        path = os.getenv('RECEIPTS_DIR') or os.path.join(current_app.root_path, '..', 'receipts')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def key(data):
+        """Hash of what a receipt was rendered from (see ExportService.receipt_data)"""
+        raw = f"{data['transaction_id']}:{data['approved_at']}:{data['version']}"
+        return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def receipt_path(transaction_id, data):
+        return os.path.join(ReceiptService._receipts_dir(), f"{int(transaction_id)}_{ReceiptService.key(data)}.pdf")
+
+    @staticmethod
+    def _stored(transaction_id):
+        """Every receipt file kept for a transaction id, whatever its key (or none, as once named)"""
+        receipts_dir = ReceiptService._receipts_dir()
+        paths = glob.glob(os.path.join(receipts_dir, f"{int(transaction_id)}_*.pdf"))
+        legacy = os.path.join(receipts_dir, f"{int(transaction_id)}.pdf")
+        return paths + [legacy] if os.path.exists(legacy) else paths
+
+    @staticmethod
+    def render(transaction_id, data=None):
+        """
+        Render and store a transaction's receipt
+        Returns (path, error)
+        """
+        data = data or ExportService.receipt_data(transaction_id)
+        if not data:
+            return None, "Transaction not found"
+        if data['status'] != 'APPROVED':
+            return None, "Receipts are only available for approved transactions"
+
+        path = ReceiptService.receipt_path(transaction_id, data)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(render_receipt(data))
+            replace_readable(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # Older renders of this id no longer match what it shows
+        for stale in ReceiptService._stored(transaction_id):
+            if stale != path:
+                ReceiptService._remove(stale)
+        return path, None
+
+    @staticmethod
+    def get_receipt(transaction_id, data):
+        """
+        Stored receipt of an approved transaction, rendered now if missing
+        Returns (path, error)
+        """
+        if data['status'] != 'APPROVED':
+            return None, "Receipts are only available for approved transactions"
+        path = ReceiptService.receipt_path(transaction_id, data)
+        if os.path.exists(path):
+            return path, None
+        return ReceiptService.render(transaction_id, data)
+
+    @staticmethod
+    def enqueue_render(transaction_ids):
+        """
+        Queue receipt rendering; never fails the caller, since downloads
+        fall back to rendering on demand
+        """
+        if not transaction_ids:
+            return None
+        try:
+            job = JobService._queue().enqueue(
+                render_receipts_job,
+                list(transaction_ids),
+                job_timeout=RECEIPT_JOB_TIMEOUT_SECONDS,
+                result_ttl=0
+            )
+        except Exception as e:
+            current_app.logger.warning(f"Could not queue receipt rendering: {e}")
+            return None
+        return job.id
+
+    @staticmethod
+    def discard(transaction_id):
+        """Delete a transaction's stored receipts, e.g. when its payment is taken back"""
+        for path in ReceiptService._stored(transaction_id):
+            ReceiptService._remove(path)
+
+    @staticmethod
+    def clear():
+        """
+        Delete every stored receipt, e.g. after a restore, when ids may
+        name other rows; they are rendered again on download
+        Returns files removed
+        """
+        paths = glob.glob(os.path.join(ReceiptService._receipts_dir(), '*.pdf'))
+        for path in paths:
+            ReceiptService._remove(path)
+        return len(paths)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
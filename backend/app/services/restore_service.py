@@ -0,0 +1,375 @@
+"""
+Restore service
+Restores a backup chain over the live database while the app is running.
+The chain is decrypted into a staging SQLite file and checked there first;
+only the final swap runs in maintenance mode. Progress is kept in the rq
+job's meta so the API can report it.
+"""
+import base64
+import hashlib
+import os
+import sqlite3
+import time
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from flask import current_app
+from sqlalchemy import create_engine, inspect
+from app import db
+from app.models.audit_log import AuditLog
+from app.models.backup_meta import BackupMeta
+from app.models.backup_run import BackupRun
+from app.models.deleted_row import DeletedRow
+from app.models.user import User
+from app.services.backup_service import BackupService
+from app.services.document_cache_service import DocumentCacheService
+from app.services.job_service import JobService, RESULT_TTL_SECONDS
+from app.services.logical_backup_service import LogicalBackupService, EXCLUDED_TABLES
+from app.services.maintenance_service import MaintenanceService, DRAIN_TIMEOUT_SECONDS
+from app.services.proof_image_service import ProofImageService
+from app.services.receipt_service import ReceiptService
+from app.services.time_service import TimeService
+from app.utils.encryption import BackupEncryption, BackupFormatError
+
+# Worst-case restore time before rq kills the job; also caps how long the
+# restore lock and maintenance mode can outlive a crashed worker
+RESTORE_JOB_TIMEOUT_SECONDS = 2 * 60 * 60
+RESTORE_LOCK_KEY = 'hostelix:restore:lock'
+# Database pages SQLite's online backup copies between progress reports
+SWAP_PAGES_PER_STEP = 1024
+# Phases in order, with their share of the overall percentage
+PHASES = (
+    ('staging', 60),
+    ('validating', 5),
+    ('draining', 5),
+    ('swapping', 28),
+    ('finishing', 2),
+)
+# Progress is saved to Redis at most this often
+PROGRESS_INTERVAL_SECONDS = 0.5
+
+
+def run_restore_job(backup_id, sealed_key, user_id):
+    """
+    rq entry point: restore a backup chain over the live database
+    Runs inside the worker's app context (see worker.py)
+    """
+    from rq import get_current_job
+    progress = _Progress(get_current_job())
+    try:
+        key = BackupEncryption.key_from_string(RestoreService._unseal_key(sealed_key))
+        return RestoreService.restore(backup_id, key, user_id, progress)
+    except Exception as e:
+        progress.update('failed', message=str(e), force=True)
+        raise
+    finally:
+        JobService._connection().delete(RESTORE_LOCK_KEY)
+
+
+class _Progress:
+    """Overall restore progress, written to the job's meta"""
+
+    def __init__(self, job):
+        self._job = job
+        self._saved_at = 0
+        self._percent = 0.0
+        self._ranges = {}
+        start = 0
+        for phase, share in PHASES:
+            self._ranges[phase] = (start, share)
+            start += share
+
+    def update(self, phase, fraction=0.0, message=None, force=False):
+        if phase == 'done':
+            self._percent = 100.0
+        elif phase in self._ranges:
+            start, share = self._ranges[phase]
+            self._percent = start + share * min(max(fraction, 0.0), 1.0)
+
+        now = time.monotonic()
+        if self._job is None or (not force and message is None and now - self._saved_at < PROGRESS_INTERVAL_SECONDS):
+            return
+        self._saved_at = now
+        previous = self._job.meta.get('progress') or {}
+        self._job.meta['progress'] = {
+            'phase': phase,
+            'percent': round(self._percent, 1),
+            'message': message if message is not None else previous.get('message')
+        }
+        self._job.save_meta()
+
+    def phase(self, phase):
+        """progress(fraction) callback for one phase"""
+        return lambda fraction: self.update(phase, fraction)
+
+
+class RestoreService:
+    """
+    Queue restores and run them on the worker
+    Only one restore runs at a time (a Redis lock). The key travels to the
+    worker sealed with the app's SECRET_KEY, so it is not stored in Redis
+    in the clear.
+    """
+
+    @staticmethod
+    def _sealing_key():
+        return hashlib.sha256(current_app.config['SECRET_KEY'].encode()).digest()
+
+    @staticmethod
+    def _seal_key(key_str):
+        nonce = os.urandom(12)
+        sealed = AESGCM(RestoreService._sealing_key()).encrypt(nonce, key_str.encode(), b'backup-restore')
+        return base64.urlsafe_b64encode(nonce + sealed).decode()
+
+    @staticmethod
+    def _unseal_key(sealed_str):
+        sealed = base64.urlsafe_b64decode(sealed_str)
+        return AESGCM(RestoreService._sealing_key()).decrypt(sealed[:12], sealed[12:], b'backup-restore').decode()
+
+    @staticmethod
+    def start(backup_id, key_str, user_id):
+        """
+        Check a restore can run, then queue it for the worker
+        Returns (job_id, error)
+        """
+        backup = db.session.get(BackupMeta, backup_id)
+        if not backup:
+            return None, "Backup not found"
+        chain = BackupService.get_chain(backup)
+        missing = BackupService._missing_files(chain)
+        if missing:
+            return None, f"Backup file missing from disk for backup(s) {missing}"
+        try:
+            key = BackupEncryption.key_from_string(key_str)
+            root_path = os.path.join(BackupService._get_backup_dir(), chain[0].filename)
+            next(BackupEncryption.iter_plaintext(root_path, key))
+        except (ValueError, BackupFormatError):
+            return None, "Key does not match the backup"
+
+        try:
+            connection = JobService._connection()
+            if not connection.set(RESTORE_LOCK_KEY, 'queued', nx=True, ex=RESTORE_JOB_TIMEOUT_SECONDS):
+                return None, "A restore is already in progress"
+            job = JobService._queue().enqueue(
+                run_restore_job,
+                backup_id, RestoreService._seal_key(key_str), user_id,
+                job_timeout=RESTORE_JOB_TIMEOUT_SECONDS,
+                result_ttl=RESULT_TTL_SECONDS,
+                failure_ttl=RESULT_TTL_SECONDS,
+                meta={
+                    'user_id': user_id,
+                    'backup_id': backup_id,
+                    'progress': {'phase': 'queued', 'percent': 0, 'message': None}
+                }
+            )
+            connection.set(RESTORE_LOCK_KEY, job.id, ex=RESTORE_JOB_TIMEOUT_SECONDS)
+        except Exception as e:
+            return None, f"Background jobs unavailable: {e}"
+        return job.id, None
+
+    @staticmethod
+    def job_status(job):
+        status = job.get_status(refresh=False)
+        data = {
+            'job_id': job.id,
+            'backup_id': job.meta.get('backup_id'),
+            'status': status.value if hasattr(status, 'value') else status,
+            'progress': job.meta.get('progress'),
+            'enqueued_at': job.enqueued_at.isoformat() if job.enqueued_at else None,
+            'ended_at': job.ended_at.isoformat() if job.ended_at else None,
+            'result': None,
+            'error': None
+        }
+        if data['status'] == 'finished':
+            data['result'] = job.result
+        elif data['status'] == 'failed':
+            lines = (job.exc_info or '').strip().splitlines()
+            data['error'] = lines[-1] if lines else 'Restore failed'
+        return data
+
+    @staticmethod
+    def restore(backup_id, key, user_id, progress):
+        """
+        Stage, validate and swap in a backup chain
+        Returns a summary of the restore
+        """
+        started = time.monotonic()
+        backup = db.session.get(BackupMeta, backup_id)
+        if not backup:
+            raise Exception("Backup not found")
+        chain = BackupService.get_chain(backup)
+        uploads = None
+        requeued = []
+        cleared = None
+        live_path = BackupService._get_db_path()
+        staging_path = os.path.join(BackupService._get_backup_dir(), f"restore_staging_{TimeService.now_ms()}.db")
+
+        try:
+            progress.update('staging', message=f"Decrypting {len(chain)} backup file(s)", force=True)
+            users = BackupService._restore_chain_to_sqlite(chain, key, staging_path, progress.phase('staging'))
+
+            progress.update('validating', message="Checking the staged database", force=True)
+            RestoreService._validate_staging(staging_path)
+            if backup.upload_files is not None:
+                # Files are only ever added, so they can go back before the swap
+                progress.update('validating', message="Restoring uploaded files", force=True)
+                uploads = BackupService._restore_uploads(chain, key)
+
+            progress.update('draining', message="Waiting for running requests to finish", force=True)
+            MaintenanceService.enable(
+                f"Restoring backup {backup_id}", RESTORE_JOB_TIMEOUT_SECONDS, backup_id=backup_id
+            )
+            try:
+                busy = MaintenanceService.drain()
+                if busy:
+                    raise Exception(f"{busy} request(s) still running after {DRAIN_TIMEOUT_SECONDS}s; restore aborted")
+
+                progress.update('swapping', message="Replacing the live database", force=True)
+                if live_path:
+                    # The backup list describes the files on disk, so keep the live one
+                    RestoreService._carry_over_backups(staging_path)
+                    db.session.remove()
+                    db.engine.dispose()
+                    RestoreService._swap_sqlite(staging_path, live_path, progress.phase('swapping'))
+                else:
+                    db.session.remove()
+                    RestoreService._reload(staging_path, progress.phase('swapping'))
+                db.engine.dispose()
+
+                # Rendered by id; the restored ids may name other rows
+                progress.update('finishing', message="Clearing rendered receipts and documents", force=True)
+                cleared = RestoreService._clear_rendered()
+
+                progress.update('finishing', message="Recording the restore", force=True)
+                backup = db.session.get(BackupMeta, backup_id)
+                backup.restored_at = TimeService.now_ms()
+                AuditLog.log(
+                    # The restoring admin may not exist in the restored data
+                    user_id=user_id if db.session.get(User, user_id) else None,
+                    action='BACKUP_RESTORE',
+                    entity='backup',
+                    entity_id=backup_id,
+                    details={'chain': [b.id for b in chain], 'restored_by': user_id}
+                )
+                db.session.commit()
+            finally:
+                MaintenanceService.disable()
+
+            # Backups hold the proofs, not the images derived from them
+            try:
+                requeued = ProofImageService.reset_missing()
+            except Exception as e:
+                # The restore itself is done; process_proof_images.py can catch up
+                db.session.rollback()
+                current_app.logger.warning(f"Could not check proof images after restore: {e}")
+            for blob in requeued:
+                ProofImageService.enqueue(blob)
+        finally:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+
+        summary = {
+            'backup_id': backup_id,
+            'chain_length': len(chain),
+            'users': users,
+            'uploads_restored': uploads[0] if uploads else None,
+            'proof_images_requeued': len(requeued),
+            'rendered_files_cleared': cleared,
+            'seconds': round(time.monotonic() - started, 1)
+        }
+        progress.update('done', message=f"Restored backup {backup_id} ({users} users)", force=True)
+        return summary
+
+    @staticmethod
+    def _clear_rendered():
+        """
+        Remove stored receipts and cached documents, before the API is back
+        Returns files removed, or None if they could not be (logged)
+        """
+        try:
+            return ReceiptService.clear() + DocumentCacheService.clear()
+        except OSError as e:
+            current_app.logger.warning(f"Could not clear rendered files after restore: {e}")
+            return None
+
+    @staticmethod
+    def _validate_staging(staging_path):
+        """The staged database must be intact and carry every table and column the app uses"""
+        conn = sqlite3.connect(staging_path)
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            conn.close()
+        if result != 'ok':
+            raise Exception(f"Staged database failed its integrity check: {result}")
+
+        engine = create_engine(f"sqlite:///{staging_path}")
+        try:
+            inspector = inspect(engine)
+            problems = []
+            for table in db.metadata.sorted_tables:
+                # Not restored: the live rows are kept (see _carry_over_backups)
+                if table.name in EXCLUDED_TABLES:
+                    continue
+                if not inspector.has_table(table.name):
+                    problems.append(f"table {table.name} is missing")
+                    continue
+                present = {c['name'] for c in inspector.get_columns(table.name)}
+                missing = [c.name for c in table.columns if c.name not in present]
+                if missing:
+                    problems.append(f"{table.name} lacks {', '.join(missing)}")
+        finally:
+            engine.dispose()
+        if problems:
+            raise Exception(f"Backup does not match this version's schema: {'; '.join(problems)}")
+
+    @staticmethod
+    def _carry_over_backups(staging_path):
+        """
+        Replace the staged backups and backup_runs tables with the live ones
+        (whatever schema the backup had) and empty its deletion log
+        """
+        backups = BackupMeta.__table__
+        tables = [backups, BackupRun.__table__]
+        rows = [[dict(row._mapping) for row in db.session.execute(db.select(t))] for t in tables]
+        engine = create_engine(f"sqlite:///{staging_path}")
+        try:
+            for table in reversed(tables):
+                table.drop(engine, checkfirst=True)
+            for table in tables:
+                table.create(engine)
+            with engine.begin() as conn:
+                conn.execute(DeletedRow.__table__.delete())
+                for table, table_rows in zip(tables, rows):
+                    if table_rows:
+                        conn.execute(table.insert(), table_rows)
+                conn.execute(
+                    backups.update()
+                    .where(backups.c.created_by_id.not_in(db.select(User.__table__.c.id)))
+                    .values(created_by_id=None)
+                )
+        finally:
+            engine.dispose()
+
+    @staticmethod
+    def _swap_sqlite(staging_path, live_path, progress):
+        """Copy the staged database over the live file page by page"""
+        source = sqlite3.connect(staging_path)
+        target = sqlite3.connect(live_path, timeout=DRAIN_TIMEOUT_SECONDS)
+        try:
+            source.backup(
+                target,
+                pages=SWAP_PAGES_PER_STEP,
+                progress=lambda status, remaining, total: progress(1 - remaining / total if total else 1)
+            )
+        finally:
+            target.close()
+            source.close()
+
+    @staticmethod
+    def _reload(staging_path, progress):
+        """Reload every table of a non-SQLite database from the staged one, in one transaction"""
+        engine = create_engine(f"sqlite:///{staging_path}")
+        try:
+            with db.engine.begin() as conn:
+                return LogicalBackupService.copy_database(engine, conn, progress)
+        finally:
+            engine.dispose()
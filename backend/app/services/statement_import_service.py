@@ -0,0 +1,374 @@
+"""
+Bank statement import service
+Streams CSV/XLSX statements and matches rows to fees in batches
+"""
+import csv
+import io
+import zipfile
+from decimal import Decimal, InvalidOperation
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models.fee import Fee
+from app.models.student import Student
+from app.models.transaction import Transaction
+from app.models.audit_log import AuditLog
+from app.services.fee_service import FeeService
+from app.services.receipt_service import ReceiptService
+from app.services.time_service import TimeService
+
+# Rows matched before each locked write + commit
+BATCH_SIZE = 500
+# Unmatched rows echoed back in the summary (the rest are only counted)
+MAX_REPORTED_ROWS = 100
+
+# Accepted spellings of each statement column, after normalization
+HEADER_ALIASES = {
+    'reference': {'reference', 'transaction_reference', 'ref', 'reference_no', 'transaction_id', 'trx_id'},
+    'admission_no': {'admission_no', 'admission_number', 'admission', 'student_id_no'},
+    'amount': {'amount', 'credit', 'deposit', 'paid_amount'},
+    'month': {'month'},
+    'year': {'year'},
+}
+
+
+class StatementImportService:
+    """
+    Matches statement rows to fees using in-memory hash indexes:
+    1. reference of an existing transaction -> approve it (or skip if already done)
+    2. admission_no + amount -> new APPROVED transaction on the oldest open fee
+       (or the row's month/year fee) with enough remaining balance; a month
+       with no fee row yet gets one, as a student's submission would create it
+    Index size depends on open fees/transactions, not on statement length.
+    """
+
+    @staticmethod
+    def _normalize_header(value):
+        return str(value or '').strip().lower().replace(' ', '_').replace('-', '_').replace('.', '')
+
+    @staticmethod
+    def _map_header(header_row):
+        """Map canonical column name -> index, or raise if required ones are missing"""
+        columns = {}
+        for idx, raw in enumerate(header_row):
+            name = StatementImportService._normalize_header(raw)
+            for canonical, aliases in HEADER_ALIASES.items():
+                if name in aliases and canonical not in columns:
+                    columns[canonical] = idx
+        missing = [c for c in ('reference', 'admission_no', 'amount') if c not in columns]
+        if missing:
+            raise ValueError(f"Statement is missing required columns: {', '.join(missing)}")
+        return columns
+
+    @staticmethod
+    def iter_rows(file_obj, filename):
+        """
+        Stream statement rows as dicts of canonical columns
+        CSV is read line by line; XLSX uses openpyxl read-only mode
+        """
+        if filename.lower().endswith('.xlsx'):
+            try:
+                wb = load_workbook(file_obj, read_only=True, data_only=True)
+            except (zipfile.BadZipFile, InvalidFileException, KeyError, OSError):
+                # Not a workbook (corrupt, or another format renamed to .xlsx)
+                raise ValueError("Could not read .xlsx statement")
+            try:
+                rows = wb.active.iter_rows(values_only=True)
+                yield from StatementImportService._iter_mapped(rows)
+            finally:
+                wb.close()
+        elif filename.lower().endswith('.csv'):
+            text = io.TextIOWrapper(file_obj, encoding='utf-8-sig', newline='')
+            yield from StatementImportService._iter_mapped(csv.reader(text))
+        else:
+            raise ValueError("Unsupported statement format, expected .csv or .xlsx")
+
+    @staticmethod
+    def _iter_mapped(rows):
+        columns = None
+        for line_no, row in enumerate(rows, start=1):
+            if columns is None:
+                columns = StatementImportService._map_header(row)
+                continue
+            if not row or all(v in (None, '') for v in row):
+                continue
+            record = {'line': line_no}
+            for name, idx in columns.items():
+                value = row[idx] if idx < len(row) else None
+                record[name] = str(value).strip() if value is not None else ''
+            yield record
+
+    @staticmethod
+    def _parse_amount(value):
+        try:
+            amount = Decimal(value.replace(',', '')).quantize(Decimal('0.01'))
+        except (InvalidOperation, AttributeError):
+            return None
+        return amount if amount > 0 else None
+
+    @staticmethod
+    def _parse_int(value):
+        """Whole number in a cell ('3', '03' or '3.0' from a spreadsheet), or None"""
+        try:
+            number = Decimal(value)
+        except (InvalidOperation, TypeError):
+            return None
+        if not number.is_finite() or number != number.to_integral_value():
+            return None
+        return int(number)
+
+    @staticmethod
+    def _parse_period(month, year):
+        """
+        (month, year) of a row as ints, None if the row gives neither,
+        or raise ValueError if they do not name a month
+        """
+        if not month and not year:
+            return None
+        month, year = StatementImportService._parse_int(month), StatementImportService._parse_int(year)
+        if month is None or year is None or not 1 <= month <= 12 or not 1 <= year <= 9999:
+            raise ValueError("invalid month or year")
+        return month, year
+
+    @staticmethod
+    def _build_indexes():
+        """
+        reference -> transaction state, admission_no -> student id,
+        student id -> open fees (oldest first) with their remaining balance
+        """
+        references = {}
+        rows = db.session.query(
+            Transaction.transaction_reference, Transaction.id, Transaction.fee_id,
+            Transaction.amount, Transaction.status
+        ).filter(Transaction.transaction_reference.isnot(None)).yield_per(5000)
+        for reference, trx_id, fee_id, amount, status in rows:
+            references[reference] = {'id': trx_id, 'fee_id': fee_id, 'amount': amount, 'status': status}
+
+        students = dict(
+            db.session.query(Student.admission_no, Student.id)
+            .filter(Student.admission_no.isnot(None))
+        )
+
+        open_fees = {}
+        rows = db.session.query(
+            Fee.id, Fee.student_id, Fee.month, Fee.year,
+            Fee.expected_amount, Fee.paid_amount, Fee.pending_amount
+        ).filter(~Fee.status.in_(['APPROVED', 'PAID']))\
+            .order_by(Fee.year, Fee.month).yield_per(5000)
+        for fee_id, student_id, month, year, expected, paid, pending in rows:
+            open_fees.setdefault(student_id, []).append({
+                'id': fee_id,
+                'month': month,
+                'year': year,
+                'remaining': (expected or 0) - (paid or 0) - (pending or 0)
+            })
+
+        return references, students, open_fees
+
+    @staticmethod
+    def _pick_fee(fees, amount, period=None):
+        for fee in fees:
+            if period and (fee['month'], fee['year']) != period:
+                continue
+            if fee['remaining'] >= amount:
+                return fee
+        return None
+
+    @staticmethod
+    def _add_month(fees, student_id, period):
+        """
+        Index entry for a month the student has no fee row for, created when
+        its batch is written; None if the month has a (settled) fee already
+        """
+        if Fee.query.filter_by(student_id=student_id, month=period[0], year=period[1]).first():
+            return None
+        fee = {
+            'id': None,
+            'month': period[0],
+            'year': period[1],
+            'remaining': FeeService.expected_amount(db.session.get(Student, student_id))
+        }
+        # Keep the student's open fees oldest first
+        position = next((i for i, f in enumerate(fees) if (f['year'], f['month']) > period[::-1]), len(fees))
+        fees.insert(position, fee)
+        return fee
+
+    @staticmethod
+    def _fee_for_month(student_id, month, year):
+        """A student's fee row for a month, created if there is none"""
+        fee = Fee.query.filter_by(student_id=student_id, month=month, year=year).first()
+        if fee:
+            return fee
+        try:
+            with db.session.begin_nested():
+                return FeeService._create_fee(db.session.get(Student, student_id), month, year)
+        except IntegrityError:
+            # Created meanwhile by a student's submission
+            return Fee.query.filter_by(student_id=student_id, month=month, year=year).one()
+
+    @staticmethod
+    def _apply_batch(approvals, creations, admin_id):
+        """
+        Write one batch under the fee locks, re-checking balances against the
+        locked rows since they may have moved since the indexes were built
+        Returns list of (kind, row, reason) for rows that could not be applied
+        """
+        rejected = []
+        for creation in creations:
+            if creation['fee_id'] is None:
+                creation['fee_id'] = StatementImportService._fee_for_month(*creation['new_fee']).id
+        fees = FeeService._lock_fees(
+            [a['fee_id'] for a in approvals] + [c['fee_id'] for c in creations]
+        )
+        now = TimeService.now_ms()
+        new_trxs = []
+        approved_ids = []
+
+        if approvals:
+            trxs = Transaction.query.filter(
+                Transaction.id.in_([a['id'] for a in approvals])
+            ).populate_existing().all()
+            trxs = {t.id: t for t in trxs}
+            for approval in approvals:
+                trx = trxs.get(approval['id'])
+                if not trx or trx.status != 'PENDING':
+                    rejected.append(('approved', approval['row'], 'transaction no longer pending'))
+                    continue
+                fee = fees[trx.fee_id]
+                FeeService._track_pending(fee, trx, -1)
+                trx.status = 'APPROVED'
+                trx.approved_at = now
+                trx.approved_by_id = admin_id
+                FeeService._apply_payment(fee, trx, admin_id)
+                approved_ids.append(trx.id)
+
+        # Creations are only paid in after the flush, so each fee's balance is tracked here
+        remaining = {}
+        for creation in creations:
+            fee = fees[creation['fee_id']]
+            if fee.id not in remaining:
+                remaining[fee.id] = (fee.expected_amount or 0) - (fee.paid_amount or 0) - (fee.pending_amount or 0)
+            if fee.status in ('APPROVED', 'PAID') or creation['amount'] > remaining[fee.id]:
+                rejected.append(('created', creation['row'], 'amount exceeds remaining balance'))
+                continue
+            remaining[fee.id] -= creation['amount']
+            trx = Transaction(
+                fee_id=fee.id,
+                amount=creation['amount'],
+                transaction_date=now,
+                payment_method='bank_transfer',
+                transaction_reference=creation['row']['reference'],
+                status='APPROVED',
+                approved_by_id=admin_id,
+                approved_at=now
+            )
+            db.session.add(trx)
+            new_trxs.append((fee, trx))
+
+        # One multi-row INSERT for the batch, then post the payments with their ids
+        db.session.flush()
+        for fee, trx in new_trxs:
+            FeeService._apply_payment(fee, trx, admin_id)
+            approved_ids.append(trx.id)
+        db.session.commit()
+        # One receipt rendering job per batch
+        ReceiptService.enqueue_render(approved_ids)
+        # Drop the batch's ORM objects so memory stays flat across batches
+        db.session.expunge_all()
+        return rejected
+
+    @staticmethod
+    def import_statement(file_obj, filename, admin_id, dry_run=False):
+        """
+        Import a bank statement in one streaming pass
+        Returns a summary dict; with dry_run nothing is written
+        """
+        started = TimeService.now_ms()
+        references, students, open_fees = StatementImportService._build_indexes()
+        summary = {
+            'rows': 0, 'approved': 0, 'created': 0,
+            'duplicates': 0, 'unmatched': 0, 'unmatched_rows': [],
+            'dry_run': dry_run
+        }
+        approvals, creations = [], []
+        # Index entries for the batch's rows, added to references once the batch accepts them
+        batch_references = {}
+
+        def unmatched(row, reason):
+            summary['unmatched'] += 1
+            if len(summary['unmatched_rows']) < MAX_REPORTED_ROWS:
+                summary['unmatched_rows'].append({**row, 'reason': reason})
+
+        def flush():
+            if not dry_run and (approvals or creations):
+                for kind, row, reason in StatementImportService._apply_batch(approvals, creations, admin_id):
+                    summary[kind] -= 1
+                    unmatched(row, reason)
+                    batch_references.pop(row['reference'], None)
+            references.update(batch_references)
+            batch_references.clear()
+            approvals.clear()
+            creations.clear()
+
+        for row in StatementImportService.iter_rows(file_obj, filename):
+            summary['rows'] += 1
+            amount = StatementImportService._parse_amount(row['amount'])
+            reference = row['reference']
+            if amount is None:
+                unmatched(row, 'invalid amount')
+                continue
+            if not reference:
+                unmatched(row, 'missing reference')
+                continue
+
+            known = batch_references.get(reference) or references.get(reference)
+            if known:
+                if known['status'] != 'PENDING':
+                    summary['duplicates'] += 1
+                elif known['amount'] != amount:
+                    unmatched(row, f"amount differs from transaction #{known['id']}")
+                else:
+                    batch_references[reference] = dict(known, status='APPROVED')
+                    approvals.append({'id': known['id'], 'fee_id': known['fee_id'], 'row': row})
+                    summary['approved'] += 1
+            else:
+                student_id = students.get(row['admission_no'])
+                if not student_id:
+                    unmatched(row, 'unknown admission number')
+                    continue
+                try:
+                    period = StatementImportService._parse_period(row.get('month'), row.get('year'))
+                except ValueError as e:
+                    unmatched(row, str(e))
+                    continue
+                fees = open_fees.setdefault(student_id, [])
+                fee = StatementImportService._pick_fee(fees, amount, period)
+                if not fee and period and not any((f['month'], f['year']) == period for f in fees):
+                    new_fee = StatementImportService._add_month(fees, student_id, period)
+                    fee = new_fee if new_fee and new_fee['remaining'] >= amount else None
+                if not fee:
+                    unmatched(row, 'no open fee with enough remaining balance')
+                    continue
+                fee['remaining'] -= amount
+                batch_references[reference] = {'id': None, 'fee_id': fee['id'], 'amount': amount, 'status': 'APPROVED'}
+                creations.append({
+                    'fee_id': fee['id'],
+                    'new_fee': (student_id, fee['month'], fee['year']),
+                    'amount': amount,
+                    'row': row
+                })
+                summary['created'] += 1
+
+            if len(approvals) + len(creations) >= BATCH_SIZE:
+                flush()
+        flush()
+
+        summary['duration_ms'] = TimeService.now_ms() - started
+        if not dry_run:
+            AuditLog.log(
+                admin_id, 'IMPORT_BANK_STATEMENT', 'fee',
+                details={k: v for k, v in summary.items() if k != 'unmatched_rows'} | {'filename': filename}
+            )
+            db.session.commit()
+        return summary
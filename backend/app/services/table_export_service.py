@@ -0,0 +1,201 @@
+"""
+Table export service
+Streams whole tables as CSV, NDJSON or Parquet for analysis in external tools
+"""
+import csv
+import io
+import json
+from app import db
+from app.models.fee import Fee
+from app.models.transaction import Transaction
+from app.models.routine import Routine
+from app.models.audit_log import AuditLog
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = pq = None
+
+# Rows fetched per server-side cursor round trip (and per Parquet row group)
+BATCH_ROWS = 5000
+
+# Exportable table -> (model, column filtered by from/to)
+EXPORT_TABLES = {
+    'fees': (Fee, Fee.created_at),
+    'transactions': (Transaction, Transaction.transaction_date),
+    'routines': (Routine, Routine.request_time),
+    'audit_logs': (AuditLog, AuditLog.timestamp),
+}
+
+FORMATS = {
+    'csv': {'mimetype': 'text/csv', 'extension': 'csv'},
+    'ndjson': {'mimetype': 'application/x-ndjson', 'extension': 'ndjson'},
+    'parquet': {'mimetype': 'application/vnd.apache.parquet', 'extension': 'parquet'},
+}
+
+
+def _json_default(value):
+    # Decimal and date columns
+    return str(value) if not hasattr(value, 'isoformat') else value.isoformat()
+
+
+class _ByteSink:
+    """
+    Write-only file for pyarrow that hands back what was written so far
+    Tracks the absolute position, which the Parquet footer's offsets rely on
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class TableExportService:
+    """
+    Rows are read through a server-side cursor in fixed-size batches and
+    each batch is encoded and yielded before the next is fetched, so memory
+    stays flat however many rows a table has.
+    """
+
+    @staticmethod
+    def parquet_available():
+        return pa is not None
+
+    @staticmethod
+    def resolve_columns(table, requested=None):
+        """
+        Table columns to export, all of them unless requested explicitly
+        Returns (columns, error)
+        """
+        if table not in EXPORT_TABLES:
+            return None, f"table must be one of: {', '.join(EXPORT_TABLES)}"
+        model = EXPORT_TABLES[table][0]
+        # id first, then the model's own columns
+        ordered = sorted(model.__table__.columns, key=lambda c: not c.primary_key)
+        available = {c.name: c for c in ordered}
+        if not requested:
+            return list(available.values()), None
+
+        names = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            return None, f"Unknown columns for {table}: {', '.join(unknown)}"
+        return [available[name] for name in dict.fromkeys(names)], None
+
+    @staticmethod
+    def iter_batches(table, columns, from_ms=None, to_ms=None):
+        """Yield lists of row tuples, BATCH_ROWS at a time, from a server-side cursor"""
+        model, time_column = EXPORT_TABLES[table]
+        query = db.select(*columns)
+        if from_ms is not None:
+            query = query.where(time_column >= from_ms)
+        if to_ms is not None:
+            query = query.where(time_column < to_ms)
+        query = query.order_by(model.__table__.c.id)
+
+        result = db.session.execute(
+            query.execution_options(stream_results=True, yield_per=BATCH_ROWS)
+        )
+        try:
+            for partition in result.partitions(BATCH_ROWS):
+                yield partition
+        finally:
+            result.close()
+
+    @staticmethod
+    def stream(table, fmt, columns, from_ms=None, to_ms=None):
+        """Yield the encoded export in chunks of one batch each"""
+        batches = TableExportService.iter_batches(table, columns, from_ms, to_ms)
+        names = [c.name for c in columns]
+        if fmt == 'csv':
+            return TableExportService._stream_csv(batches, names)
+        if fmt == 'ndjson':
+            return TableExportService._stream_ndjson(batches, names)
+        return TableExportService._stream_parquet(batches, columns)
+
+    @staticmethod
+    def _stream_csv(batches, names):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(names)
+        for batch in batches:
+            for row in batch:
+                writer.writerow([
+                    json.dumps(v) if isinstance(v, (dict, list)) else v for v in row
+                ])
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+    @staticmethod
+    def _stream_ndjson(batches, names):
+        for batch in batches:
+            yield ''.join(
+                json.dumps(dict(zip(names, row)), default=_json_default) + '\n' for row in batch
+            ).encode('utf-8')
+
+    @staticmethod
+    def _arrow_type(column):
+        """Arrow type for a SQLAlchemy column; JSON is exported as text"""
+        sql_type = column.type
+        if isinstance(sql_type, (db.BigInteger, db.Integer)):
+            return pa.int64()
+        if isinstance(sql_type, db.Numeric) and not isinstance(sql_type, db.Float):
+            return pa.decimal128(sql_type.precision or 18, sql_type.scale or 2)
+        if isinstance(sql_type, db.Float):
+            return pa.float64()
+        if isinstance(sql_type, db.Boolean):
+            return pa.bool_()
+        if isinstance(sql_type, db.DateTime):
+            return pa.timestamp('us')
+        if isinstance(sql_type, db.Date):
+            return pa.date32()
+        return pa.string()
+
+    @staticmethod
+    def _stream_parquet(batches, columns):
+        """One row group per batch, flushed to the client as soon as it is written"""
+        schema = pa.schema([(c.name, TableExportService._arrow_type(c)) for c in columns])
+        json_indexes = [i for i, c in enumerate(columns) if isinstance(c.type, db.JSON)]
+        sink = _ByteSink()
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression='zstd')
+        try:
+            for batch in batches:
+                values = list(zip(*batch))
+                for i in json_indexes:
+                    values[i] = [json.dumps(v) if v is not None else None for v in values[i]]
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(col, type=field.type) for col, field in zip(values, schema)],
+                    schema=schema
+                ))
+                yield sink.drain()
+        finally:
+            writer.close()
+        yield sink.drain()
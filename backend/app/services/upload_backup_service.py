@@ -0,0 +1,277 @@
+"""
+Upload backup service
+Archives of the uploaded files the database references (payment proofs),
+kept next to a backup file so a restore brings back what its rows point to
+
+Archive layout (the plaintext inside backup_<ts>.uploads.enc), frames as in
+the logical archive (see app.services.logical_backup_service):
+    I  index JSON: format, files [{path, sha256, size}] referenced at backup
+       time, missing (referenced but not on disk), stored (sha256 of each
+       blob in this archive)
+    B  blob start JSON: sha256, size
+    C  blob content, up to CONTENT_FRAME_BYTES per frame
+    Z  end of archive JSON: blobs, bytes
+
+Each distinct content is stored once however many paths share it, and an
+incremental backup stores only the blobs no earlier backup of its chain
+has, so a chain's files are found across its archives. The index comes
+first: what a chain has stored is read from the first chunk of each archive.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from flask import current_app
+from app import db
+from app.models.fee import Fee
+from app.models.transaction import Transaction
+from app.services.logical_backup_service import ArchiveError, read_frame, write_frame
+from app.services.proof_storage_service import ProofStorageService
+
+ARCHIVE_FORMAT = 'hostelix-uploads'
+ARCHIVE_VERSION = 1
+# Stored upload paths are URLs under this prefix (see POST /fees/upload-proof)
+URL_PREFIX = '/static/uploads/'
+# File content read, and written, per C frame
+CONTENT_FRAME_BYTES = 1024 * 1024
+
+
+def uploads_filename(filename):
+    """Name of the uploads archive kept next to the backup file filename"""
+    return os.path.splitext(filename)[0] + '.uploads.enc'
+
+
+def _file_sha256(path, limiter=None):
+    """(sha256 hex digest, size) of a file, read a frame at a time"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(CONTENT_FRAME_BYTES), b''):
+            if limiter:
+                limiter.consume(len(data))
+            digest.update(data)
+            size += len(data)
+    return digest.hexdigest(), size
+
+
+class UploadBackupService:
+    @staticmethod
+    def upload_root():
+        return os.path.join(current_app.root_path, 'static', 'uploads')
+
+    @staticmethod
+    def resolve(relative):
+        """Absolute path of a path relative to the uploads root, or None if it would leave the root"""
+        root = os.path.realpath(UploadBackupService.upload_root())
+        path = os.path.realpath(os.path.join(root, relative))
+        return path if path.startswith(root + os.sep) else None
+
+    @staticmethod
+    def referenced_paths():
+        """
+        Paths (relative to the uploads root) of the uploads the database references
+        proof_path is supplied by the client, so values outside the uploads
+        tree are ignored
+        """
+        paths = set()
+        for column in (Transaction.proof_path, Fee.proof_path):
+            for (value,) in db.session.query(column).filter(column.isnot(None)).distinct():
+                if not value.startswith(URL_PREFIX):
+                    continue
+                relative = os.path.normpath(value[len(URL_PREFIX):]).replace(os.sep, '/')
+                if UploadBackupService.resolve(relative):
+                    paths.add(relative)
+        return sorted(paths)
+
+    @staticmethod
+    def write(out, skip=frozenset(), limiter=None):
+        """
+        Write an archive of the referenced uploads to out, leaving out the
+        blobs whose sha256 is in skip (stored earlier in the chain)
+        Files are hashed (or, content-addressed, named by their hash) before
+        anything is written, so the index and the de-duplication are settled
+        up front; content is checked against its hash as it is copied
+        Returns a summary: files, missing, blobs, bytes
+        """
+        files, missing, sources = [], [], {}
+        for relative in UploadBackupService.referenced_paths():
+            path = UploadBackupService.resolve(relative)
+            # Content-addressed proofs are named by their hash, so only the rest are read here
+            sha256 = ProofStorageService.sha256_from_path(URL_PREFIX + relative)
+            try:
+                if sha256:
+                    if not os.path.isfile(path):
+                        raise FileNotFoundError(path)
+                    size = os.path.getsize(path)
+                else:
+                    sha256, size = _file_sha256(path, limiter)
+            except (FileNotFoundError, IsADirectoryError):
+                missing.append(relative)
+                continue
+            files.append({'path': relative, 'sha256': sha256, 'size': size})
+            sources.setdefault(sha256, (path, size))
+
+        stored = [sha256 for sha256 in sources if sha256 not in skip]
+        index = {
+            'format': ARCHIVE_FORMAT,
+            'version': ARCHIVE_VERSION,
+            'files': files,
+            'missing': missing,
+            'stored': stored
+        }
+        write_frame(out, b'I', json.dumps(index).encode('utf-8'))
+
+        written = 0
+        for sha256 in stored:
+            path, size = sources[sha256]
+            write_frame(out, b'B', json.dumps({'sha256': sha256, 'size': size}).encode('utf-8'))
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(CONTENT_FRAME_BYTES), b''):
+                    if limiter:
+                        limiter.consume(len(data))
+                    digest.update(data)
+                    write_frame(out, b'C', data)
+                    written += len(data)
+            if digest.hexdigest() != sha256:
+                raise Exception(f"Upload {path} does not match its hash (changed while being backed up?)")
+        write_frame(out, b'Z', json.dumps({'blobs': len(stored), 'bytes': written}).encode('utf-8'))
+        return {'files': len(files), 'missing': len(missing), 'blobs': len(stored), 'bytes': written}
+
+    @staticmethod
+    def read_index(reader):
+        """The index frame an uploads archive starts with"""
+        frame_type, payload = read_frame(reader)
+        if frame_type != b'I':
+            raise ArchiveError("Not an uploads archive")
+        index = json.loads(payload)
+        if index.get('format') != ARCHIVE_FORMAT:
+            raise ArchiveError("Not an uploads archive")
+        if index.get('version') != ARCHIVE_VERSION:
+            raise ArchiveError(f"Unsupported uploads archive version {index.get('version')}")
+        return index
+
+    @staticmethod
+    def iter_archive(reader):
+        """
+        Yield (kind, item) from an uploads archive: ('index', index), then
+        per blob ('blob', header), ('content', bytes) for each frame and
+        ('blob_end', header) once its content matched its sha256 and size,
+        and finally ('end', summary)
+        Raises ArchiveError on a malformed archive or a blob that does not match
+        """
+        yield 'index', UploadBackupService.read_index(reader)
+        blob, digest, size = None, None, 0
+        blobs, total = 0, 0
+        while True:
+            frame_type, payload = read_frame(reader)
+            if frame_type == b'C':
+                if blob is None:
+                    raise ArchiveError("Upload content outside a blob")
+                digest.update(payload)
+                size += len(payload)
+                total += len(payload)
+                yield 'content', payload
+                continue
+            if blob is not None:
+                if digest.hexdigest() != blob['sha256'] or size != blob['size']:
+                    raise ArchiveError(f"Upload blob {blob['sha256']} does not match its checksum")
+                yield 'blob_end', blob
+                blob = None
+            if frame_type == b'B':
+                blob, digest, size = json.loads(payload), hashlib.sha256(), 0
+                blobs += 1
+                yield 'blob', blob
+            elif frame_type == b'Z':
+                summary = json.loads(payload)
+                if summary.get('blobs') != blobs or summary.get('bytes') != total:
+                    raise ArchiveError("Uploads archive end does not match its content")
+                yield 'end', summary
+                return
+            elif frame_type is None:
+                raise ArchiveError("Uploads archive is truncated")
+            else:
+                raise ArchiveError(f"Unknown uploads archive frame {frame_type!r}")
+
+    @staticmethod
+    def verify(reader, earlier):
+        """
+        Check an uploads archive without writing anything: every blob
+        against its checksum, and every indexed file against the blobs of
+        this archive and earlier (those stored before it in its chain)
+        Returns (report, sha256 of the blobs stored in this archive)
+        """
+        report = {'files': 0, 'missing': 0, 'blobs': 0, 'bytes': 0, 'errors': []}
+        stored = set()
+        try:
+            for kind, item in UploadBackupService.iter_archive(reader):
+                if kind == 'index':
+                    index = item
+                    report['files'] = len(index['files'])
+                    report['missing'] = len(index['missing'])
+                elif kind == 'blob_end':
+                    stored.add(item['sha256'])
+                    report['bytes'] += item['size']
+            report['blobs'] = len(stored)
+            if stored != set(index['stored']):
+                report['errors'].append("Uploads archive blobs do not match its index")
+            absent = {f['sha256'] for f in index['files']} - stored - earlier
+            if absent:
+                report['errors'].append(f"{len(absent)} upload blob(s) are in no backup of the chain")
+        except (ArchiveError, ValueError, KeyError) as e:
+            report['errors'].append(f"Uploads: {e}")
+        return report, stored
+
+    @staticmethod
+    def restore(index, readers):
+        """
+        Write the files of index (the head backup's) under the uploads root
+        from the blobs in readers (the uploads archives of its chain)
+        Files already there with the same content are left alone; nothing
+        referenced is ever removed
+        Returns (files written, files already present)
+        """
+        wanted = {}
+        present = 0
+        for entry in index['files']:
+            path = UploadBackupService.resolve(entry['path'])
+            if path is None:
+                raise ArchiveError(f"Upload path {entry['path']} is outside the uploads directory")
+            if os.path.isfile(path) and _file_sha256(path)[0] == entry['sha256']:
+                present += 1
+                continue
+            wanted.setdefault(entry['sha256'], []).append(path)
+
+        written = 0
+        root = UploadBackupService.upload_root()
+        os.makedirs(root, exist_ok=True)
+        for reader in readers:
+            if not wanted:
+                break
+            temp, temp_path = None, None
+            try:
+                for kind, item in UploadBackupService.iter_archive(reader):
+                    if kind == 'blob' and item['sha256'] in wanted:
+                        fd, temp_path = tempfile.mkstemp(dir=root, suffix='.tmp')
+                        temp = os.fdopen(fd, 'wb')
+                    elif kind == 'content' and temp:
+                        temp.write(item)
+                    elif kind == 'blob_end' and temp:
+                        temp.close()
+                        paths = wanted.pop(item['sha256'])
+                        for path in paths:
+                            os.makedirs(os.path.dirname(path), exist_ok=True)
+                            shutil.copyfile(temp_path, path + '.tmp')
+                            os.replace(path + '.tmp', path)
+                        written += len(paths)
+                        os.remove(temp_path)
+                        temp, temp_path = None, None
+            finally:
+                if temp:
+                    temp.close()
+                if temp_path and os.path.exists(temp_path):
+                    os.remove(temp_path)
+        if wanted:
+            raise ArchiveError(f"{len(wanted)} upload blob(s) are in no backup of the chain")
+        return written, present
@@ -0,0 +1,295 @@
+"""
+Deduplicating chunk store for backups
+
+Backup content is cut into chunks at content-defined boundaries, so an edit
+only changes the chunks around it, and every chunk is stored once under
+chunks/<first two hex digits of its id>/<id>. The id is an HMAC-SHA256 of
+the plaintext: equal chunks match without their content being revealed.
+
+Chunk file:
+    nonce (12 bytes) | AES-GCM ciphertext of codec flag (1 byte) | data
+with the chunk id as associated data, so a chunk cannot be swapped for
+another. The flag is the compression of that chunk (see CODEC_FLAGS).
+
+A chunked backup's own file is its manifest: the ordered chunk ids in the
+chunked encryption format (see app.utils.encryption), so it opens with the
+backup key like any backup file. Next to it a .refs file lists the same ids
+in the clear, for garbage collection without the key.
+
+Ids, chunk keys and boundaries are all derived from the backup key: only
+backups made with the same key share chunks.
+"""
+import hashlib
+import hmac
+import json
+import os
+import re
+import tempfile
+import zlib
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from app.utils import compression as codecs
+from app.utils.encryption import BackupFormatError, EncryptingWriter, iter_decrypt
+
+# Boundaries are only looked for past CHUNK_MIN_BYTES, and forced at CHUNK_MAX_BYTES
+CHUNK_MIN_BYTES = 8 * 1024
+CHUNK_MAX_BYTES = 256 * 1024
+# A position after one of ANCHOR_COUNT byte values is a candidate boundary,
+# taken when BOUNDARY_BITS bits of the CRC of the BOUNDARY_WINDOW bytes
+# before it are zero (both keyed): about one position in 8K, for chunks of
+# 16-24KB on database files. Finding candidates is a regex scan, so
+# chunking runs at C speed rather than a byte at a time.
+ANCHOR_COUNT = 16
+BOUNDARY_BITS = 9
+BOUNDARY_WINDOW = 32
+# Content buffered before it is cut, so small writes are chunked in bulk
+WRITE_BUFFER_BYTES = 1024 * 1024
+NONCE_BYTES = 12
+CODEC_FLAGS = {None: 0, 'zlib': 1, 'lzma': 2, 'zstd': 3}
+CODECS = {flag: name for name, flag in CODEC_FLAGS.items()}
+
+
+def _derive(key, purpose, length=32):
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=None, info=purpose).derive(key)
+
+
+def chunk_path(root, chunk_id):
+    return os.path.join(root, chunk_id[:2], chunk_id)
+
+
+def refs_path(manifest_path):
+    """Path of the .refs file listing a manifest's chunk ids"""
+    return os.path.splitext(manifest_path)[0] + '.refs'
+
+
+def read_refs(manifest_path):
+    with open(refs_path(manifest_path)) as f:
+        return set(f.read().split())
+
+
+class Chunker:
+    """Finds content-defined chunk boundaries (see ANCHOR_COUNT)"""
+
+    def __init__(self, key):
+        material = _derive(key, b'hostelix-chunk-boundaries', 64)
+        # Never 0x00 or 0xff: runs of them (empty page space) would make every byte a candidate
+        anchors = []
+        for byte in material[4:]:
+            value = 1 + byte % 254
+            if value not in anchors:
+                anchors.append(value)
+        anchors = bytes(anchors[:ANCHOR_COUNT])
+        self._anchors = re.compile(b'[' + b''.join(re.escape(bytes([a])) for a in anchors) + b']')
+        self._seed = int.from_bytes(material[:4], 'big')
+        self._mask = (1 << BOUNDARY_BITS) - 1
+
+    def boundaries(self, data, final):
+        """
+        Yield the end offsets of the chunks in data; without final, a tail
+        shorter than CHUNK_MAX_BYTES is left for when more data arrives, so
+        content is cut the same way however it was written
+        """
+        start = 0
+        while len(data) - start >= CHUNK_MAX_BYTES or (final and start < len(data)):
+            start = self._boundary(data, start, len(data))
+            yield start
+
+    def _boundary(self, data, start, end):
+        if end - start <= CHUNK_MIN_BYTES:
+            return end
+        limit = min(end, start + CHUNK_MAX_BYTES)
+        for match in self._anchors.finditer(data, start + CHUNK_MIN_BYTES, limit):
+            position = match.end()
+            if not zlib.crc32(data[position - BOUNDARY_WINDOW:position], self._seed) & self._mask:
+                return position
+        return limit
+
+
+class ChunkStore:
+    """
+    The chunks of the backups made with one key
+    Chunks are only ever added while backing up; collect_garbage() removes
+    the ones no backup references any more.
+    """
+
+    def __init__(self, root, key):
+        self.root = root
+        self._key = key
+        self._id_key = _derive(key, b'hostelix-chunk-id')
+        self._aesgcm = AESGCM(_derive(key, b'hostelix-chunk-data'))
+        self.chunker = Chunker(key)
+        # Chunks (and their bytes on disk) this store added, and bytes read
+        self.chunks_written = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def chunk_id(self, data):
+        return hmac.new(self._id_key, data, hashlib.sha256).hexdigest()
+
+    def put(self, data, compression=None, level=None):
+        """Store a chunk unless it is already there; returns its id"""
+        chunk_id = self.chunk_id(data)
+        path = chunk_path(self.root, chunk_id)
+        try:
+            # A reused chunk counts as new to a concurrent collect_garbage()
+            os.utime(path)
+            return chunk_id
+        except FileNotFoundError:
+            pass
+
+        flag = 0
+        if compression:
+            packed = codecs.compress(compression, level, data)
+            if len(packed) < len(data):
+                flag, data = CODEC_FLAGS[compression], packed
+        nonce = os.urandom(NONCE_BYTES)
+        sealed = nonce + self._aesgcm.encrypt(nonce, bytes([flag]) + data, chunk_id.encode())
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(sealed)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.chunks_written += 1
+        self.bytes_written += len(sealed)
+        return chunk_id
+
+    def get(self, chunk_id):
+        """Authenticated plaintext of a chunk"""
+        try:
+            with open(chunk_path(self.root, chunk_id), 'rb') as f:
+                sealed = f.read()
+        except FileNotFoundError:
+            raise BackupFormatError(f"Chunk {chunk_id} is missing from the chunk store")
+        self.bytes_read += len(sealed)
+        try:
+            plaintext = self._aesgcm.decrypt(sealed[:NONCE_BYTES], sealed[NONCE_BYTES:], chunk_id.encode())
+        except InvalidTag:
+            raise BackupFormatError(f"Chunk {chunk_id} failed authentication (wrong key or tampered file)")
+
+        flag, data = plaintext[0], plaintext[1:]
+        if flag not in CODECS:
+            raise BackupFormatError(f"Chunk {chunk_id} has an unknown codec")
+        if CODECS[flag]:
+            try:
+                codecs.check(CODECS[flag])
+                data = codecs.decompress(CODECS[flag], data, CHUNK_MAX_BYTES)
+            except codecs.CompressionError as e:
+                raise BackupFormatError(f"Chunk {chunk_id}: {e}")
+        if not hmac.compare_digest(self.chunk_id(data), chunk_id):
+            raise BackupFormatError(f"Chunk {chunk_id} does not match its id")
+        return data
+
+    def read_manifest(self, manifest_path):
+        """The manifest of a chunked backup: {'chunks': [ids], 'size': plaintext bytes}"""
+        with open(manifest_path, 'rb') as f:
+            try:
+                manifest = json.loads(b''.join(iter_decrypt(f, self._key)))
+            except ValueError:
+                raise BackupFormatError("Chunk manifest is not valid JSON")
+        if not isinstance(manifest.get('chunks'), list):
+            raise BackupFormatError("Not a chunk manifest")
+        return manifest
+
+    def iter_chunks(self, manifest):
+        """Yield a chunked backup's content, a chunk at a time"""
+        for chunk_id in manifest['chunks']:
+            yield self.get(chunk_id)
+
+
+class ChunkWriter:
+    """
+    File-like writer that stores what is written in a ChunkStore
+    close() stores the last chunk, then writes the manifest to
+    manifest_path and the .refs file next to it. After an error neither is
+    written; chunks already stored are left to collect_garbage().
+    """
+
+    def __init__(self, store, manifest_path, header=None, compression=None, level=None):
+        self._store = store
+        self._path = manifest_path
+        self._header = dict(header or {}, storage='chunks')
+        self._compression = compression
+        self._level = None
+        if compression:
+            codecs.check(compression)
+            self._level = level if level is not None else codecs.default_level(compression)
+        self._buffer = bytearray()
+        self.chunk_ids = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        if len(self._buffer) >= WRITE_BUFFER_BYTES:
+            self._cut(final=False)
+        return len(data)
+
+    def _cut(self, final):
+        data = bytes(self._buffer)
+        start = 0
+        for end in self._store.chunker.boundaries(data, final):
+            self.chunk_ids.append(self._store.put(data[start:end], self._compression, self._level))
+            start = end
+        self._buffer = bytearray(data[start:])
+
+    def close(self):
+        if self.closed:
+            return
+        self._cut(final=True)
+        manifest = json.dumps({'chunks': self.chunk_ids, 'size': self.size}).encode('utf-8')
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                with EncryptingWriter(f, self._store._key, header=self._header, compression='zlib') as writer:
+                    writer.write(manifest)
+            with open(refs_path(self._path), 'w') as f:
+                f.write('\n'.join(sorted(set(self.chunk_ids))))
+            os.replace(temp_path, self._path)
+        except Exception:
+            for path in (temp_path, refs_path(self._path)):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def collect_garbage(root, referenced, older_than):
+    """
+    Remove chunks outside referenced (and leftover temp files) last
+    modified before older_than (epoch seconds): younger ones may belong to a
+    backup still being written
+    Returns (chunks removed, bytes freed)
+    """
+    removed, freed = 0, 0
+    if not os.path.isdir(root):
+        return removed, freed
+    with os.scandir(root) as prefixes:
+        for prefix in prefixes:
+            if not prefix.is_dir():
+                continue
+            with os.scandir(prefix.path) as entries:
+                for entry in entries:
+                    if entry.name in referenced or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if stat.st_mtime < older_than:
+                        os.remove(entry.path)
+                        removed += 1
+                        freed += stat.st_size
+    return removed, freed
@@ -0,0 +1,85 @@
+"""
+Compression codecs for the backup pipeline
+zstd needs the optional zstandard package; lzma and zlib are always there
+"""
+import lzma
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+DEFAULT_LEVELS = {
+    'zstd': 3,
+    'lzma': 6,
+    'zlib': 6,
+}
+
+
+class CompressionError(Exception):
+    """Unknown or unavailable codec, or data that does not decompress"""
+
+
+def available():
+    """Codecs usable in this environment, best first"""
+    return (['zstd'] if zstandard else []) + ['lzma', 'zlib']
+
+
+def default_algorithm():
+    """
+    BACKUP_COMPRESSION if set ('none' disables compression), else zstd
+    where installed, else zlib (lzma compresses better but is far slower)
+    """
+    configured = os.getenv('BACKUP_COMPRESSION')
+    if configured:
+        return None if configured == 'none' else configured
+    return 'zstd' if zstandard else 'zlib'
+
+
+def default_level(algorithm):
+    configured = os.getenv('BACKUP_COMPRESSION_LEVEL')
+    return int(configured) if configured else DEFAULT_LEVELS[algorithm]
+
+
+def check(algorithm):
+    if algorithm not in DEFAULT_LEVELS:
+        raise CompressionError(f"Unknown compression algorithm {algorithm}")
+    if algorithm not in available():
+        raise CompressionError(f"{algorithm} compression needs the zstandard package")
+
+
+def compress(algorithm, level, data):
+    if algorithm == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if algorithm == 'lzma':
+        return lzma.compress(data, preset=level)
+    return zlib.compress(data, level)
+
+
+def decompress(algorithm, data, max_size):
+    """Decompress one chunk, refusing output larger than max_size"""
+    try:
+        if algorithm == 'zstd':
+            result = zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+        elif algorithm == 'lzma':
+            decompressor = lzma.LZMADecompressor()
+            # One byte of headroom, so a chunk of exactly max_size can reach eof
+            result = decompressor.decompress(data, max_length=max_size + 1)
+            if not decompressor.eof:
+                raise CompressionError("Compressed chunk is truncated or too large")
+        else:
+            decompressor = zlib.decompressobj()
+            result = decompressor.decompress(data, max_size + 1)
+            if not decompressor.eof:
+                raise CompressionError("Compressed chunk is truncated or too large")
+    except (zlib.error, lzma.LZMAError) as e:
+        raise CompressionError(f"Chunk does not decompress: {e}")
+    except Exception as e:
+        if zstandard and isinstance(e, zstandard.ZstdError):
+            raise CompressionError(f"Chunk does not decompress: {e}")
+        raise
+    if len(result) > max_size:
+        raise CompressionError("Compressed chunk is larger than the chunk size")
+    return result
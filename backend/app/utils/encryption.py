@@ -1,62 +1,345 @@
 """
 Encryption utility for backups
+
+Chunked format (version 2):
+    magic b'HXBK' | version (1 byte) | header length (4 bytes BE) | header JSON
+    then one record per chunk: ciphertext length (4 bytes BE) | AES-GCM ciphertext
+
+Chunk i is encrypted with nonce = nonce_prefix (7 bytes, from the header)
+| i (4 bytes BE) | 1 if last chunk else 0, and the raw header bytes as
+associated data. Reordered, dropped or appended chunks, a truncated file
+or an edited header all fail authentication.
+
+With a "compression" algorithm (and "level") in the header, each chunk is
+compressed on its own before encryption and its plaintext is a flag byte
+(1 compressed, 0 stored as is, when compression would not shrink it)
+followed by the data. Independent chunks compress in parallel.
+
+Files without the magic are the original single-shot format:
+    nonce (12 bytes) | AES-GCM ciphertext of the whole file
 """
 import os
+import json
 import base64
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from app.utils import compression as codecs
+
+MAGIC = b'HXBK'
+FORMAT_VERSION = 2
+# Plaintext bytes per chunk; memory use is a small multiple of this
+CHUNK_SIZE = 1024 * 1024
+NONCE_PREFIX_BYTES = 7
+TAG_BYTES = 16
+# Largest header accepted when reading, to reject garbage before allocating
+MAX_HEADER_BYTES = 64 * 1024
+# Threads compressing chunks; compressors and AES-GCM release the GIL
+COMPRESSION_WORKERS = int(os.getenv('BACKUP_COMPRESSION_WORKERS', 0)) or os.cpu_count() or 1
+
+
+class BackupFormatError(Exception):
+    """Backup file is corrupt, truncated, tampered with or the key is wrong"""
+
+
+def _nonce(prefix, index, last):
+    return prefix + struct.pack('>IB', index, 1 if last else 0)
+
+
+class EncryptingWriter:
+    """
+    File-like writer that encrypts into the chunked format
+    Data is buffered up to one chunk; close() writes the final chunk.
+    With compression, up to workers chunks are compressed and encrypted at
+    once and written in order.
+    """
+
+    def __init__(self, fileobj, key, chunk_size=CHUNK_SIZE, header=None,
+                 compression=None, level=None, workers=None):
+        self._file = fileobj
+        self._aesgcm = AESGCM(key)
+        self._chunk_size = chunk_size
+        self._prefix = os.urandom(NONCE_PREFIX_BYTES)
+        self._index = 0
+        self._buffer = bytearray()
+        self.closed = False
+        self.header = dict(header or {})
+        self.header.update({
+            'chunk_size': chunk_size,
+            'nonce_prefix': self._prefix.hex()
+        })
+        self._compression = compression
+        self._level = None
+        if compression:
+            codecs.check(compression)
+            self._level = level if level is not None else codecs.default_level(compression)
+            self.header.update({'compression': compression, 'level': self._level, 'chunk_overhead': 1})
+        self._workers = workers or (COMPRESSION_WORKERS if compression else 1)
+        self._pool = ThreadPoolExecutor(self._workers) if self._workers > 1 else None
+        self._pending = deque()
+        self._aad = json.dumps(self.header, sort_keys=True).encode('utf-8')
+        self._file.write(MAGIC + struct.pack('>BI', FORMAT_VERSION, len(self._aad)) + self._aad)
+        self.bytes_in = 0
+        self.bytes_out = len(MAGIC) + 5 + len(self._aad)
+
+    def _seal(self, data, index, last):
+        if self._compression:
+            packed = codecs.compress(self._compression, self._level, data)
+            data = b'\x01' + packed if len(packed) < len(data) else b'\x00' + data
+        return self._aesgcm.encrypt(_nonce(self._prefix, index, last), data, self._aad)
+
+    def _write_record(self, ciphertext):
+        self._file.write(struct.pack('>I', len(ciphertext)))
+        self._file.write(ciphertext)
+        self.bytes_out += 4 + len(ciphertext)
+
+    def _emit(self, data, last):
+        if self._pool is None:
+            self._write_record(self._seal(bytes(data), self._index, last))
+        else:
+            self._pending.append(self._pool.submit(self._seal, bytes(data), self._index, last))
+            # Bound memory to a couple of chunks per worker
+            while len(self._pending) > self._workers * 2:
+                self._write_record(self._pending.popleft().result())
+        self._index += 1
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        # Hold back a full chunk until more data arrives, so the last chunk
+        # is only known (and flagged) at close()
+        while len(self._buffer) > self._chunk_size:
+            self._emit(self._buffer[:self._chunk_size], last=False)
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._emit(self._buffer, last=True)
+        while self._pending:
+            self._write_record(self._pending.popleft().result())
+        self._buffer = bytearray()
+        self._shutdown()
+        self.closed = True
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._shutdown()
+
+
+def _read_exact(fileobj, size):
+    data = fileobj.read(size)
+    while len(data) < size:
+        more = fileobj.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def read_header(fileobj):
+    """
+    Read and parse a chunked-format header
+    Returns (header dict, raw header bytes)
+    """
+    fixed = _read_exact(fileobj, len(MAGIC) + 5)
+    if len(fixed) < len(MAGIC) + 5 or fixed[:len(MAGIC)] != MAGIC:
+        raise BackupFormatError("Not a chunked backup file")
+    version, header_len = struct.unpack('>BI', fixed[len(MAGIC):])
+    if version != FORMAT_VERSION:
+        raise BackupFormatError(f"Unsupported backup format version {version}")
+    if header_len > MAX_HEADER_BYTES:
+        raise BackupFormatError("Backup header too large")
+    raw = _read_exact(fileobj, header_len)
+    if len(raw) < header_len:
+        raise BackupFormatError("Backup header truncated")
+    try:
+        return json.loads(raw), raw
+    except ValueError:
+        raise BackupFormatError("Backup header is not valid JSON")
+
+
+def iter_decrypt(fileobj, key):
+    """
+    Yield authenticated plaintext chunks of a chunked-format file
+    Nothing is yielded from a chunk that fails authentication; a missing
+    final chunk raises after the last good one.
+    """
+    header, aad = read_header(fileobj)
+    aesgcm = AESGCM(key)
+    prefix = bytes.fromhex(header['nonce_prefix'])
+    chunk_size = header['chunk_size']
+    max_len = chunk_size + header.get('chunk_overhead', 0) + TAG_BYTES
+    algorithm = header.get('compression')
+    if algorithm:
+        try:
+            codecs.check(algorithm)
+        except codecs.CompressionError as e:
+            raise BackupFormatError(str(e))
+
+    def next_length():
+        raw = _read_exact(fileobj, 4)
+        if not raw:
+            return None
+        if len(raw) < 4:
+            raise BackupFormatError("Backup truncated inside a chunk header")
+        length = struct.unpack('>I', raw)[0]
+        if length < TAG_BYTES or length > max_len:
+            raise BackupFormatError("Backup chunk has an invalid length")
+        return length
+
+    index = 0
+    length = next_length()
+    if length is None:
+        raise BackupFormatError("Backup has no chunks")
+    while length is not None:
+        ciphertext = _read_exact(fileobj, length)
+        if len(ciphertext) < length:
+            raise BackupFormatError("Backup truncated inside a chunk")
+        following = next_length()
+        try:
+            plaintext = aesgcm.decrypt(_nonce(prefix, index, following is None), ciphertext, aad)
+        except InvalidTag:
+            raise BackupFormatError(
+                f"Chunk {index} failed authentication (wrong key, tampered, reordered or truncated file)"
+            )
+        if algorithm:
+            if plaintext[:1] == b'\x01':
+                try:
+                    plaintext = codecs.decompress(algorithm, plaintext[1:], chunk_size)
+                except codecs.CompressionError as e:
+                    raise BackupFormatError(f"Chunk {index}: {e}")
+            else:
+                plaintext = plaintext[1:]
+        yield plaintext
+        index += 1
+        length = following
+
+
+class IterReader:
+    """File-like reader over an iterable of byte chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        self._pos = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) - self._pos < size):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                break
+            # Drop what was already read before appending, so reads copy only what they return
+            del self._buffer[:self._pos]
+            self._pos = 0
+            self._buffer += chunk
+        end = len(self._buffer) if size < 0 else min(len(self._buffer), self._pos + size)
+        data = bytes(self._buffer[self._pos:end])
+        self._pos = end
+        return data
+
+
+class DecryptingReader(IterReader):
+    """File-like reader over the plaintext of a chunked-format file"""
+
+    def __init__(self, fileobj, key):
+        super().__init__(iter_decrypt(fileobj, key))
+
 
 class BackupEncryption:
     """
     Handles AES-256-GCM encryption for backup files
     """
-    
+
     @staticmethod
     def generate_key():
         """Generate a random 32-byte key"""
         return AESGCM.generate_key(bit_length=256)
-    
+
     @staticmethod
     def key_to_string(key):
         """Convert bytes key to base64 string"""
         return base64.b64encode(key).decode('utf-8')
-        
+
     @staticmethod
     def key_from_string(key_str):
         """Convert base64 string to bytes key"""
         return base64.b64decode(key_str)
 
     @staticmethod
-    def encrypt_file(file_path, output_path, key):
+    def is_chunked(file_path):
+        """True for chunked-format files, False for the original single-shot format"""
+        with open(file_path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+
+    @staticmethod
+    def encrypt_file(file_path, output_path, key, chunk_size=CHUNK_SIZE,
+                     compression=None, level=None, workers=None, limiter=None):
         """
-        Encrypt a file using AES-GCM
-        Appends nonce (12 bytes) to the beginning of the file
+        Encrypt a file into the chunked format, a few chunks in memory at a time
+        compression: 'zstd', 'lzma', 'zlib' or None; see app.utils.compression
+        limiter: optional app.utils.throttle.RateLimiter for the reads
+        Returns the writer's header
         """
-        aesgcm = AESGCM(key)
-        nonce = os.urandom(12)
-        
-        with open(file_path, 'rb') as f:
-            data = f.read()
-            
-        ciphertext = aesgcm.encrypt(nonce, data, None)
-        
-        with open(output_path, 'wb') as f:
-            f.write(nonce + ciphertext)
-            
+        with open(file_path, 'rb') as src, open(output_path, 'wb') as dst:
+            with EncryptingWriter(dst, key, chunk_size, compression=compression,
+                                  level=level, workers=workers) as writer:
+                while True:
+                    data = src.read(chunk_size)
+                    if not data:
+                        break
+                    if limiter:
+                        limiter.consume(len(data))
+                    writer.write(data)
+        return writer.header
+
     @staticmethod
-    def decrypt_file(file_path, output_path, key):
+    def iter_plaintext(file_path, key):
         """
-        Decrypt a file using AES-GCM
-        Reads nonce from the beginning of the file
+        Yield the decrypted content of a backup file in chunks
+        Old single-shot files are decrypted in one piece
         """
-        aesgcm = AESGCM(key)
-        
+        if not BackupEncryption.is_chunked(file_path):
+            yield BackupEncryption._decrypt_single_shot(file_path, key)
+            return
+        with open(file_path, 'rb') as f:
+            yield from iter_decrypt(f, key)
+
+    @staticmethod
+    def _decrypt_single_shot(file_path, key):
         with open(file_path, 'rb') as f:
             content = f.read()
-            
-        nonce = content[:12]
-        ciphertext = content[12:]
-        
-        plaintext = aesgcm.decrypt(nonce, ciphertext, None)
-        
-        with open(output_path, 'wb') as f:
-            f.write(plaintext)
+        try:
+            return AESGCM(key).decrypt(content[:12], content[12:], None)
+        except InvalidTag:
+            raise BackupFormatError("Backup failed authentication (wrong key or tampered file)")
+
+    @staticmethod
+    def decrypt_file(file_path, output_path, key):
+        """
+        Decrypt a backup file of either format
+        The output is removed again if any chunk fails authentication
+        """
+        try:
+            with open(output_path, 'wb') as f:
+                for chunk in BackupEncryption.iter_plaintext(file_path, key):
+                    f.write(chunk)
+        except Exception:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
@@ -0,0 +1,23 @@
+"""
+Atomic file writes
+Files are written to a temp file (mkstemp, mode 0600) and moved into place
+once complete; before the move they get the mode a plain open() would
+have given them, so the web server and other processes can still read them
+"""
+import os
+
+
+def _default_mode():
+    # The umask can only be read by setting it; done once, at import
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+FILE_MODE = _default_mode()
+
+
+def replace_readable(temp_path, path):
+    """Give temp_path the default file mode, then move it over path"""
+    os.chmod(temp_path, FILE_MODE)
+    os.replace(temp_path, path)
@@ -0,0 +1,433 @@
+"""
+Streaming structural check of a SQLite database file
+Follows the file format (https://www.sqlite.org/fileformat2.html) page by
+page as the bytes arrive, so a backup can be checked without writing it to
+disk or holding it in memory: the header, the layout of every b-tree page,
+the tree links, overflow chains and freelist, and that every page is used
+exactly once. Row counts come from the table b-tree leaves. Cell contents
+are not decoded (bit rot after the backup was taken is caught by the
+encryption's authentication anyway).
+"""
+import struct
+from array import array
+
+MAGIC = b'SQLite format 3\x00'
+INTERIOR_INDEX, INTERIOR_TABLE, LEAF_INDEX, LEAF_TABLE = 0x02, 0x05, 0x0a, 0x0d
+BTREE_TYPES = (INTERIOR_INDEX, INTERIOR_TABLE, LEAF_INDEX, LEAF_TABLE)
+# Deeper than any real b-tree; guards against loops
+MAX_DEPTH = 40
+# Problems listed before the rest are only counted
+MAX_ERRORS = 50
+# Passes over the file when the schema tree links back to earlier pages
+MAX_PASSES = 4
+LOCK_BYTE_OFFSET = 1073741824
+
+
+def _varint(buf, pos):
+    """Returns (value, position after it)"""
+    value = 0
+    for i in range(8):
+        byte = buf[pos + i]
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, pos + i + 1
+    return (value << 8) | buf[pos + 8], pos + 9
+
+
+def _record(payload):
+    """Decode a record (a row) into a list of values"""
+    header_size, pos = _varint(payload, 0)
+    types = []
+    while pos < header_size:
+        serial, pos = _varint(payload, pos)
+        types.append(serial)
+    values = []
+    pos = header_size
+    for serial in types:
+        if serial in (0, 8, 9):
+            values.append(None if serial == 0 else serial - 8)
+        elif serial <= 6:
+            size = (1, 2, 3, 4, 6, 8)[serial - 1]
+            values.append(int.from_bytes(payload[pos:pos + size], 'big', signed=True))
+            pos += size
+        elif serial == 7:
+            values.append(struct.unpack_from('>d', payload, pos)[0])
+            pos += 8
+        else:
+            size = (serial - 12) // 2
+            value = bytes(payload[pos:pos + size])
+            values.append(value.decode('utf-8', 'replace') if serial % 2 else value)
+            pos += size
+    return values
+
+
+class SqliteStreamChecker:
+    """
+    Usage: SqliteStreamChecker().check(open_stream), where open_stream()
+    returns a fresh iterator over the file's bytes (in any chunk sizes).
+    Usually one pass is enough; the stream is only reopened when the schema
+    tree links to a page that went by before it was known to be needed
+    (only the schema's pages are kept).
+    """
+
+    def __init__(self):
+        self.errors = []
+        self._error_count = 0
+        self.page_size = None
+        self.usable = None
+        self.page_count = 0
+        self.header = {}
+        self.bytes_read = 0
+        # Per page, indexed by page number: b-tree type (0 if the page does
+        # not parse as one), cell count, and its first two 4-byte integers
+        # (the next page of overflow and freelist trunk pages, and a trunk's
+        # leaf count)
+        self._types = array('B', [0])
+        self._cells = array('H', [0])
+        self._next = array('I', [0])
+        self._second = array('I', [0])
+        self._children = {}
+        self._overflows = {}
+        # Raw pages kept to read the schema; pages still wanted and those
+        # that went by before they were, by role: 'schema' (b-tree page) or
+        # 'overflow' (of a schema record)
+        self._kept = {}
+        self._wanted = {}
+        self._missed = {}
+
+    def error(self, message):
+        self._error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(message)
+
+    def check(self, open_stream):
+        """Returns a report: header fields, row count per table, errors"""
+        self._wanted = {1: 'schema'}
+        passes = 0
+        while True:
+            passes += 1
+            self._missed = {}
+            self._run_pass(open_stream(), first=passes == 1)
+            if passes == 1 and self.errors:
+                break
+            if not self._missed or passes >= MAX_PASSES:
+                break
+            # Pages wanted once they were already gone: reread them
+            self._wanted = dict(self._missed)
+        if self._missed:
+            self.error(f"Pages {sorted(self._missed)[:10]} could not be read back")
+        tables = self._check_structure() if not self.errors else {}
+        if self._error_count > len(self.errors):
+            self.errors.append(f"... and {self._error_count - len(self.errors)} more problem(s)")
+        return {
+            'page_size': self.page_size,
+            'pages': self.page_count,
+            'freelist_pages': self.header.get('freelist_pages'),
+            'passes': passes,
+            'tables': tables,
+            'errors': self.errors
+        }
+
+    def _run_pass(self, chunks, first):
+        buffer = bytearray()
+        page_no = 0
+        for chunk in chunks:
+            if first:
+                self.bytes_read += len(chunk)
+            buffer += chunk
+            if self.page_size is None:
+                if len(buffer) < 100:
+                    continue
+                if not self._read_header(bytes(buffer[:100])):
+                    return
+            size = self.page_size
+            whole = len(buffer) - len(buffer) % size
+            view = memoryview(buffer)
+            for start in range(0, whole, size):
+                page_no += 1
+                self._page(page_no, view[start:start + size], first)
+            view.release()
+            del buffer[:whole]
+        if buffer:
+            self.error(f"File ends {len(buffer)} bytes into page {page_no + 1}")
+        if first:
+            self._end_of_file(page_no)
+
+    def _read_header(self, header):
+        if header[:16] != MAGIC:
+            self.error("Not a SQLite database (bad header magic)")
+            return False
+        page_size = struct.unpack_from('>H', header, 16)[0]
+        page_size = 65536 if page_size == 1 else page_size
+        if page_size < 512 or page_size & (page_size - 1):
+            self.error(f"Invalid page size {page_size}")
+            return False
+        reserved = header[20]
+        if header[18] not in (1, 2) or header[19] not in (1, 2):
+            self.error(f"Unknown file format versions {header[18]}/{header[19]}")
+        if header[21:24] != b'\x40\x20\x20':
+            self.error("Invalid payload fractions in the header")
+        change_counter, page_count, first_trunk, freelist_pages = struct.unpack_from('>IIII', header, 24)
+        valid_for = struct.unpack_from('>I', header, 92)[0]
+        self.page_size = page_size
+        self.usable = page_size - reserved
+        if self.usable < 480:
+            self.error(f"Usable page size {self.usable} is too small")
+        self.header = {
+            # The in-header size is only trusted if written by the same change
+            'page_count': page_count if valid_for == change_counter else None,
+            'first_trunk': first_trunk,
+            'freelist_pages': freelist_pages,
+            'autovacuum': struct.unpack_from('>I', header, 52)[0] != 0,
+            'text_encoding': struct.unpack_from('>I', header, 56)[0]
+        }
+        if self.header['text_encoding'] not in (0, 1, 2, 3):
+            self.error(f"Unknown text encoding {self.header['text_encoding']}")
+        return True
+
+    def _end_of_file(self, pages):
+        self.page_count = pages
+        if pages == 0:
+            self.error("Database has no pages")
+        expected = self.header.get('page_count')
+        if expected is not None and expected != pages:
+            self.error(f"Header says {expected} pages, file has {pages}")
+
+    def _want(self, page_no, role, current):
+        """Keep page_no when it arrives; remember it if it already went by"""
+        if not page_no or page_no in self._kept:
+            return
+        if page_no <= current:
+            self._missed[page_no] = role
+        else:
+            self._wanted[page_no] = role
+
+    def _page(self, page_no, page, first):
+        if first:
+            self._types.append(0)
+            self._cells.append(0)
+            self._next.append(int.from_bytes(page[:4], 'big'))
+            self._second.append(int.from_bytes(page[4:8], 'big'))
+            self._parse_btree(page_no, page)
+        role = self._wanted.pop(page_no, None)
+        if role is None:
+            return
+        self._kept[page_no] = bytes(page)
+        # Keep what the page links to as well
+        if role == 'schema':
+            for child in self._children.get(page_no, ()):
+                self._want(child, 'schema', page_no)
+            for first_page, _ in self._overflows.get(page_no, ()):
+                self._want(first_page, 'overflow', page_no)
+        else:
+            self._want(self._next[page_no], role, page_no)
+
+    def _parse_btree(self, page_no, page):
+        """Record a page that parses as a b-tree page (freelist pages may too)"""
+        offset = 100 if page_no == 1 else 0
+        kind = page[offset]
+        if kind not in BTREE_TYPES:
+            if page_no == 1:
+                self.error(f"Page 1 is not a b-tree page (type {kind})")
+            return
+        interior = kind in (INTERIOR_INDEX, INTERIOR_TABLE)
+        header_size = 12 if interior else 8
+        cells, content = struct.unpack_from('>HH', page, offset + 3)
+        content = content or 65536
+        usable = self.usable
+        pointers_end = offset + header_size + 2 * cells
+        if pointers_end > content or content > usable:
+            if page_no == 1:
+                self.error("Page 1 has an invalid b-tree header")
+            return
+        pointers = struct.unpack_from(f'>{cells}H', page, offset + header_size)
+        if len(set(pointers)) != cells:
+            if page_no == 1:
+                self.error("Page 1 has two cells at the same offset")
+            return
+        children = array('I') if interior else None
+        overflows = []
+        if kind == LEAF_TABLE:
+            max_local = usable - 35
+        else:
+            max_local = (usable - 12) * 64 // 255 - 23
+        min_local = (usable - 12) * 32 // 255 - 23
+        for pointer in pointers:
+            if pointer < content or pointer >= usable:
+                if page_no == 1:
+                    self.error(f"Page 1 has a cell outside its content area")
+                return
+            pos = pointer
+            if interior:
+                children.append(int.from_bytes(page[pos:pos + 4], 'big'))
+                if kind == INTERIOR_TABLE:
+                    continue
+                pos += 4
+            # Payload sizes are nearly always 1- or 2-byte varints
+            byte = page[pos]
+            if byte < 0x80:
+                payload = byte
+                pos += 1
+            elif page[pos + 1] < 0x80:
+                payload = ((byte & 0x7f) << 7) | page[pos + 1]
+                pos += 2
+            else:
+                payload, pos = _varint(page, pos)
+            if payload > max_local:
+                if kind == LEAF_TABLE:
+                    _, pos = _varint(page, pos)
+                local = min_local + (payload - min_local) % (usable - 4)
+                if local > max_local:
+                    local = min_local
+                if pos + local + 4 > usable:
+                    return
+                pages = -(-(payload - local) // (usable - 4))
+                overflows.append((int.from_bytes(page[pos + local:pos + local + 4], 'big'), pages))
+        if interior:
+            children.append(int.from_bytes(page[offset + 8:offset + 12], 'big'))
+            self._children[page_no] = children
+        if overflows:
+            self._overflows[page_no] = overflows
+        self._types[page_no] = kind
+        self._cells[page_no] = cells
+
+    def _payload(self, page, pos, payload_size, max_local, min_local):
+        """Reassemble a cell's payload from a kept page and its overflow pages"""
+        usable = self.usable
+        if payload_size <= max_local:
+            return page[pos:pos + payload_size]
+        local = min_local + (payload_size - min_local) % (usable - 4)
+        if local > max_local:
+            local = min_local
+        data = bytearray(page[pos:pos + local])
+        next_page = int.from_bytes(page[pos + local:pos + local + 4], 'big')
+        while len(data) < payload_size and next_page in self._kept:
+            overflow = self._kept[next_page]
+            data += overflow[4:4 + min(usable - 4, payload_size - len(data))]
+            next_page = int.from_bytes(overflow[:4], 'big')
+        if len(data) < payload_size:
+            raise ValueError("schema record overflow chain is incomplete")
+        return bytes(data)
+
+    def _schema(self):
+        """Rows of sqlite_schema (type, name, tbl_name, rootpage, sql), read from the kept pages"""
+        rows = []
+        usable = self.usable
+        stack, seen = [1], set()
+        while stack:
+            page_no = stack.pop()
+            if page_no in seen or page_no not in self._kept:
+                raise ValueError(f"schema page {page_no} is missing")
+            seen.add(page_no)
+            page = self._kept[page_no]
+            offset = 100 if page_no == 1 else 0
+            kind = page[offset]
+            if kind == INTERIOR_TABLE:
+                stack.extend(self._children.get(page_no, ()))
+                continue
+            if kind != LEAF_TABLE:
+                raise ValueError(f"schema page {page_no} has type {kind}")
+            cells = struct.unpack_from('>H', page, offset + 3)[0]
+            for pointer in struct.unpack_from(f'>{cells}H', page, offset + 8):
+                size, pos = _varint(page, pointer)
+                _, pos = _varint(page, pos)
+                rows.append(_record(self._payload(page, pos, size, usable - 35, (usable - 12) * 32 // 255 - 23)))
+        return rows
+
+    def _check_structure(self):
+        """Walk every b-tree, overflow chain and the freelist; returns rows per table"""
+        used = bytearray(self.page_count + 1)
+
+        def use(page_no, what):
+            if page_no < 1 or page_no > self.page_count:
+                self.error(f"{what} points to page {page_no}, outside the file")
+                return False
+            if used[page_no]:
+                self.error(f"Page {page_no} is used twice ({what})")
+                return False
+            used[page_no] = 1
+            return True
+
+        try:
+            schema = self._schema()
+        except (ValueError, IndexError, struct.error) as e:
+            self.error(f"Cannot read the schema: {e}")
+            return {}
+
+        roots = [('table', 'sqlite_schema', 1, None)]
+        for row in schema:
+            if len(row) >= 5 and isinstance(row[3], int) and row[3] > 0:
+                roots.append((row[0], row[1], row[3], row[4]))
+
+        tables = {}
+        for kind, name, root, sql in roots:
+            # WITHOUT ROWID tables are stored as index b-trees
+            table_tree = kind == 'table' and 'WITHOUT ROWID' not in (sql or '').upper()
+            rows = 0
+            stack = [(root, 0)]
+            while stack:
+                page_no, depth = stack.pop()
+                if not use(page_no, f"b-tree of {name}"):
+                    continue
+                page_type = self._types[page_no]
+                expected = (INTERIOR_TABLE, LEAF_TABLE) if table_tree else (INTERIOR_INDEX, LEAF_INDEX)
+                if page_type not in expected:
+                    self.error(f"Page {page_no} of {name} is not a valid {kind} b-tree page")
+                    continue
+                if depth > MAX_DEPTH:
+                    self.error(f"b-tree of {name} is deeper than {MAX_DEPTH} levels")
+                    continue
+                if page_type == LEAF_TABLE or not table_tree:
+                    rows += self._cells[page_no]
+                for child in self._children.get(page_no, ()):
+                    stack.append((child, depth + 1))
+                for first_page, count in self._overflows.get(page_no, ()):
+                    overflow = first_page
+                    for i in range(count):
+                        if not use(overflow, f"overflow chain of {name}"):
+                            break
+                        next_page = self._next[overflow]
+                        if i == count - 1 and next_page:
+                            self.error(f"Overflow chain of {name} runs past page {overflow}")
+                        overflow = next_page
+            if kind == 'table' and name != 'sqlite_schema':
+                tables[name] = rows
+
+        free_leaves = self._check_freelist(use)
+
+        if self.header.get('autovacuum'):
+            entries = self.usable // 5
+            page_no = 2
+            while page_no <= self.page_count:
+                use(page_no, "pointer map")
+                page_no += entries + 1
+        lock_page = LOCK_BYTE_OFFSET // self.page_size + 1
+        if lock_page <= self.page_count:
+            use(lock_page, "lock-byte page")
+
+        # Whatever is left must be the freelist leaves
+        unused = used.count(0) - 1
+        if free_leaves is not None and unused != free_leaves:
+            self.error(f"{unused} page(s) are not in use, but the freelist has {free_leaves} leaf page(s)")
+        return tables
+
+    def _check_freelist(self, use):
+        """
+        Walk the trunk chain; returns how many leaf pages the trunks list
+        (their page numbers are not kept, so the leaves are checked by count)
+        """
+        trunk = self.header.get('first_trunk', 0)
+        trunks = leaves = 0
+        while trunk:
+            if not use(trunk, "freelist trunk"):
+                return None
+            count = self._second[trunk]
+            if count > self.usable // 4 - 2:
+                self.error(f"Freelist trunk page {trunk} lists {count} pages")
+                return None
+            trunks += 1
+            leaves += count
+            trunk = self._next[trunk]
+        if trunks + leaves != self.header.get('freelist_pages'):
+            self.error(f"Freelist has {trunks + leaves} pages, header says {self.header.get('freelist_pages')}")
+        return leaves
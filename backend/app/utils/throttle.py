@@ -0,0 +1,36 @@
+"""
+I/O rate limiting for background work (e.g. scheduled backups), so it
+does not compete with requests for the disk
+"""
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket over bytes: consume() sleeps once the caller gets ahead of
+    bytes_per_second, allowing bursts of up to one second's worth
+    With no rate it only counts, so callers can always report totals
+    """
+
+    def __init__(self, bytes_per_second=None):
+        self.rate = bytes_per_second or None
+        self.total = 0
+        self.slept = 0.0
+        self._allowance = self.rate or 0
+        self._checked = time.monotonic()
+
+    def consume(self, nbytes):
+        self.total += nbytes
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._allowance = min(self.rate, self._allowance + (now - self._checked) * self.rate)
+        self._checked = now
+        self._allowance -= nbytes
+        if self._allowance < 0:
+            delay = -self._allowance / self.rate
+            time.sleep(delay)
+            self.slept += delay
+            self._allowance = 0
+            self._checked = time.monotonic()
+
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Migration: add backup format and incremental chain tracking to backups
+
+Adds backups.backup_format (existing backups are database file copies
+and are marked 'sqlite'), backups.backup_type, parent_id, high_water_ms,
+id_marks, restored_at, storage (existing backups are self-contained
+files) and upload_files (existing backups have no uploads), and creates the deleted_rows log and the backup_runs history. Existing backups have no high-water mark, so the
+first incremental needs a new full backup.
+
+Usage:
+    python scripts/add_backup_columns.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import inspect, text
+from app import create_app, db
+from app.models.backup_meta import BackupMeta  # noqa: F401
+from app.models.deleted_row import DeletedRow
+from app.models.backup_run import BackupRun
+
+COLUMNS = [
+    ("backup_format", "VARCHAR(20) NOT NULL DEFAULT 'sqlite'"),
+    ("backup_type", "VARCHAR(20) NOT NULL DEFAULT 'full'"),
+    ("parent_id", "INTEGER REFERENCES backups(id)"),
+    ("high_water_ms", "BIGINT"),
+    ("id_marks", "JSON"),
+    ("restored_at", "BIGINT"),
+    ("storage", "VARCHAR(20) NOT NULL DEFAULT 'file'"),
+    ("upload_files", "INTEGER"),
+]
+
+
+def add_columns():
+    inspector = inspect(db.engine)
+    if not inspector.has_table('deleted_rows'):
+        DeletedRow.__table__.create(db.engine)
+        print("Created table: deleted_rows")
+    if not inspector.has_table('backups'):
+        db.create_all()
+        print("Created table: backups")
+        return
+    existing = {c['name'] for c in inspector.get_columns('backups')}
+    for col_name, col_type in COLUMNS:
+        if col_name in existing:
+            print(f"Column {col_name} already exists.")
+            continue
+        db.session.execute(text(f"ALTER TABLE backups ADD COLUMN {col_name} {col_type}"))
+        print(f"Added column: {col_name}")
+    db.session.commit()
+    if not inspector.has_table('backup_runs'):
+        BackupRun.__table__.create(db.engine)
+        print("Created table: backup_runs")
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        add_columns()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Migration: add denormalized pending totals to fees and backfill them
+
+Adds fees.pending_amount, fees.pending_count and fees.pending_proofs,
+fills them from PENDING transactions, then runs the consistency check.
+
+Usage:
+    python scripts/add_fee_pending_columns.py           # migrate + backfill
+    python scripts/add_fee_pending_columns.py --check   # consistency check only
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import inspect, text
+from app import create_app, db
+from app.services.fee_service import FeeService
+
+COLUMNS = [
+    ("pending_amount", "NUMERIC(10, 2) NOT NULL DEFAULT 0"),
+    ("pending_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("pending_proofs", "JSON"),
+]
+
+
+def add_columns():
+    existing = {c['name'] for c in inspect(db.engine).get_columns('fees')}
+    for col_name, col_type in COLUMNS:
+        if col_name in existing:
+            print(f"Column {col_name} already exists.")
+            continue
+        db.session.execute(text(f"ALTER TABLE fees ADD COLUMN {col_name} {col_type}"))
+        print(f"Added column: {col_name}")
+    db.session.commit()
+
+
+def check():
+    mismatches = FeeService.find_pending_mismatches()
+    for m in mismatches[:20]:
+        print(f"Fee #{m['fee_id']}: stored={m['stored']} actual={m['actual']}")
+    if len(mismatches) > 20:
+        print(f"... and {len(mismatches) - 20} more")
+    print(f"{len(mismatches)} fee(s) with inconsistent pending totals")
+    return not mismatches
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        if '--check' in sys.argv:
+            sys.exit(0 if check() else 1)
+
+        add_columns()
+        fixed = FeeService.repair_pending_totals()
+        print(f"Backfilled pending totals on {fixed} fee(s)")
+        sys.exit(0 if check() else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Migration: content-addressed payment proofs
+
+Creates the proof_blobs and transaction_proofs tables, then moves the
+proofs saved as <uuid4>_<name> into blobs named by the SHA-256 of their
+content: byte-identical copies become one file, the transactions and
+fees referencing them are rewritten to the blob path, and the old files
+are removed once the rows no longer point at them. Adds the image
+processing columns to an existing proof_blobs table, and removes links
+left by transactions deleted before their link was deleted with them
+(SQLite can reuse the id, and the new transaction's link would clash);
+run scripts/process_proof_images.py afterwards to make the thumbnails.
+
+Usage:
+    python scripts/add_proof_blobs.py            # migrate
+    python scripts/add_proof_blobs.py --dry-run  # create tables, report what would move
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import inspect, text
+from app import create_app, db
+from app.models.proof_blob import ProofBlob, TransactionProof
+from app.models.transaction import Transaction
+from app.services.proof_storage_service import ProofStorageService
+
+COLUMNS = [
+    ("updated_at", "BIGINT"),
+    ("image_status", "VARCHAR(20) NOT NULL DEFAULT 'pending'"),
+    ("image_extension", "VARCHAR(10)"),
+]
+
+
+def create_tables():
+    inspector = inspect(db.engine)
+    for table in (ProofBlob.__table__, TransactionProof.__table__):
+        if inspector.has_table(table.name):
+            print(f"Table {table.name} already exists.")
+            continue
+        table.create(db.engine)
+        print(f"Created table: {table.name}")
+
+    existing = {c['name'] for c in inspector.get_columns('proof_blobs')}
+    for col_name, col_type in COLUMNS:
+        if col_name in existing:
+            continue
+        db.session.execute(text(f"ALTER TABLE proof_blobs ADD COLUMN {col_name} {col_type}"))
+        print(f"Added column: {col_name}")
+    db.session.commit()
+
+
+def remove_orphan_links(dry_run=False):
+    links = TransactionProof.query.filter(
+        TransactionProof.transaction_id.notin_(db.session.query(Transaction.id))
+    ).all()
+    if not links:
+        return
+    if dry_run:
+        print(f"{len(links)} link(s) to deleted transactions would be removed")
+        return
+    # Through the session, so incremental backups see the deletions
+    for link in links:
+        db.session.delete(link)
+    db.session.commit()
+    print(f"Removed {len(links)} link(s) to deleted transactions")
+
+
+def main():
+    dry_run = '--dry-run' in sys.argv
+    app = create_app()
+    with app.app_context():
+        create_tables()
+        remove_orphan_links(dry_run)
+        summary = ProofStorageService.adopt_legacy(dry_run=dry_run)
+        for proof_path in summary['missing']:
+            print(f"Missing or not a proof file: {proof_path}")
+        if dry_run:
+            print(f"{summary['files']} proof file(s) would move to content-addressed storage")
+            return
+        print(f"Moved {summary['files']} proof file(s) into {summary['blobs_created']} new blob(s), "
+              f"updated {summary['rows_updated']} row(s), freed {summary['bytes_freed'] / 1024 / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
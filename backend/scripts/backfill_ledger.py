@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Migration: create the fee ledger tables and backfill them from history
+
+Posts a CHARGE for every fee, a LATE_FEE for any recorded late fee and a
+PAYMENT for every approved transaction, dated when they happened, then
+rebuilds the balance snapshots. Safe to re-run: fees and transactions
+that already have entries are skipped. Entries and snapshots left behind
+by students deleted before their ledger history was deleted with them
+are removed first.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app, db
+from app.models.fee import Fee
+from app.models.student import Student
+from app.models.transaction import Transaction
+from app.models.ledger_entry import LedgerEntry
+from app.models.balance_snapshot import BalanceSnapshot
+from app.services.ledger_service import LedgerService
+
+BATCH_SIZE = 1000
+
+
+def remove_orphans():
+    """Delete ledger rows whose student, fee or transaction no longer exists"""
+    entries = LedgerEntry.query.filter(db.or_(
+        LedgerEntry.student_id.notin_(db.session.query(Student.id)),
+        db.and_(LedgerEntry.fee_id.isnot(None), LedgerEntry.fee_id.notin_(db.session.query(Fee.id))),
+        db.and_(LedgerEntry.transaction_id.isnot(None),
+                LedgerEntry.transaction_id.notin_(db.session.query(Transaction.id)))
+    )).all()
+    snapshots = BalanceSnapshot.query.filter(
+        BalanceSnapshot.student_id.notin_(db.session.query(Student.id))
+    ).all()
+    # Through the session, so incremental backups see the deletions
+    for row in entries + snapshots:
+        db.session.delete(row)
+    db.session.commit()
+    print(f"Removed {len(entries)} orphaned ledger entries and {len(snapshots)} snapshot(s)")
+
+
+def backfill_fees():
+    charged = {fee_id for (fee_id,) in db.session.query(LedgerEntry.fee_id)
+               .filter(LedgerEntry.entry_type == 'CHARGE')}
+    posted = 0
+    for fee in Fee.query.order_by(Fee.id).yield_per(BATCH_SIZE):
+        if fee.id in charged:
+            continue
+        LedgerService.post_charge(fee, posted_at=fee.created_at)
+        if fee.late_fee:
+            LedgerService.post_late_fee(fee, fee.late_fee, posted_at=fee.created_at)
+        posted += 1
+    db.session.commit()
+    print(f"Posted charges for {posted} fee(s)")
+    return posted
+
+
+def backfill_payments():
+    paid = {trx_id for (trx_id,) in db.session.query(LedgerEntry.transaction_id)
+            .filter(LedgerEntry.entry_type == 'PAYMENT')}
+    posted = 0
+    rows = db.session.query(Transaction, Fee).join(Fee, Transaction.fee_id == Fee.id)\
+        .filter(Transaction.status == 'APPROVED').order_by(Transaction.id).yield_per(BATCH_SIZE)
+    for trx, fee in rows:
+        if trx.id in paid:
+            continue
+        LedgerService.post_payment(
+            fee, trx, actor_id=trx.approved_by_id,
+            posted_at=trx.approved_at or trx.transaction_date
+        )
+        posted += 1
+    db.session.commit()
+    print(f"Posted {posted} payment(s)")
+    return posted
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        LedgerEntry.__table__.create(db.engine, checkfirst=True)
+        BalanceSnapshot.__table__.create(db.engine, checkfirst=True)
+        remove_orphans()
+        posted = backfill_fees() + backfill_payments()
+        if posted:
+            # Backdated entries invalidate snapshots; they are derived, so rebuild
+            BalanceSnapshot.query.delete()
+            db.session.commit()
+        print(f"Wrote {LedgerService.take_snapshots()} balance snapshot(s)")
+
+
+if __name__ == '__main__':
+    main()
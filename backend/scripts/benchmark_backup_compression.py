@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Benchmark the backup compression stage: ratio and throughput per codec
+
+Snapshots the SQLite database (or builds a synthetic one with --seed),
+then runs the backup pipeline (compress + encrypt) and its reverse over
+the snapshot for every algorithm, level and worker count asked for.
+
+Usage:
+    python scripts/benchmark_backup_compression.py                  # configured SQLite database
+    python scripts/benchmark_backup_compression.py --db path/to.db
+    python scripts/benchmark_backup_compression.py --seed 5000      # synthetic DB, 5000 students
+    python scripts/benchmark_backup_compression.py --algorithms zstd zlib --levels 1 3 --workers 1 4
+"""
+import argparse
+import os
+import random
+import secrets
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.utils import compression
+from app.utils.encryption import BackupEncryption, COMPRESSION_WORKERS
+
+FIRST_NAMES = ['Ali', 'Sara', 'Usman', 'Ayesha', 'Bilal', 'Fatima', 'Hamza', 'Zainab', 'Omar', 'Hira']
+LAST_NAMES = ['Khan', 'Ahmed', 'Malik', 'Hussain', 'Raza', 'Sheikh', 'Qureshi', 'Butt', 'Iqbal', 'Chaudhry']
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def seed(path, students):
+    """Build a synthetic database: 2 years of fees, 90 days of reports per student"""
+    os.environ['DATABASE_URL'] = f"sqlite:///{path}"
+    from app import create_app, db
+    from app.models import User, Student, Fee, Report, LedgerEntry, AuditLog
+
+    rng = random.Random(42)
+    start_ms = int(time.time() * 1000) - 2 * 365 * DAY_MS
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        db.session.bulk_insert_mappings(User, [{
+            'email': f"student{i}@hostel.example",
+            'password_hash': '$2b$12$' + secrets.token_urlsafe(40)[:53],
+            'display_name': f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            'role': 'student',
+            'created_at': start_ms + rng.randrange(30 * DAY_MS)
+        } for i in range(students)])
+        db.session.commit()
+        user_ids = [u for (u,) in db.session.query(User.id).order_by(User.id)]
+        db.session.bulk_insert_mappings(Student, [{
+            'user_id': user_id,
+            'admission_no': f"HX-{2024 + i % 2}-{i:05d}",
+            'room': f"{rng.choice('ABCD')}-{rng.randrange(1, 60):02d}",
+            'monthly_fee_amount': rng.choice([4500, 5000, 5500]),
+            'profile_json': {'phone': f"03{rng.randrange(10**9):09d}", 'guardian': rng.choice(LAST_NAMES)},
+            'created_at': start_ms + rng.randrange(30 * DAY_MS)
+        } for i, user_id in enumerate(user_ids)])
+        db.session.commit()
+        student_ids = [s for (s,) in db.session.query(Student.id).order_by(Student.id)]
+
+        for student_id in student_ids:
+            fees, reports, audit = [], [], []
+            for n in range(24):
+                amount = rng.choice([4500, 5000, 5500])
+                paid = amount if rng.random() < 0.8 else rng.choice([0, amount // 2])
+                fees.append({
+                    'student_id': student_id, 'month': n % 12 + 1, 'year': 2024 + n // 12,
+                    'expected_amount': amount, 'paid_amount': paid, 'late_fee': 0,
+                    'pending_amount': 0, 'pending_count': 0,
+                    'status': 'PAID' if paid == amount else ('PARTIAL' if paid else 'UNPAID'),
+                    'created_at': start_ms + n * 30 * DAY_MS
+                })
+            for day in range(90):
+                if rng.random() < 0.9:
+                    reports.append({
+                        'student_id': student_id,
+                        'wake_time': start_ms + day * DAY_MS + rng.randrange(5 * 3600 * 1000, 8 * 3600 * 1000),
+                        'walk': rng.random() < 0.5, 'exercise': rng.random() < 0.3,
+                        'late_minutes': rng.choice([0, 0, 0, 5, 15]), 'status': 'APPROVED',
+                        'created_at': start_ms + day * DAY_MS
+                    })
+            for _ in range(10):
+                audit.append({
+                    'user_id': student_id, 'action': rng.choice(['LOGIN', 'FEE_SUBMIT', 'REPORT_CREATE']),
+                    'entity': 'student', 'entity_id': student_id,
+                    'timestamp': start_ms + rng.randrange(700 * DAY_MS),
+                    'ip': f"10.0.{rng.randrange(256)}.{rng.randrange(256)}",
+                    'device': 'Mozilla/5.0 (Linux; Android 13) AppleWebKit/537.36 Chrome/120.0 Mobile',
+                    'details_json': {'source': 'app', 'version': '1.4.2'}
+                })
+            db.session.bulk_insert_mappings(Fee, fees)
+            db.session.bulk_insert_mappings(Report, reports)
+            db.session.bulk_insert_mappings(AuditLog, audit)
+        db.session.commit()
+
+        entries = []
+        for fee_id, student_id, amount, paid in db.session.query(
+                Fee.id, Fee.student_id, Fee.expected_amount, Fee.paid_amount):
+            entries.append({'student_id': student_id, 'fee_id': fee_id, 'entry_type': 'CHARGE',
+                            'debit_account': 'receivable', 'credit_account': 'fee_income', 'amount': amount})
+            if paid:
+                entries.append({'student_id': student_id, 'fee_id': fee_id, 'entry_type': 'PAYMENT',
+                                'debit_account': 'cash', 'credit_account': 'receivable', 'amount': paid})
+        db.session.bulk_insert_mappings(LedgerEntry, entries)
+        db.session.commit()
+
+
+def snapshot(db_path, out_path):
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(out_path)
+    with dst:
+        src.backup(dst)
+    dst.close()
+    src.close()
+
+
+def run(plain_path, algorithm, level, workers, key):
+    size = os.path.getsize(plain_path)
+    fd, enc_path = tempfile.mkstemp(suffix='.enc')
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        BackupEncryption.encrypt_file(plain_path, enc_path, key, compression=algorithm,
+                                      level=level, workers=workers)
+        write_s = time.perf_counter() - started
+        out_size = os.path.getsize(enc_path)
+
+        started = time.perf_counter()
+        restored = sum(len(chunk) for chunk in BackupEncryption.iter_plaintext(enc_path, key))
+        read_s = time.perf_counter() - started
+        if restored != size:
+            raise SystemExit(f"{algorithm}: restored {restored} bytes, expected {size}")
+    finally:
+        os.remove(enc_path)
+
+    mb = size / 1024 / 1024
+    print(f"{algorithm or 'none':<6} {level if level is not None else '-':>5} {workers:>7} "
+          f"{out_size / 1024 / 1024:>9.1f} {size / out_size:>6.2f}x "
+          f"{mb / write_s:>9.1f} {mb / read_s:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark backup compression')
+    parser.add_argument('--db', help='SQLite database file (default: the configured one)')
+    parser.add_argument('--seed', type=int, metavar='STUDENTS', help='Benchmark a synthetic database instead')
+    parser.add_argument('--algorithms', nargs='+', default=['none'] + compression.available())
+    parser.add_argument('--levels', nargs='+', type=int, help='Levels to try (default: each codec default)')
+    parser.add_argument('--workers', nargs='+', type=int, default=sorted({1, COMPRESSION_WORKERS}))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='backup_bench_')
+    plain_path = os.path.join(workdir, 'snapshot.db')
+    try:
+        if args.seed:
+            started = time.perf_counter()
+            seed(plain_path, args.seed)
+            print(f"Seeded {args.seed} students in {time.perf_counter() - started:.1f}s")
+        else:
+            db_path = args.db
+            if not db_path:
+                from app import create_app
+                from app.services.backup_service import BackupService
+                with create_app().app_context():
+                    db_path = BackupService._get_db_path()
+            snapshot(db_path, plain_path)
+
+        print(f"Database snapshot: {os.path.getsize(plain_path) / 1024 / 1024:.1f} MB, "
+              f"{os.cpu_count()} CPU(s)\n")
+        print(f"{'codec':<6} {'level':>5} {'workers':>7} {'out MB':>9} {'ratio':>7} {'enc MB/s':>9} {'dec MB/s':>9}")
+        key = BackupEncryption.generate_key()
+        for algorithm in args.algorithms:
+            algorithm = None if algorithm == 'none' else algorithm
+            if algorithm is None:
+                run(plain_path, None, None, 1, key)
+                continue
+            compression.check(algorithm)
+            for level in args.levels or [compression.DEFAULT_LEVELS[algorithm]]:
+                for workers in args.workers:
+                    run(plain_path, algorithm, level, workers, key)
+    finally:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
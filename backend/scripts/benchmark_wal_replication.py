@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Benchmark the write overhead of WAL replication
+
+Runs the same write workload (a ledger entry plus a balance update per
+transaction, like a fee payment) against a scratch SQLite database three
+ways: rollback journal, WAL mode, and WAL mode with the replicator
+shipping segments from another process, as scripts/replicate_wal.py does
+in production. Reports transactions per second and commit latency, flat
+out or (with --rate) at a steady load, where latency is what users see.
+
+Usage:
+    python scripts/benchmark_wal_replication.py
+    python scripts/benchmark_wal_replication.py --transactions 5000 --interval 0.5
+    python scripts/benchmark_wal_replication.py --rate 200               # 200 transactions/s
+    python scripts/benchmark_wal_replication.py --compression none
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.utils import compression
+from app.utils.encryption import BackupEncryption
+
+STUDENTS = 2000
+
+
+def create(path):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE balances (student_id INTEGER PRIMARY KEY, balance INTEGER NOT NULL);
+        CREATE TABLE ledger (
+            id INTEGER PRIMARY KEY, student_id INTEGER NOT NULL, amount INTEGER NOT NULL,
+            memo TEXT, created_at INTEGER NOT NULL
+        );
+        CREATE INDEX ix_ledger_student ON ledger (student_id);
+    """)
+    with conn:
+        conn.executemany('INSERT INTO balances VALUES (?, 0)', [(i,) for i in range(STUDENTS)])
+    conn.close()
+
+
+def replicate(db_path, wal_root, key, algorithm, interval, ready, stop, totals):
+    """The replicator process: ship until stop is set, then report its totals"""
+    from app.services.replication_service import WalReplicator
+
+    replicator = WalReplicator(db_path, wal_root, key, algorithm)
+    replicator.start()
+    ready.set()
+    while not stop.is_set():
+        replicator.sync()
+        replicator.wait(interval, stop)
+    replicator.close()
+    totals.put((replicator.frames_shipped, replicator.bytes_written))
+
+
+def workload(db_path, transactions, rate):
+    """Latency of each transaction, in seconds"""
+    rng = random.Random(42)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    latencies = []
+    begun = time.perf_counter()
+    for n in range(transactions):
+        if rate:
+            time.sleep(max(0, begun + n / rate - time.perf_counter()))
+        student_id = rng.randrange(STUDENTS)
+        amount = rng.choice([4500, 5000, 5500])
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('INSERT INTO ledger (student_id, amount, memo, created_at) VALUES (?, ?, ?, ?)',
+                     (student_id, amount, f"Fee payment {n} via bank transfer", int(time.time() * 1000)))
+        conn.execute('UPDATE balances SET balance = balance + ? WHERE student_id = ?', (amount, student_id))
+        conn.execute('COMMIT')
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+    return latencies
+
+
+def run(mode, workdir, transactions, rate, key, algorithm, interval):
+    db_path = os.path.join(workdir, f"{mode}.db")
+    create(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute(f"PRAGMA journal_mode={'DELETE' if mode == 'journal' else 'WAL'}")
+    conn.close()
+
+    process = None
+    if mode == 'replicated':
+        wal_root = os.path.join(workdir, 'wal')
+        os.makedirs(wal_root)
+        ready, stop, totals = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=replicate, args=(db_path, wal_root, key, algorithm, interval, ready, stop, totals)
+        )
+        process.start()
+        if not ready.wait(60):
+            process.terminate()
+            raise SystemExit("The replicator did not start")
+
+    started = time.perf_counter()
+    latencies = workload(db_path, transactions, rate)
+    elapsed = time.perf_counter() - started
+
+    shipped = ''
+    if process:
+        stop.set()
+        frames, written = totals.get(timeout=60)
+        process.join()
+        shipped = f"{frames} frames, {written / 1024 / 1024:.1f} MB shipped"
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'tps': transactions / elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'shipped': shipped
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WAL replication overhead')
+    parser.add_argument('--transactions', type=int, default=2000)
+    parser.add_argument('--rate', type=float, help='Transactions per second (default: as fast as possible)')
+    parser.add_argument('--interval', type=float, default=1.0, help='Replicator sync interval in seconds')
+    parser.add_argument('--compression', default=compression.default_algorithm() or 'none',
+                        help='Segment compression (default: as for backups)')
+    args = parser.parse_args()
+
+    algorithm = None if args.compression == 'none' else args.compression
+    if algorithm:
+        compression.check(algorithm)
+    key = BackupEncryption.generate_key()
+    workdir = tempfile.mkdtemp(prefix='wal_bench_')
+    try:
+        print(f"{args.transactions} transactions at {f'{args.rate:g}/s' if args.rate else 'full speed'}, "
+              f"sync every {args.interval}s, "
+              f"segments compressed with {algorithm or 'nothing'}\n")
+        print(f"{'mode':<11} {'tx/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'vs WAL':>8}")
+        baseline = None
+        for mode in ('journal', 'wal', 'replicated'):
+            result = run(mode, workdir, args.transactions, args.rate, key, algorithm, args.interval)
+            if mode == 'wal':
+                baseline = result['tps']
+            overhead = f"{(baseline / result['tps'] - 1) * 100:+.1f}%" if baseline else '-'
+            print(f"{mode:<11} {result['tps']:>8.0f} {result['p50']:>8.2f} {result['p99']:>8.2f} "
+                  f"{overhead:>8} {result['shipped']}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
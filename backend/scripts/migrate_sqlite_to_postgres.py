@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Move a SQLite database into the PostgreSQL database configured by DATABASE_URL
+
+Every model table is streamed through COPY with its ids kept, sequences
+are reset past them, and each table is verified by row count and SHA-256
+checksum before anything is committed; on any failure the target is left
+as it was. Stop the app first, so the SQLite file does not change meanwhile.
+
+Usage:
+    DATABASE_URL=postgresql://... python scripts/migrate_sqlite_to_postgres.py instance/hostelixpro.db
+    DATABASE_URL=postgresql://... python scripts/migrate_sqlite_to_postgres.py instance/hostelixpro.db --check
+    DATABASE_URL=postgresql://... python scripts/migrate_sqlite_to_postgres.py instance/hostelixpro.db --replace
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app, db
+from app.services.database_migration_service import DatabaseMigrationService, MigrationError
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate a SQLite database to PostgreSQL')
+    parser.add_argument('source', help='SQLite database file')
+    parser.add_argument('--check', action='store_true', help='Only check the source can be migrated')
+    parser.add_argument('--replace', action='store_true', help='Empty target tables that already hold rows')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.source):
+        print(f"{args.source} does not exist")
+        sys.exit(1)
+
+    app = create_app()
+    with app.app_context():
+        if args.check:
+            check = DatabaseMigrationService.check_source(args.source)
+            for table, rows in check['tables'].items():
+                print(f"{table}: {rows} row(s)")
+            if check['missing_tables']:
+                print(f"Not in the source (left empty): {', '.join(check['missing_tables'])}")
+            if check['extra_tables']:
+                print(f"Not migrated (no model): {', '.join(check['extra_tables'])}")
+            for problem in check['problems']:
+                print(f"Problem: {problem}")
+            sys.exit(1 if check['problems'] else 0)
+
+        def progress(fraction):
+            print(f"\r{fraction * 100:5.1f}%", end='', flush=True)
+
+        started = time.perf_counter()
+        try:
+            results = DatabaseMigrationService.migrate(args.source, db.engine, replace=args.replace,
+                                                       progress=progress)
+        except MigrationError as e:
+            print(f"\n{e}")
+            sys.exit(1)
+        elapsed = time.perf_counter() - started
+
+    print()
+    for table, result in results.items():
+        print(f"{table}: {result['rows']} row(s), sha256 {result['sha256'][:16]}")
+    size = os.path.getsize(args.source) / 1024 / 1024
+    print(f"Migrated and verified {sum(r['rows'] for r in results.values())} row(s) "
+          f"({size:.1f} MB of SQLite) in {elapsed:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Make the thumbnails and display images of payment proofs
+
+Uploads are processed on the background worker as they arrive; this
+catches up on the ones still pending (uploaded while the worker or Redis
+was down, moved over by scripts/add_proof_blobs.py, or restored from a
+backup without their images), or with --all redoes every proof, e.g.
+after changing PROOF_THUMBNAIL_MAX_PX.
+
+Usage:
+    python scripts/process_proof_images.py           # process pending proofs here
+    python scripts/process_proof_images.py --queue   # hand them to the worker instead
+    python scripts/process_proof_images.py --all
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app
+from app.models.proof_blob import ProofBlob
+from app.services.proof_image_service import ProofImageService
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Make proof thumbnails and display images')
+    parser.add_argument('--all', action='store_true', help='Redo every proof, not only pending ones')
+    parser.add_argument('--queue', action='store_true', help='Queue the proofs for the worker')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        reset = ProofImageService.reset_missing()
+        if reset:
+            print(f"{len(reset)} proof(s) had no images on disk")
+        query = ProofBlob.query if args.all else ProofBlob.query.filter_by(image_status='pending')
+        blobs = query.order_by(ProofBlob.id).all()
+        if args.queue:
+            queued = sum(1 for blob in blobs if ProofImageService.enqueue(blob))
+            print(f"Queued {queued} of {len(blobs)} proof(s)")
+            sys.exit(0 if queued == len(blobs) else 1)
+
+        started = time.monotonic()
+        statuses = {}
+        for n, blob in enumerate(blobs, 1):
+            try:
+                status = ProofImageService.process(blob)
+            except FileNotFoundError:
+                status = 'missing'
+            statuses[status] = statuses.get(status, 0) + 1
+            print(f"\r{n}/{len(blobs)}", end='', flush=True)
+        summary = ', '.join(f"{count} {status}" for status, count in sorted(statuses.items())) or 'nothing to do'
+        print(f"\rProcessed {len(blobs)} proof(s) in {time.monotonic() - started:.1f}s: {summary}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Continuously replicate the SQLite database's WAL for point-in-time recovery
+Run alongside the app (like worker.py); it switches the database to WAL
+mode and ships committed transactions every WAL_SYNC_INTERVAL_SECONDS
+(default 1) into backups/wal/, encrypted with BACKUP_ENCRYPTION_KEY.
+Restore with scripts/restore_wal.py.
+
+Usage:
+    python scripts/replicate_wal.py
+"""
+import os
+import signal
+import sys
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app
+from app.services.replication_service import ReplicationService
+
+
+def main():
+    stop = threading.Event()
+    for name in ('SIGINT', 'SIGTERM'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), lambda *_: stop.set())
+
+    app = create_app()
+    with app.app_context():
+        try:
+            replicator = ReplicationService.run(os.getenv('BACKUP_ENCRYPTION_KEY'), stop)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+    print(f"Stopped: shipped {replicator.frames_shipped} frames, "
+          f"{replicator.bytes_written / 1024 / 1024:.1f} MB of segments")
+
+
+if __name__ == '__main__':
+    main()
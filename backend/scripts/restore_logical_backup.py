@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Load a logical backup into the database configured by DATABASE_URL
+
+The archived tables are emptied and reloaded in one transaction (COPY on
+PostgreSQL, batched inserts on SQLite). Missing tables are created first,
+so this also moves data between backends, e.g. SQLite to PostgreSQL.
+Incremental backups given after their full backup are then replayed in
+order (upserts plus deletions), one transaction each.
+
+Usage:
+    DATABASE_URL=postgresql://... python scripts/restore_logical_backup.py FULL [INCREMENTAL ...] --key KEY --yes
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app, db
+from app.services.logical_backup_service import LogicalBackupService
+from app.utils.encryption import BackupEncryption, DecryptingReader
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Restore a logical backup')
+    parser.add_argument('files', nargs='+', help='Full backup, then its incrementals in order')
+    parser.add_argument('--key', required=True, help='Base64 backup key')
+    parser.add_argument('--yes', action='store_true', help='Confirm overwriting the archived tables')
+    args = parser.parse_args()
+
+    if not args.yes:
+        print("This replaces every archived table's rows; re-run with --yes to continue.")
+        sys.exit(1)
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        key = BackupEncryption.key_from_string(args.key)
+        started = time.perf_counter()
+        counts = {}
+        for path in args.files:
+            with open(path, 'rb') as f:
+                for table, rows in LogicalBackupService.restore(DecryptingReader(f, key), db.engine).items():
+                    counts[table] = counts.get(table, 0) + rows
+            print(f"Applied {os.path.basename(path)}")
+        elapsed = time.perf_counter() - started
+        dialect = db.engine.dialect.name
+
+    for table, rows in counts.items():
+        print(f"{table}: {rows} row(s)")
+    print(f"Restored {sum(counts.values())} row(s) into {dialect} in {elapsed:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Rebuild the database from the replicated WAL (see scripts/replicate_wal.py)
+as it was at a point in time, into a new file. Stop the app and put the
+file in place of the database to roll it back.
+
+Usage:
+    python scripts/restore_wal.py --list
+    python scripts/restore_wal.py OUTPUT.db [--at 2025-03-01T14:30:00] [--key KEY]
+
+--at is local time unless it carries an offset (e.g. +05:00 or Z); without
+it the latest shipped state is restored. The key defaults to
+BACKUP_ENCRYPTION_KEY.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app
+from app.services.replication_service import ReplicationService
+
+
+def _format(ms):
+    return datetime.fromtimestamp(ms / 1000).isoformat(sep=' ', timespec='seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Point-in-time restore from the replicated WAL')
+    parser.add_argument('output', nargs='?', help='Database file to create')
+    parser.add_argument('--at', help='ISO 8601 time to restore to (default: latest)')
+    parser.add_argument('--key', default=os.getenv('BACKUP_ENCRYPTION_KEY'), help='Base64 backup key')
+    parser.add_argument('--list', action='store_true', help='List the generations that can be restored')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.list:
+            for g in ReplicationService.generations():
+                print(f"{g['generation']}: {_format(g['started_at'])} to {_format(g['restorable_to'])}, "
+                      f"{g['segments']} segment(s), {g['bytes'] / 1024 / 1024:.1f} MB")
+            return
+        if not args.output or not args.key:
+            parser.error('OUTPUT and a key (--key or BACKUP_ENCRYPTION_KEY) are required')
+
+        at_ms = None
+        if args.at:
+            at_ms = int(datetime.fromisoformat(args.at.replace('Z', '+00:00')).timestamp() * 1000)
+        try:
+            summary = ReplicationService.restore(args.output, args.key, at_ms)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print(f"Restored {args.output} to {_format(summary['restored_to'])}: generation "
+              f"{summary['generation']}, {summary['segments']} segment(s), {summary['frames']} frame(s)")
+
+
+if __name__ == '__main__':
+    main()
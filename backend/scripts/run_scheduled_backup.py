@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Scheduled backup with grandfather-father-son retention
+Run hourly (e.g. cron: 0 * * * *). Each run takes a full backup every
+BACKUP_FULL_INTERVAL_HOURS (default 24) and an incremental otherwise, all
+encrypted with BACKUP_ENCRYPTION_KEY, then prunes the backups outside
+BACKUP_KEEP_HOURLY/DAILY/WEEKLY/MONTHLY (default 24/7/4/12). Reads are
+limited to BACKUP_IO_LIMIT_MB_S (default 20, 0 = unlimited).
+
+Usage:
+    python scripts/run_scheduled_backup.py
+    python scripts/run_scheduled_backup.py --no-prune
+    python scripts/run_scheduled_backup.py --prune-only [--dry-run]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app
+from app.services.backup_schedule_service import BackupScheduleService
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scheduled backup with tiered retention')
+    parser.add_argument('--no-prune', action='store_true', help='Back up without pruning')
+    parser.add_argument('--prune-only', action='store_true', help='Prune without backing up')
+    parser.add_argument('--dry-run', action='store_true', help='With --prune-only: list what would be pruned')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.prune_only:
+            removed, freed = BackupScheduleService.prune(dry_run=args.dry_run)
+            verb = 'Would prune' if args.dry_run else 'Pruned'
+            print(f"{verb} {len(removed)} backup(s), {freed / 1024 / 1024:.1f} MB: {removed}")
+            return
+
+        run = BackupScheduleService.run(prune=not args.no_prune)
+        stats = run.to_dict()
+        if run.status != 'success':
+            print(f"Backup {run.status}: {run.message}")
+            sys.exit(1 if run.status == 'failed' else 0)
+        print(f"Backup {run.backup_id} ({run.backup_type}): {run.bytes_written / 1024 / 1024:.1f} MB "
+              f"in {run.duration_ms / 1000:.1f}s, {stats['mb_per_second'] or 0} MB/s read, "
+              f"{run.throttled_ms / 1000:.1f}s throttled; pruned {run.pruned_count} backup(s), "
+              f"{run.pruned_bytes / 1024 / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
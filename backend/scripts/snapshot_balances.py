@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+"""
+Take per-student ledger balance snapshots
+Run periodically (e.g. nightly cron) to keep point-in-time balance
+lookups to one snapshot plus a short tail of entries.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app
+from app.services.ledger_service import LedgerService
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        print(f"Wrote {LedgerService.take_snapshots()} balance snapshot(s)")
+
+
+if __name__ == '__main__':
+    main()
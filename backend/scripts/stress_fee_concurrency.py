@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Concurrency stress check for fee balance accounting
+Many threads submit payments against one fee at once, then approve them
+concurrently; the fee must never be over-submitted or over-paid.
+
+Usage:
+    python scripts/stress_fee_concurrency.py [threads] [attempts_per_thread]
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file.
+Exits 1, listing the failed checks, if any check fails (tests/test_fee_concurrency.py
+runs the same checks on SQLite under pytest).
+"""
+import os
+import sys
+import tempfile
+import threading
+from decimal import Decimal
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+if not os.getenv('DATABASE_URL'):
+    _tmp_dir = tempfile.mkdtemp(prefix='hostelix_stress_')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'stress.db')}"
+
+from app import create_app, db
+from app.models.user import User
+from app.models.student import Student
+from app.models.fee import Fee
+from app.models.transaction import Transaction
+from app.services.fee_service import FeeService
+
+MONTHLY_FEE = Decimal('1000.00')
+PAYMENT = Decimal('100.00')
+MONTH, YEAR = 1, 2030
+
+
+def _setup(app):
+    with app.app_context():
+        db.create_all()
+        admin = User(email='stress-admin@example.com', password_hash='x', role='admin')
+        user = User(email='stress-student@example.com', password_hash='x', role='student')
+        db.session.add_all([admin, user])
+        db.session.flush()
+        db.session.add(Student(user_id=user.id, admission_no='STRESS-1', monthly_fee_amount=MONTHLY_FEE))
+        db.session.commit()
+        return admin.id, user.id
+
+
+def _run_threads(count, target):
+    errors = []
+
+    def wrapped(i):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=wrapped, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    attempts = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    app = create_app()
+    admin_id, student_user_id = _setup(app)
+    accepted = []
+
+    def submit(_):
+        with app.app_context():
+            for _ in range(attempts):
+                trx, error = FeeService.add_transaction(student_user_id, MONTH, YEAR, str(PAYMENT))
+                if trx:
+                    accepted.append(trx.id)
+
+    errors = _run_threads(threads, submit)
+    print(f"Submissions: {threads * attempts} attempted, {len(accepted)} accepted, {len(errors)} errors")
+
+    # Approve every accepted transaction twice over, concurrently
+    ids = accepted + accepted
+
+    def approve(i):
+        with app.app_context():
+            FeeService.approve_transaction(ids[i], admin_id)
+
+    errors += _run_threads(len(ids), approve)
+
+    with app.app_context():
+        fee = Fee.query.filter_by(month=MONTH, year=YEAR).one()
+        approved = Transaction.query.filter_by(fee_id=fee.id, status='APPROVED').count()
+        mismatches = FeeService.find_pending_mismatches()
+        print(f"Fee #{fee.id}: expected={fee.expected_amount} paid={fee.paid_amount} "
+              f"status={fee.status} approved_transactions={approved} "
+              f"pending_mismatches={len(mismatches)}")
+
+        expected_count = int(MONTHLY_FEE / PAYMENT)
+        checks = [
+            ('errors raised', len(errors), 0),
+            ('submissions accepted', len(accepted), expected_count),
+            ('transactions approved', approved, expected_count),
+            ('paid amount', fee.paid_amount, MONTHLY_FEE),
+            ('fee status', fee.status, 'APPROVED'),
+            ('pending mismatches', len(mismatches), 0),
+        ]
+        failures = [(name, actual, wanted) for name, actual, wanted in checks if actual != wanted]
+
+    for e in errors:
+        print(f"Error: {e!r}")
+    if failures:
+        print(f"FAIL: {len(failures)} of {len(checks)} checks failed")
+        for name, actual, wanted in failures:
+            print(f"  {name}: got {actual}, expected {wanted}")
+        sys.exit(1)
+    print(f"PASS: {len(checks)} checks")
+
+
+if __name__ == '__main__':
+    main()
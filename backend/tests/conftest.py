@@ -0,0 +1,64 @@
+"""
+Shared fixtures: the app on a throwaway SQLite database, with uploads,
+backups, receipts, cached documents and export results written under the
+test's tmp_path
+
+Run from backend/: pip install -r requirements-dev.txt && python -m pytest
+"""
+import fakeredis
+import pytest
+from app import create_app, db
+from app.models.student import Student
+from app.models.user import User
+from app.services.backup_service import BackupService
+from app.services.job_service import JobService
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'hostelixpro.db'}")
+    monkeypatch.setenv('RECEIPTS_DIR', str(tmp_path / 'receipts'))
+    monkeypatch.setenv('DOCUMENT_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('EXPORT_RESULTS_DIR', str(tmp_path / 'exports'))
+    backup_dir = tmp_path / 'backups'
+    backup_dir.mkdir()
+    monkeypatch.setattr(BackupService, '_get_backup_dir', staticmethod(lambda: str(backup_dir)))
+
+    app = create_app()
+    app.config['TESTING'] = True
+    # Uploads (and the static route serving them) live under root_path
+    app.root_path = str(tmp_path / 'app')
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """Every JobService connection (queues, locks, maintenance) on one fake server"""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(JobService, '_connection', staticmethod(lambda: fakeredis.FakeRedis(server=server)))
+    return fakeredis.FakeRedis(server=server)
+
+
+@pytest.fixture
+def make_user(app):
+    def make_user(email, role='student'):
+        user = User(email=email, password_hash='x', display_name=email.split('@')[0], role=role)
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return make_user
+
+
+@pytest.fixture
+def make_student(make_user):
+    def make_student(email, monthly_fee=100):
+        user = make_user(email)
+        student = Student(user_id=user.id, admission_no=email.split('@')[0].upper(), monthly_fee_amount=monthly_fee)
+        db.session.add(student)
+        db.session.commit()
+        return student
+    return make_student
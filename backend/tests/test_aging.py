@@ -0,0 +1,48 @@
+"""
+Aging report cache: reused until the data behind it changes
+"""
+import pytest
+from app import db
+from app.models.fee import Fee
+from app.services.aging_service import AgingService
+from app.services.fee_service import FeeService
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    # The cache is per process; each test has its own database
+    monkeypatch.setattr(AgingService, '_cache', {})
+
+
+def _total(report):
+    return report['totals']['total']
+
+
+def test_cached_report_follows_payments_and_late_fees(app, redis, make_user, make_student):
+    admin = make_user('admin@x.test', role='admin')
+    student = make_student('s1@x.test')
+    trx, _ = FeeService.add_transaction(student.user_id, 1, 2026, 40)
+    fee = db.session.get(Fee, trx.fee_id)
+
+    first, _ = AgingService.get_report()
+    assert _total(first) == 100.0
+    assert AgingService.get_report()[0] is first
+
+    FeeService.approve_transaction(trx.id, admin.id)
+    paid, _ = AgingService.get_report()
+    assert _total(paid) == 60.0
+
+    FeeService.add_late_fee(fee.id, 15, admin.id)
+    assert _total(AgingService.get_report()[0]) == 75.0
+
+
+def test_cache_follows_student_changes(app, make_student):
+    student = make_student('s1@x.test')
+    FeeService.add_transaction(student.user_id, 1, 2026, 40)
+    by_room, _ = AgingService.get_report(group_by='room')
+    assert [row['key'] for row in by_room['rows']] == [None]
+
+    student.room = 'B-12'
+    db.session.commit()
+    by_room, _ = AgingService.get_report(group_by='room')
+    assert [row['key'] for row in by_room['rows']] == ['B-12']
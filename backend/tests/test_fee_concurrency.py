@@ -0,0 +1,58 @@
+"""
+Fee balances under concurrent payments: submissions and approvals racing
+on one fee never over-submit or over-pay it
+(scripts/stress_fee_concurrency.py runs the same checks at scale, or on Postgres)
+"""
+import threading
+from decimal import Decimal
+from app.models.fee import Fee
+from app.models.transaction import Transaction
+from app.services.fee_service import FeeService
+
+MONTHLY_FEE = Decimal('1000.00')
+PAYMENT = Decimal('100.00')
+THREADS, ATTEMPTS = 12, 3
+
+
+def _run_threads(app, count, target):
+    errors = []
+
+    def wrapped(i):
+        try:
+            with app.app_context():
+                target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=wrapped, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def test_concurrent_payments_never_overpay_a_fee(app, redis, make_user, make_student):
+    admin = make_user('admin@x.test', role='admin')
+    student_user_id = make_student('s1@x.test', monthly_fee=MONTHLY_FEE).user_id
+    admin_id = admin.id
+    accepted = []
+
+    def submit(_):
+        for _ in range(ATTEMPTS):
+            trx, _ = FeeService.add_transaction(student_user_id, 1, 2030, str(PAYMENT))
+            if trx:
+                accepted.append(trx.id)
+
+    errors = _run_threads(app, THREADS, submit)
+    # Every accepted payment approved twice over, concurrently
+    ids = accepted + accepted
+    errors += _run_threads(app, len(ids), lambda i: FeeService.approve_transaction(ids[i], admin_id))
+
+    expected_count = int(MONTHLY_FEE / PAYMENT)
+    fee = Fee.query.filter_by(month=1, year=2030).one()
+    assert errors == []
+    assert len(accepted) == expected_count
+    assert Transaction.query.filter_by(fee_id=fee.id, status='APPROVED').count() == expected_count
+    assert (fee.paid_amount, fee.status) == (MONTHLY_FEE, 'APPROVED')
+    assert FeeService.find_pending_mismatches() == []
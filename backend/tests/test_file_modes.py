@@ -0,0 +1,54 @@
+"""
+Files written atomically get the default mode, not mkstemp's 0600, so the
+web server can serve them
+"""
+import io
+import os
+import stat
+from PIL import Image
+from app.services.document_cache_service import DocumentCacheService
+from app.services.export_service import ExportService
+from app.services.fee_service import FeeService
+from app.services.proof_image_service import ProofImageService
+from app.services.proof_storage_service import ProofStorageService
+from app.services.receipt_service import ReceiptService
+from app.utils.files import FILE_MODE
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def _jpeg():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), 'red').save(buffer, 'JPEG')
+    buffer.seek(0)
+    return buffer
+
+
+def test_default_mode_follows_the_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    assert FILE_MODE == 0o666 & ~umask
+
+
+def test_stored_proofs_and_their_images_are_readable(app):
+    blob, created = ProofStorageService.store(_jpeg(), 'proof.jpg')
+    assert created
+    assert _mode(ProofStorageService.blob_file(blob)) == FILE_MODE
+
+    assert ProofImageService.process(blob) == 'ready'
+    for kind in ('thumb', 'display'):
+        assert _mode(ProofImageService.derived_file(blob, kind)) == FILE_MODE
+
+
+def test_receipts_and_cached_documents_are_readable(app, redis, make_user, make_student):
+    admin = make_user('admin@x.test', role='admin')
+    student = make_student('s1@x.test')
+    trx, _ = FeeService.add_transaction(student.user_id, 3, 2026, 40)
+    FeeService.approve_transaction(trx.id, admin.id)
+    path, error = ReceiptService.get_receipt(trx.id, ExportService.receipt_data(trx.id))
+    assert error is None and _mode(path) == FILE_MODE
+
+    path = DocumentCacheService.store(DocumentCacheService.key('challan', 1, 'v1'), b'%PDF')
+    assert _mode(path) == FILE_MODE
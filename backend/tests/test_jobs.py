@@ -0,0 +1,126 @@
+"""
+Background exports: queued by the API, run by an rq worker, downloaded
+while retained
+"""
+import io
+import os
+import time
+import zipfile
+import pytest
+from rq import SimpleWorker
+from app.models.fee import Fee
+from app.services import export_service
+from app.services.auth_service import AuthService
+from app.services.fee_service import FeeService
+from app.services.job_service import JobService, EXPORT_TYPES, QUEUE_NAME, RESULT_TTL_SECONDS
+
+
+def _headers(user):
+    token, _ = AuthService.generate_jwt_token(user.id, user.role)
+    return {'Authorization': f"Bearer {token}"}
+
+
+def _run_jobs(redis):
+    SimpleWorker([QUEUE_NAME], connection=redis).work(burst=True)
+
+
+@pytest.fixture
+def fee(make_student):
+    student = make_student('s1@x.test')
+    FeeService.add_transaction(student.user_id, 3, 2026, 40)
+    return Fee.query.filter_by(student_id=student.id).one()
+
+
+# Export type -> the API call that queues it and a check of the download
+EXPORTS = {
+    'reports_xlsx': (
+        lambda fee: '/api/v1/reports/export?async=true',
+        lambda body: zipfile.ZipFile(io.BytesIO(body)).testzip() is None,
+    ),
+    'fee_challan': (
+        lambda fee: f"/api/v1/fees/{fee.id}/challan?async=true",
+        lambda body: body.startswith(b'%PDF'),
+    ),
+    'bulk_challans': (
+        lambda fee: '/api/v1/fees/challans/bulk?month=3&year=2026&async=true',
+        lambda body: zipfile.ZipFile(io.BytesIO(body)).namelist() != [],
+    ),
+}
+
+
+def test_every_export_type_is_covered():
+    assert set(EXPORTS) == set(EXPORT_TYPES)
+
+
+@pytest.mark.parametrize('export_type', sorted(EXPORTS))
+def test_export_is_queued_run_and_downloaded(app, redis, make_user, fee, monkeypatch, export_type):
+    # One process: the test database is not shared with spawned renderers
+    monkeypatch.setattr(export_service, 'CHALLAN_WORKERS', 1)
+    admin = make_user('admin@x.test', role='admin')
+    client = app.test_client()
+    url, check = EXPORTS[export_type]
+
+    response = client.get(url(fee), headers=_headers(admin))
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    status = client.get(f"/api/v1/exports/{job_id}", headers=_headers(admin)).get_json()
+    assert status['status'] == 'queued' and status['export_type'] == export_type
+    assert client.get(f"/api/v1/exports/{job_id}/download", headers=_headers(admin)).status_code == 409
+
+    _run_jobs(redis)
+
+    status = client.get(f"/api/v1/exports/{job_id}", headers=_headers(admin)).get_json()
+    assert status['status'] == 'finished'
+    response = client.get(status['download_url'], headers=_headers(admin))
+    assert response.status_code == 200
+    assert response.mimetype == EXPORT_TYPES[export_type]['mimetype']
+    assert check(response.data)
+
+    os.remove(JobService.result_path(job_id, EXPORT_TYPES[export_type]['extension']))
+    assert client.get(status['download_url'], headers=_headers(admin)).status_code == 410
+
+
+def test_failed_export_reports_its_error(app, redis, make_user):
+    admin = make_user('admin@x.test', role='admin')
+    job_id, error = JobService.enqueue_export('fee_challan', {'fee_id': 999}, admin.id)
+    assert error is None
+    _run_jobs(redis)
+
+    job = JobService.get_job(job_id, {'user_id': admin.id, 'role': 'admin'})
+    status = JobService.job_status(job)
+    assert status['status'] == 'failed' and 'Fee not found' in status['error']
+    assert not os.listdir(JobService._results_dir())
+
+
+def test_job_is_visible_to_its_owner_and_admins_only(app, redis, make_user, fee):
+    owner = make_user('owner@x.test', role='student')
+    other = make_user('other@x.test', role='student')
+    admin = make_user('admin@x.test', role='admin')
+    job_id, _ = JobService.enqueue_export('fee_challan', {'fee_id': fee.id}, owner.id)
+
+    assert JobService.get_job(job_id, {'user_id': owner.id, 'role': 'student'}).id == job_id
+    assert JobService.get_job(job_id, {'user_id': admin.id, 'role': 'admin'}).id == job_id
+    assert JobService.get_job(job_id, {'user_id': other.id, 'role': 'student'}) is None
+    assert JobService.get_job('no-such-job', {'user_id': admin.id, 'role': 'admin'}) is None
+
+    client = app.test_client()
+    assert client.get(f"/api/v1/exports/{job_id}", headers=_headers(other)).status_code == 404
+    assert client.get(f"/api/v1/exports/{job_id}/download", headers=_headers(other)).status_code == 404
+    assert client.get(f"/api/v1/exports/{job_id}", headers=_headers(owner)).status_code == 200
+
+
+def test_results_past_their_ttl_are_purged(app, redis, make_user, fee):
+    results = JobService._results_dir()
+    expired = os.path.join(results, 'expired.pdf')
+    fresh = os.path.join(results, 'fresh.pdf')
+    for path in (expired, fresh):
+        with open(path, 'wb') as f:
+            f.write(b'%PDF')
+    old = time.time() - RESULT_TTL_SECONDS - 60
+    os.utime(expired, (old, old))
+
+    # Every enqueue purges first
+    admin = make_user('admin@x.test', role='admin')
+    JobService.enqueue_export('fee_challan', {'fee_id': fee.id}, admin.id)
+    assert sorted(os.listdir(results)) == ['fresh.pdf']
+    assert JobService.purge_expired_results() == 0
@@ -0,0 +1,47 @@
+"""
+Logical backup archives: incremental chains restored into a fresh database
+"""
+import sqlite3
+from app import db
+from app.services.backup_service import BackupService
+from app.utils.encryption import BackupEncryption
+
+
+def _restore(backup, key, path):
+    chain = BackupService.get_chain(backup)
+    return BackupService._restore_chain_to_sqlite(chain, BackupEncryption.key_from_string(key), str(path))
+
+
+def test_incremental_restore_after_unique_value_reused(app, make_user, tmp_path):
+    deleted = make_user('u@x.test')
+    make_user('other@x.test')
+    full, key = BackupService.create_backup(None)
+
+    # A new user takes the deleted one's email under a new id
+    db.session.delete(deleted)
+    db.session.commit()
+    replacement = make_user('u@x.test')
+    assert replacement.id != deleted.id
+    incremental, _ = BackupService.create_backup(None, key, backup_type='incremental')
+
+    staged = tmp_path / 'staged.db'
+    assert _restore(incremental, key, staged) == 2
+    with sqlite3.connect(staged) as conn:
+        rows = dict(conn.execute("SELECT email, id FROM users"))
+    assert rows == {'u@x.test': replacement.id, 'other@x.test': replacement.id - 1}
+
+
+def test_incremental_restore_applies_updates_and_deletions(app, make_user, tmp_path):
+    kept = make_user('kept@x.test')
+    gone = make_user('gone@x.test')
+    full, key = BackupService.create_backup(None, backup_format='logical')
+
+    kept.display_name = 'Renamed'
+    db.session.delete(gone)
+    db.session.commit()
+    incremental, _ = BackupService.create_backup(None, key, backup_type='incremental')
+
+    staged = tmp_path / 'staged.db'
+    assert _restore(incremental, key, staged) == 1
+    with sqlite3.connect(staged) as conn:
+        assert conn.execute("SELECT email, display_name FROM users").fetchall() == [('kept@x.test', 'Renamed')]
@@ -0,0 +1,72 @@
+"""
+Proof images: only admins are handed the original upload, which keeps its
+EXIF; everyone else gets the display copy made without it
+"""
+import io
+from PIL import Image
+from app import db
+from app.models.proof_blob import ProofBlob
+from app.models.user import User
+from app.services.auth_service import AuthService
+from app.services.proof_image_service import ProofImageService
+
+
+def _headers(user):
+    token, _ = AuthService.generate_jwt_token(user.id, user.role)
+    return {'Authorization': f"Bearer {token}"}
+
+
+def _photo_with_location():
+    exif = Image.Exif()
+    exif[0x8825] = {1: 'N', 2: (51.0, 30.0, 0.0)}  # GPSInfo: latitude
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), 'red').save(buffer, 'JPEG', exif=exif)
+    buffer.seek(0)
+    return buffer
+
+
+def _proofs(client, user, fee_id):
+    fees = client.get('/api/v1/fees', headers=_headers(user)).get_json()['fees']
+    transactions = client.get(f"/api/v1/fees/{fee_id}/transactions", headers=_headers(user)).get_json()
+    return fees[0]['pending_proofs'], transactions[0]['proof_path']
+
+
+def test_only_admins_are_given_the_original(app, make_user, make_student):
+    admin = make_user('admin@x.test', role='admin')
+    teacher = make_user('teacher@x.test', role='teacher')
+    student = db.session.get(User, make_student('s1@x.test').user_id)
+    client = app.test_client()
+
+    response = client.post(
+        '/api/v1/fees/upload-proof', headers=_headers(student),
+        data={'proof_file': (_photo_with_location(), 'proof.jpg')}
+    )
+    original = response.get_json()['path']
+    response = client.post(
+        '/api/v1/fees', headers=_headers(student),
+        json={'month': 3, 'year': 2026, 'amount': 40, 'proof_path': original}
+    )
+    fee_id = response.get_json()['fee_id']
+    assert Image.open(io.BytesIO(client.get(original).data)).getexif().get(0x8825)
+
+    # Nothing to show until the display copy exists
+    assert _proofs(client, teacher, fee_id) == ([None], None)
+    assert _proofs(client, admin, fee_id) == ([original], original)
+
+    blob = ProofBlob.query.one()
+    assert ProofImageService.process(blob) == 'ready'
+    assert _proofs(client, teacher, fee_id) == ([blob.display_path], blob.display_path)
+    assert _proofs(client, student, fee_id) == ([blob.display_path], blob.display_path)
+    assert _proofs(client, admin, fee_id) == ([original], original)
+    shown = Image.open(io.BytesIO(client.get(blob.display_path).data))
+    assert not shown.getexif().get(0x8825)
+
+
+def test_proofs_that_are_not_images_are_shown_as_uploaded(app, make_user):
+    pdf = '/static/uploads/proofs/ab/' + 'ab' * 32 + '.pdf'
+    blob = ProofBlob(sha256='ab' * 32, size_bytes=4, extension='.pdf', image_status='unsupported')
+    db.session.add(blob)
+    db.session.commit()
+    assert blob.path == pdf
+    legacy = '/static/uploads/old.jpg'
+    assert ProofImageService.viewable_for([pdf, legacy]) == {pdf: pdf, legacy: None}
@@ -0,0 +1,50 @@
+"""
+Stored receipts: served only for the approval they were rendered from
+"""
+import os
+from app.services.export_service import ExportService
+from app.services.fee_service import FeeService
+from app.services.receipt_service import ReceiptService
+
+
+def _approved_payment(make_user, make_student):
+    admin = make_user('admin@x.test', role='admin')
+    student = make_student('s1@x.test')
+    trx, error = FeeService.add_transaction(student.user_id, 3, 2026, 40)
+    assert error is None
+    FeeService.approve_transaction(trx.id, admin.id)
+    return trx.id
+
+
+def test_receipt_is_rendered_once_and_served(app, make_user, make_student):
+    trx_id = _approved_payment(make_user, make_student)
+    data = ExportService.receipt_data(trx_id)
+    path, error = ReceiptService.get_receipt(trx_id, data)
+    assert error is None and os.path.basename(path).startswith(f"{trx_id}_")
+    mtime = os.stat(path).st_mtime_ns
+    assert ReceiptService.get_receipt(trx_id, data) == (path, None)
+    assert os.stat(path).st_mtime_ns == mtime
+
+
+def test_receipt_of_another_row_under_the_same_id_is_not_served(app, make_user, make_student):
+    trx_id = _approved_payment(make_user, make_student)
+    data = ExportService.receipt_data(trx_id)
+    old_path, _ = ReceiptService.get_receipt(trx_id, data)
+
+    # What a restore or a reused id looks like: same id, other rows
+    other = dict(data, name='Someone Else', version=data['version'] + '1')
+    new_path, error = ReceiptService.get_receipt(trx_id, other)
+    assert error is None and new_path != old_path
+    assert not os.path.exists(old_path)
+
+    ReceiptService.discard(trx_id)
+    assert not os.path.exists(new_path)
+
+
+def test_receipt_from_before_keys_is_not_served(app, make_user, make_student):
+    trx_id = _approved_payment(make_user, make_student)
+    legacy = os.path.join(ReceiptService._receipts_dir(), f"{trx_id}.pdf")
+    with open(legacy, 'wb') as f:
+        f.write(b'not this one')
+    path, _ = ReceiptService.get_receipt(trx_id, ExportService.receipt_data(trx_id))
+    assert path != legacy and not os.path.exists(legacy)
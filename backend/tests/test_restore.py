@@ -0,0 +1,38 @@
+"""
+Restores: rendered files keyed by id are cleared with the swap
+"""
+import os
+from app import db
+from app.models.user import User
+from app.services import maintenance_service
+from app.services.backup_service import BackupService
+from app.services.document_cache_service import DocumentCacheService
+from app.services.maintenance_service import MaintenanceService
+from app.services.receipt_service import ReceiptService
+from app.services.restore_service import RestoreService, _Progress
+from app.utils.encryption import BackupEncryption
+
+
+def test_restore_clears_receipts_and_document_cache(app, redis, make_user, monkeypatch):
+    monkeypatch.setattr(maintenance_service, 'CHECK_INTERVAL_SECONDS', 0)
+    admin = make_user('admin@x.test', role='admin')
+    backup, key = BackupService.create_backup(None)
+    make_user('later@x.test')
+
+    receipts = os.getenv('RECEIPTS_DIR')
+    os.makedirs(receipts)
+    receipt = os.path.join(receipts, '1_0123456789abcdef.pdf')
+    with open(receipt, 'wb') as f:
+        f.write(b'%PDF')
+    cache_key = DocumentCacheService.key('challan', 1, 'v1')
+    DocumentCacheService.store(cache_key, b'%PDF')
+
+    summary = RestoreService.restore(
+        backup.id, BackupEncryption.key_from_string(key), admin.id, _Progress(None)
+    )
+
+    assert summary['rendered_files_cleared'] == 2
+    assert not os.path.exists(receipt)
+    assert DocumentCacheService.lookup(cache_key) is None
+    assert not MaintenanceService.status()
+    assert [u.email for u in db.session.query(User)] == ['admin@x.test']
@@ -0,0 +1,52 @@
+"""
+Bank statement import: rows are matched against in-memory indexes, which
+only take in what a written batch accepted
+"""
+import io
+from app import db
+from app.models.transaction import Transaction
+from app.services import statement_import_service
+from app.services.fee_service import FeeService
+from app.services.statement_import_service import StatementImportService
+
+
+def _statement(*rows):
+    lines = ['reference,admission_no,amount,month,year'] + [','.join(map(str, row)) for row in rows]
+    return io.BytesIO('\n'.join(lines).encode())
+
+
+def test_reference_of_a_rejected_row_is_not_a_duplicate(app, redis, make_user, make_student, monkeypatch):
+    admin = make_user('admin@x.test', role='admin')
+    student = make_student('s1@x.test')
+    FeeService._create_fee(student, 3, 2026)
+    db.session.commit()
+    build_indexes = StatementImportService._build_indexes
+
+    def build_then_submit():
+        indexes = build_indexes()
+        # A submission lands after the indexes are built, leaving 40 of March open
+        FeeService.add_transaction(student.user_id, 3, 2026, 60)
+        return indexes
+
+    monkeypatch.setattr(StatementImportService, '_build_indexes', staticmethod(build_then_submit))
+    monkeypatch.setattr(statement_import_service, 'BATCH_SIZE', 1)
+
+    summary = StatementImportService.import_statement(
+        _statement(('BANK-1', 'S1', 100, 3, 2026), ('BANK-1', 'S1', 100, 4, 2026)),
+        'statement.csv', admin.id
+    )
+
+    assert summary['unmatched_rows'][0]['reason'] == 'amount exceeds remaining balance'
+    assert (summary['created'], summary['duplicates'], summary['unmatched']) == (1, 0, 1)
+    created = Transaction.query.filter_by(transaction_reference='BANK-1').one()
+    assert created.status == 'APPROVED' and created.amount == 100
+
+
+def test_repeated_reference_in_one_batch_is_a_duplicate(app, redis, make_user, make_student):
+    admin = make_user('admin@x.test', role='admin')
+    make_student('s1@x.test')
+    summary = StatementImportService.import_statement(
+        _statement(('BANK-1', 'S1', 30, 3, 2026), ('BANK-1', 'S1', 30, 3, 2026)),
+        'statement.csv', admin.id
+    )
+    assert (summary['created'], summary['duplicates']) == (1, 1)
@@ -0,0 +1,19 @@
+"""
+Hostelix Pro - Background job worker entry point
+Runs rq workers inside the Flask app context so jobs can use the database
+
+Usage: python worker.py [queue ...]   (default queue: default)
+"""
+import os
+import sys
+from redis import Redis
+from rq import Worker
+from app import create_app
+
+app = create_app()
+
+if __name__ == '__main__':
+    queues = sys.argv[1:] or ['default']
+    connection = Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+    with app.app_context():
+        Worker(queues, connection=connection).work()
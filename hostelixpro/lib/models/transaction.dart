@@ -6,6 +6,8 @@ class Transaction {
   final String paymentMethod;
   final String? transactionReference;
   final String? proofPath;
+  final String? proofThumbnail;
+  final String? proofDisplayPath;
   final String status;
   final String? rejectionReason;
   final DateTime? approvedAt;
@@ -19,6 +21,8 @@ class Transaction {
     required this.paymentMethod,
     this.transactionReference,
     this.proofPath,
+    this.proofThumbnail,
+    this.proofDisplayPath,
     required this.status,
     this.rejectionReason,
     this.approvedAt,
@@ -34,6 +38,8 @@ class Transaction {
       paymentMethod: json['payment_method'],
       transactionReference: json['transaction_reference'],
       proofPath: json['proof_path'],
+      proofThumbnail: json['proof_thumbnail'],
+      proofDisplayPath: json['proof_display_path'],
       status: json['status'],
       rejectionReason: json['rejection_reason'],
       approvedAt: json['approved_at'] != null 
@@ -812,7 +812,7 @@ class _TransactionListState extends State<_TransactionList> {
                               TextButton.icon(
                                 icon: const Icon(Icons.image, size: 16),
                                 label: const Text('View Proof', style: TextStyle(fontSize: 12)),
-                                onPressed: () => _viewProof(trx.proofPath!),
+                                onPressed: () => _viewProof(trx.proofDisplayPath ?? trx.proofPath!),
                                 style: TextButton.styleFrom(
                                   visualDensity: VisualDensity.compact,
                                   padding: const EdgeInsets.symmetric(horizontal: 8),